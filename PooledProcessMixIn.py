@@ -6,12 +6,17 @@ but provides better performance by utilizing a pool
 of processes forked at initialization time
 each process allocate a pool of given number of threads
 
+With _reuse_port set, each process instead listens on a socket of
+its own bound with SO_REUSEPORT and its threads accept on it
+directly; the kernel spreads connections over the processes
+
 Copyright © 2012, Muayyad Alsadi <alsadi@gmail.org>
 Released under the same terms as of Python 
 http://docs.python.org/license.html
 """
 
 import time # might be used for shutdown
+import sys, errno, inspect
 import socket
 
 from multiprocessing import Process, Event, Semaphore, Value, cpu_count
@@ -22,6 +27,10 @@ __author__ = 'Muayyad Saleh Alsadi'
 __version__ = '0.0.2'
 __license__ = 'PSFL'
 
+# Python 2 does not name it; 15 on Linux 3.9+
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT',
+                       15 if sys.platform.startswith('linux') else None)
+
 class PooledProcessMixIn:
     """
 A Mix-in added by inheritance to any Socket Server like BaseHTTPServer to provide concurrency through
@@ -41,6 +50,9 @@ A Pool of forked processes each having a pool of threads
             self._event.set()
             return
         self._event.set()
+        self._serve_request(request, client_address)
+
+    def _serve_request(self, request, client_address):
         if self.verify_request(request, client_address):
             try:
                 self.process_request(request, client_address)
@@ -52,6 +64,7 @@ A Pool of forked processes each having a pool of threads
 
     def _init_pool(self):
         self._pool_initialized = True
+        self._reuse_port = getattr(self, '_reuse_port', False)
         self._process_n = getattr(self, '_process_n', max(2, cpu_count()))
         self._thread_n = getattr(self, '_thread_n', 64)
         self._keep_running = Value('i', 1)
@@ -70,9 +83,15 @@ A Pool of forked processes each having a pool of threads
             self._processes.append(t)
 
     def _process_loop(self):
+        target = self._thread_loop
+        if self._reuse_port:
+            # this process's copy of the reserved socket is not needed
+            self.socket.close()
+            self.socket = self._listen_reuse_port()
+            target = self._accept_loop
         threads = []
         for i in range(self._thread_n):
-            t = Thread(target=self._thread_loop)
+            t = Thread(target=target)
             t.setDaemon(0)
             t.start()
             threads.append(t)
@@ -87,12 +106,63 @@ A Pool of forked processes each having a pool of threads
             self._semaphore.acquire() # wait for resource
             self._real_handle_request_noblock()
 
+    def _accept_loop(self):
+        # all threads of the process block in accept() on its own socket
+        while(self._keep_running.value):
+            try:
+                request, client_address = self.get_request()
+            except socket.error:
+                continue
+            self._serve_request(request, client_address)
+
+    def _listen_reuse_port(self):
+        sock = socket.socket(self.address_family, self.socket_type)
+        if self.allow_reuse_address:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        sock.bind(self.server_address)
+        sock.listen(self.request_queue_size)
+        return sock
+
+    def _base(self, name):
+        # the method of the server class this is mixed into
+        mro = inspect.getmro(self.__class__)
+        for cls in mro[list(mro).index(PooledProcessMixIn) + 1:]:
+            if name in cls.__dict__:
+                return cls.__dict__[name]
+        raise AttributeError(name)
+
+    def server_bind(self):
+        if getattr(self, '_reuse_port', False):
+            if SO_REUSEPORT is None:
+                raise socket.error(errno.ENOPROTOOPT,
+                                   'SO_REUSEPORT is not supported here')
+            # the workers bind the same address
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        self._base('server_bind')(self)
+
+    def server_activate(self):
+        # with _reuse_port the main socket only reserves the address; a
+        # listening one would take a share of the connections
+        if not getattr(self, '_reuse_port', False):
+            self._base('server_activate')(self)
+
+    def serve_forever(self, poll_interval=0.5):
+        if not getattr(self, '_reuse_port', False):
+            return self._base('serve_forever')(self, poll_interval)
+        if not getattr(self, '_pool_initialized', False): self._init_pool()
+        while not self._shutdown_event.is_set():
+            self._shutdown_event.wait(poll_interval)
+
     def pool_shutdown(self):
         self._keep_running.value = 0
         self._shutdown_event.set()
 
     def shutdown(self):
         self.pool_shutdown()
+        if getattr(self, '_reuse_port', False):
+            # serve_forever returns with the shutdown event
+            return
         BaseServer.shutdown(self) # super(BaseServer).shutdown()
         # TODO: is the below needed ?
         #time.sleep(1) # give them 1 second for clean shutdown
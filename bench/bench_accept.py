@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""
+Connections accepted per second by PooledProcessMixIn as the number of
+worker processes grows, with the shared accept handed out through the main
+process and with ``_reuse_port`` (a SO_REUSEPORT socket per process).
+
+The server answers every connection with one byte and closes it. ``-k``
+client processes each connect, read the byte and disconnect in a loop for
+``-t`` seconds. Reports connections/sec and the speedup over one process.
+
+    python bench/bench_accept.py -p 1,2,4,8 -k 8 -t 5
+"""
+
+import sys, os, time, signal, socket, errno
+from optparse import OptionParser
+from multiprocessing import Process, Queue
+from os.path import dirname, abspath, join
+sys.path.insert(0, abspath(join(dirname(__file__), '..')))
+
+from SocketServer import TCPServer, BaseRequestHandler
+from PooledProcessMixIn import PooledProcessMixIn
+
+ADDRESS = ('127.0.0.1', 1236)
+
+class OneByteHandler(BaseRequestHandler):
+  def handle(self):
+    self.request.sendall('x')
+
+class Server(PooledProcessMixIn, TCPServer):
+  allow_reuse_address = True
+  request_queue_size = 1024
+  def __init__(self, processes, reuse_port):
+    self._process_n = processes
+    self._thread_n = 4
+    self._reuse_port = reuse_port
+    TCPServer.__init__(self, ADDRESS, OneByteHandler)
+
+def serve(processes, reuse_port):
+  # own process group, so that the workers go with it
+  os.setsid()
+  Server(processes, reuse_port).serve_forever()
+
+def client(seconds, results):
+  done = 0
+  failed = 0
+  deadline = time.time() + seconds
+  while time.time() < deadline:
+    s = socket.socket()
+    try:
+      s.connect(ADDRESS)
+      s.recv(1)
+      done += 1
+    except socket.error:
+      failed += 1
+    finally:
+      s.close()
+  results.put((done, failed))
+
+def wait_listening():
+  deadline = time.time() + 10
+  while time.time() < deadline:
+    try:
+      socket.create_connection(ADDRESS, 1).close()
+      return
+    except socket.error:
+      time.sleep(0.1)
+  raise RuntimeError('server did not start')
+
+def run(processes, reuse_port, clients, seconds):
+  server = Process(target=serve, args=(processes, reuse_port))
+  server.start()
+  try:
+    wait_listening()
+    # every worker has its socket bound by now, or soon after
+    time.sleep(0.5)
+    results = Queue()
+    workers = [Process(target=client, args=(seconds, results))
+               for i in range(clients)]
+    for p in workers:
+      p.start()
+    counts = [results.get() for p in workers]
+    for p in workers:
+      p.join()
+  finally:
+    try:
+      os.killpg(server.pid, signal.SIGKILL)
+    except OSError as e:
+      if e.errno != errno.ESRCH:
+        raise
+    server.join()
+  return (sum(c[0] for c in counts) / float(seconds),
+          sum(c[1] for c in counts))
+
+if __name__ == '__main__':
+  parser = OptionParser()
+  parser.add_option("-p", "--processes", default="1,2,4,8",
+                    help="comma-separated worker process counts")
+  parser.add_option("-k", "--clients", type="int", default=8,
+                    help="client processes")
+  parser.add_option("-t", "--seconds", type="float", default=5.0)
+  (options, args) = parser.parse_args()
+  levels = [int(p) for p in options.processes.split(',')]
+
+  print "%d client processes, %g s per run" % (options.clients,
+                                               options.seconds)
+  print "%-10s %6s %12s %8s %7s" % ('accept', 'procs', 'conns/sec',
+                                    'speedup', 'errors')
+  for reuse_port in (False, True):
+    base = None
+    for processes in levels:
+      rate, errors = run(processes, reuse_port, options.clients,
+                         options.seconds)
+      base = base or rate
+      print "%-10s %6d %12.1f %7.2fx %7d" % (
+          'reuseport' if reuse_port else 'shared', processes, rate,
+          rate / base if base else 0, errors)
+      sys.stdout.flush()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+"""
+Latency against concurrency for the two serving modes of proxyserv.py:
+``--server pool`` (a thread per connection in a pool of processes) and
+``--server event`` (an event loop per process).
+
+Runs a keep-alive HTTP server on 127.0.0.1:1235 as the upstream, with
+``--delay`` ms before every response, and starts proxyserv.py on 1234 in a
+temporary directory for each mode. At each concurrency level, that many
+client threads each open one keep-alive connection and send ``--requests``
+GETs over ``--objects`` URLs, the first of which are misses and the rest
+hits. Reports requests/sec and the p50 and p99 latency of a request.
+
+    python bench/bench_event.py -c 16,64,256,1024 -n 20
+"""
+
+import sys, os, time, signal, socket, threading, httplib, resource, shutil
+import subprocess, tempfile
+from optparse import OptionParser
+from os.path import dirname, abspath, join
+sys.path.insert(0, abspath(join(dirname(__file__), '..')))
+
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+PROXY = ('127.0.0.1', 1234)
+UPSTREAM = ('127.0.0.1', 1235)
+BODY = 'x' * 4096
+
+class UpstreamHandler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  disable_nagle_algorithm = True
+  delay = 0.0
+  def log_message(self, *args):
+    pass
+  def do_GET(self):
+    time.sleep(self.delay)
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain')
+    self.send_header('Cache-Control', 'max-age=3600')
+    self.send_header('Content-Length', str(len(BODY)))
+    self.end_headers()
+    self.wfile.write(BODY)
+
+class Upstream(ThreadingMixIn, HTTPServer):
+  allow_reuse_address = True
+  daemon_threads = True
+  request_queue_size = 1024
+
+def start_proxy(server, workdir):
+  proxyserv = abspath(join(dirname(__file__), '..', 'proxyserv.py'))
+  p = subprocess.Popen([sys.executable, proxyserv, '--server', server],
+                       cwd=workdir, preexec_fn=os.setsid,
+                       stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+  deadline = time.time() + 30
+  while time.time() < deadline:
+    try:
+      socket.create_connection(PROXY, 1).close()
+      return p
+    except socket.error:
+      time.sleep(0.2)
+  stop_proxy(p)
+  raise RuntimeError('proxy did not start')
+
+def stop_proxy(p):
+  # the workers are in the proxy's process group
+  try:
+    os.killpg(p.pid, signal.SIGTERM)
+  except OSError:
+    pass
+  p.wait()
+
+def client(n, objects, start, latencies, errors, lock):
+  samples = []
+  failed = 0
+  connection = httplib.HTTPConnection(*PROXY, timeout=60)
+  for i in xrange(n):
+    url = 'http://bench.local/object/%d' % ((start + i) % objects)
+    t = time.time()
+    try:
+      connection.request('GET', url)
+      response = connection.getresponse()
+      response.read()
+      samples.append(time.time() - t)
+    except (socket.error, httplib.HTTPException):
+      failed += 1
+      connection.close()
+      connection = httplib.HTTPConnection(*PROXY, timeout=60)
+  connection.close()
+  with lock:
+    latencies.extend(samples)
+    errors[0] += failed
+
+def run(concurrency, n, objects):
+  latencies = []
+  errors = [0]
+  lock = threading.Lock()
+  threads = [threading.Thread(target=client,
+                              args=(n, objects, i * n, latencies, errors, lock))
+             for i in range(concurrency)]
+  start = time.time()
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  elapsed = time.time() - start
+  latencies.sort()
+  def quantile(q):
+    if not latencies:
+      return float('nan')
+    return latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+  return len(latencies) / elapsed, quantile(0.5), quantile(0.99), errors[0]
+
+if __name__ == '__main__':
+  parser = OptionParser()
+  parser.add_option("-c", "--concurrency", default="16,64,256,1024",
+                    help="comma-separated client connection counts")
+  parser.add_option("-n", "--requests", type="int", default=20,
+                    help="requests per connection")
+  parser.add_option("-o", "--objects", type="int", default=2000)
+  parser.add_option("--delay", type="float", default=50.0,
+                    help="ms the upstream waits before answering")
+  parser.add_option("--servers", default="pool,event")
+  (options, args) = parser.parse_args()
+  levels = [int(c) for c in options.concurrency.split(',')]
+
+  soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+  wanted = max(levels) * 2 + 256
+  if soft < wanted:
+    resource.setrlimit(resource.RLIMIT_NOFILE, (min(wanted, hard), hard))
+  threading.stack_size(256 << 10)
+
+  UpstreamHandler.delay = options.delay / 1000.0
+  upstream = Upstream(UPSTREAM, UpstreamHandler)
+  t = threading.Thread(target=upstream.serve_forever)
+  t.setDaemon(True)
+  t.start()
+
+  print "%d requests per connection over %d objects, upstream delay %g ms" % (
+      options.requests, options.objects, options.delay)
+  print "%-6s %6s %10s %9s %9s %7s" % (
+      'server', 'conns', 'req/sec', 'p50 ms', 'p99 ms', 'errors')
+  for server in options.servers.split(','):
+    workdir = tempfile.mkdtemp(prefix='bench_event.')
+    p = start_proxy(server, workdir)
+    try:
+      for concurrency in levels:
+        print "%-6s %6d %10.1f %9.1f %9.1f %7d" % (
+            (server, concurrency) +
+            run(concurrency, options.requests, options.objects))
+        sys.stdout.flush()
+    finally:
+      stop_proxy(p)
+      shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""
+Misses/sec of the upstream fetch path: one forked ``multiprocessing.Process``
+per miss (the old ``cache_or_request``) against the persistent
+:class:`fetcher.FetchEngine`.
+
+Runs a small keep-alive HTTP server on a loopback port as the upstream, and
+drives ``--requests`` fetches from ``--concurrency`` handler threads, as a
+single :class:`PooledProxyServer` worker process would.
+
+    python bench/bench_fetch.py -n 2000 -c 16
+"""
+
+import sys, os, time, threading
+from optparse import OptionParser
+from os.path import dirname, abspath, join
+sys.path.insert(0, abspath(join(dirname(__file__), '..')))
+
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from multiprocessing import Process
+from httpmessage import RequestMessage
+from fetcher import FetchEngine
+
+BODY = 'x' * 4096
+
+class UpstreamHandler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  disable_nagle_algorithm = True
+  def log_message(self, *args):
+    pass
+  def do_GET(self):
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain')
+    self.send_header('Content-Length', str(len(BODY)))
+    self.end_headers()
+    self.wfile.write(BODY)
+
+class Upstream(ThreadingMixIn, HTTPServer):
+  allow_reuse_address = True
+  daemon_threads = True
+
+def make_request(i):
+  request = RequestMessage()
+  request.method = 'GET'
+  request.request_uri = '/object/%d' % i
+  request.host = 'bench.local'
+  return request
+
+def fetch_forked(engine, i):
+  p = Process(target=(lambda: engine.fetch_now(make_request(i), time.time() + 10)))
+  p.start()
+  p.join(10)
+  if p.is_alive():
+    p.terminate()
+    p.join()
+
+def fetch_pooled(engine, i):
+  engine.fetch(make_request(i))
+
+def run(fetch, engine, n, concurrency):
+  counter = iter(xrange(n))
+  lock = threading.Lock()
+  def loop():
+    while True:
+      with lock:
+        i = next(counter, None)
+      if i is None:
+        return
+      fetch(engine, i)
+  threads = [threading.Thread(target=loop) for i in range(concurrency)]
+  start = time.time()
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  return n / (time.time() - start)
+
+if __name__ == '__main__':
+  parser = OptionParser()
+  parser.add_option("-n", "--requests", type="int", default=1000)
+  parser.add_option("-c", "--concurrency", type="int", default=16)
+  (options, args) = parser.parse_args()
+
+  upstream = Upstream(('127.0.0.1', 0), UpstreamHandler)
+  t = threading.Thread(target=upstream.serve_forever)
+  t.setDaemon(True)
+  t.start()
+
+  engine = FetchEngine(upstream=upstream.server_address,
+                       workers=options.concurrency)
+  print "%d misses, %d concurrent" % (options.requests, options.concurrency)
+  for name, fetch in [('process per miss', fetch_forked),
+                      ('fetch engine', fetch_pooled)]:
+    print "%-18s %8.1f misses/sec" % (
+        name, run(fetch, engine, options.requests, options.concurrency))
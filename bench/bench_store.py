@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+One file per entry (:class:`cachestore.FileStore`) against append-only
+segment files (:class:`packstore.PackStore`) on many small objects.
+
+For each store: writes ``--objects`` responses of ``--size`` bytes, rebuilds
+the index as a restarted proxy would, reads ``--reads`` random entries the
+way a hit does (open, read, close), and reports the disk space used.
+With ``--drop-caches`` (root only; it empties the page cache of the whole
+machine) the reads start cold.
+
+    python bench/bench_store.py -n 1000000 -s 2048
+"""
+
+import sys, os, time, random, shutil, tempfile, ctypes
+from optparse import OptionParser
+from os.path import dirname, abspath, join
+sys.path.insert(0, abspath(join(dirname(__file__), '..')))
+
+from cachestore import FileStore
+from packstore import PackStore
+from entrymeta import EntryMeta
+
+HEAD = 'HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nContent-Length: %d'
+
+def key(i):
+  return 'bench.local/object/%d' % i
+
+def write(store, n, body):
+  start = time.time()
+  head = EntryMeta.from_head(HEAD % len(body)).pack()
+  for i in xrange(n):
+    writer = store.writer(key(i))
+    writer.write(head)
+    writer.write(body)
+    writer.commit()
+  return n / (time.time() - start)
+
+def read(store, n, reads):
+  keys = [key(random.randrange(n)) for i in xrange(reads)]
+  start = time.time()
+  for k in keys:
+    entry = store.open_entry(k)
+    entry.read(entry.length, 0)
+    entry.close()
+  return reads / (time.time() - start)
+
+def drop_caches():
+  # write back dirty pages first; drop_caches leaves them alone
+  ctypes.CDLL(None).sync()
+  with open('/proc/sys/vm/drop_caches', 'w') as f:
+    f.write('1\n')
+
+def disk_usage(root):
+  files = used = 0
+  for dirpath, dirnames, filenames in os.walk(root):
+    for name in filenames:
+      files += 1
+      used += os.lstat(join(dirpath, name)).st_blocks * 512
+  return files, used
+
+if __name__ == '__main__':
+  parser = OptionParser()
+  parser.add_option("-n", "--objects", type="int", default=1000000)
+  parser.add_option("-s", "--size", type="int", default=2048)
+  parser.add_option("-r", "--reads", type="int", default=100000)
+  parser.add_option("-d", "--dir", default=None,
+                    help="where to create the stores (default: a temp dir)")
+  parser.add_option("--drop-caches", action="store_true", default=False,
+                    help="empty the machine's page cache before the reads "
+                         "(needs root)")
+  (options, args) = parser.parse_args()
+
+  body = 'x' * options.size
+  print "%d objects of %d bytes, %d random reads" % (
+      options.objects, options.size, options.reads)
+  for name, make in [('file per entry', FileStore), ('pack segments', PackStore)]:
+    cache_dir = tempfile.mkdtemp(prefix='bench_store.', dir=options.dir)
+    try:
+      store = make(cache_dir)
+      store.init()
+      store.load()
+      writes = write(store, options.objects, body)
+
+      store = make(cache_dir)
+      start = time.time()
+      store.load()
+      load = time.time() - start
+
+      if options.drop_caches:
+        drop_caches()
+      reads = read(store, options.objects, options.reads)
+      files, used = disk_usage(store.root)
+      print "%-15s %9.0f writes/sec %9.0f reads/sec  load %6.2fs  " \
+            "%8d files %8.1f MB" % (name, writes, reads, load, files,
+                                    used / 1048576.0)
+    finally:
+      shutil.rmtree(cache_dir)
@@ -0,0 +1,495 @@
+"""
+In-memory index of the entries stored under the cache directory.
+
+The index is built once at startup by walking ``cache_dir`` and is then kept
+up to date by :meth:`CacheIndex.add` and :meth:`CacheIndex.remove`. Lookups
+are plain dict probes; no subprocess and no filesystem access.
+
+The proxy runs as several forked worker processes, so every process holds
+its own copy of the map. Changes are shipped between them through an
+append-only journal file in the cache directory. The journal length lives in
+shared memory, so a lookup only has to compare a few integers to know
+whether another process has published anything since the last time it
+looked.
+:class:`SharedMap` is that mechanism on its own; other stores build their
+indexes on it.
+
+A map can also be checkpointed to a snapshot file (a flat binary dump read
+back with one sequential read) together with how far into the journal it
+was taken. At startup, the snapshot plus the rest of the previous run's
+journal give back the index without walking the cache directory; the walk
+happens afterwards, in the background (:meth:`CacheIndex.reconcile`). A
+checkpoint also starts a new journal, so the journal holds only what changed
+since the last snapshot; the one before is kept until the next checkpoint.
+A process that falls behind by more than one checkpoint reloads the
+snapshot, and events (:meth:`SharedMap.notify`) sent in between are then
+lost to it.
+"""
+
+import os, time, struct, threading
+from multiprocessing import Lock, Value
+
+JOURNAL_NAME = '.index.journal'
+SNAPSHOT_NAME = '.index.snapshot'
+SNAPSHOT_MAGIC = 'CIX1'
+# magic, run id of the journal it continues, journal offset, entry count
+SNAPSHOT_HEADER = struct.Struct('<4s16sQI')
+# name length, encoded value length
+SNAPSHOT_RECORD = struct.Struct('<HH')
+# what an unfinished fetch left in its file under the unversioned layout
+PLACEHOLDER = '~empty~'
+# entries are written under <path><TEMP_MARK><writer id> and renamed into place
+TEMP_MARK = '.tmp.'
+
+class SharedMap(object):
+
+  """A ``name -> value`` map with a replica in every process forked after
+  :meth:`reset`. Names must not contain tabs or newlines; subclasses say how
+  values are written to the journal with :meth:`encode` and :meth:`decode`,
+  and the encoded form has the same restriction."""
+
+  def __init__(self, journal_path):
+    self.journal_path = journal_path
+    self._entries = {}
+    self._lock = threading.Lock()
+    # shared between every process forked after this point
+    self._journal_lock = Lock()
+    self._journal_size = Value('L', 0, lock=False)
+    # bumped twice by every checkpoint that starts a new journal (odd while
+    # it does so), where the snapshot was taken in the old journal, and
+    # where the records after that start in the new one
+    self._generation = Value('L', 0, lock=False)
+    self._rotated_at = Value('L', 0, lock=False)
+    self._start = Value('L', 0, lock=False)
+    self._generation_seen = 0
+    self._write_fd = None
+    self._read_fd = None
+    self._read_pid = None
+    self._replayed = 0
+    self.run_id = None
+    self.snapshot_path = None
+    # when reset() started this run's journal
+    self.started = None
+    # whether the contents came from a snapshot rather than from scratch
+    self.from_snapshot = False
+
+  def encode(self, value):
+    return str(value)
+
+  def decode(self, text):
+    return text
+
+  def on_event(self, event):
+    """Called in every process for each event sent with :meth:`notify`."""
+    pass
+
+  def reset(self, entries):
+    """Replace the contents with the dict ``entries`` and start a new
+    journal. Must run before the processes sharing the map are forked."""
+    with self._lock:
+      self._entries = entries
+      self.started = time.time()
+      if self._write_fd is not None:
+        os.close(self._write_fd)
+      self._write_fd = os.open(self.journal_path,
+          os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0644)
+      # tells snapshots of this run apart from those of earlier ones
+      self.run_id = os.urandom(8).encode('hex')
+      record = '#%s\n' % self.run_id
+      os.write(self._write_fd, record)
+      self._journal_size.value = self._replayed = len(record)
+      self._start.value = len(record)
+      self._generation_seen = self._generation.value
+
+  #......................................................................
+  def checkpoint(self, path):
+    """Write the current contents to the snapshot file ``path``, atomically
+    replacing it, and start a new journal from there: the records published
+    while the snapshot was written are carried over, and every process moves
+    on to the new journal the next time it looks."""
+    self._catch_up()
+    with self._lock:
+      items = self._entries.items()
+      offset = self._replayed
+      generation = self._generation_seen
+    self.snapshot_path = path
+    if self._write_fd is None:
+      # no journal to start again
+      self._write_snapshot(path, self.run_id, offset, items)
+      return
+    run_id = os.urandom(8).encode('hex')
+    header = '#%s\n' % run_id
+    tmppath = self._write_snapshot(path, run_id, len(header), items, False)
+
+    self._journal_lock.acquire()
+    try:
+      if self._generation.value != generation:
+        # another process started a journal meanwhile; keep its snapshot
+        os.remove(tmppath)
+        return
+      fd = os.open(self.journal_path, os.O_RDONLY)
+      try:
+        tail = _read_range(fd, offset, self._journal_size.value)
+      finally:
+        os.close(fd)
+      newpath = self.journal_path + '.new'
+      fd = os.open(newpath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND,
+                   0644)
+      os.write(fd, header + tail)
+      self._generation.value += 1
+      os.rename(tmppath, path)
+      # kept for processes that have not read the rest of it yet
+      os.rename(self.journal_path, self.journal_path + '.old')
+      os.rename(newpath, self.journal_path)
+      self._rotated_at.value = offset
+      self._start.value = len(header)
+      self._journal_size.value = len(header) + len(tail)
+      self._generation.value += 1
+      with self._lock:
+        os.close(self._write_fd)
+        self._write_fd = fd
+        self._forget_read_fd()
+        # the tail carried over is where this process left off
+        self._replayed += len(header) - offset
+        self._generation_seen = self._generation.value
+        self.run_id = run_id
+    finally:
+      self._journal_lock.release()
+    self._catch_up()
+
+  def _write_snapshot(self, path, run_id, offset, items, rename=True):
+    parts = [SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, run_id or '', offset,
+                                  len(items))]
+    for name, value in items:
+      value = self.encode(value)
+      parts.append(SNAPSHOT_RECORD.pack(len(name), len(value)))
+      parts.append(name)
+      parts.append(value)
+    tmppath = '%s.%d' % (path, os.getpid())
+    f = open(tmppath, 'wb')
+    try:
+      f.write(''.join(parts))
+    finally:
+      f.close()
+    if rename:
+      os.rename(tmppath, path)
+    return tmppath
+
+  def _read_snapshot(self, path):
+    """``(run_id, offset, entries)`` from the snapshot file ``path``, or
+    None if there is no usable one."""
+    try:
+      f = open(path, 'rb')
+      try:
+        data = f.read()
+      finally:
+        f.close()
+      magic, run_id, offset, count = SNAPSHOT_HEADER.unpack_from(data)
+    except (IOError, struct.error):
+      return None
+    if magic != SNAPSHOT_MAGIC:
+      return None
+    entries = {}
+    at = SNAPSHOT_HEADER.size
+    try:
+      for i in xrange(count):
+        name_len, value_len = SNAPSHOT_RECORD.unpack_from(data, at)
+        at += SNAPSHOT_RECORD.size
+        name = data[at:at + name_len]
+        at += name_len
+        entries[name] = self.decode(data[at:at + value_len])
+        at += value_len
+    except (struct.error, ValueError):
+      return None
+    return run_id.rstrip('\0'), offset, entries
+
+  def load_snapshot(self, path):
+    """Read the snapshot file ``path`` and, if the journal on disk is the
+    one it was taken from, replay the rest of that journal on top. Returns
+    ``(entries, complete)``, or None if there is no usable snapshot;
+    ``complete`` is False if changes made after the snapshot are missing.
+    Does not touch the current contents."""
+    self.snapshot_path = path
+    snapshot = self._read_snapshot(path)
+    if snapshot is None:
+      return None
+    run_id, offset, entries = snapshot
+    try:
+      f = open(self.journal_path, 'rb')
+      try:
+        header = f.readline(64)
+        if header != '#%s\n' % run_id:
+          return entries, False
+        # only what came after the snapshot
+        f.seek(offset)
+        tail = f.read()
+      finally:
+        f.close()
+    except IOError:
+      return entries, False
+    saved, self._entries = self._entries, entries
+    try:
+      for record in tail[:tail.rfind('\n') + 1].splitlines(True):
+        self._apply(record)
+    finally:
+      self._entries = saved
+    return entries, True
+
+  #......................................................................
+  def get(self, name):
+    if self._journal_size.value != self._replayed or \
+        self._generation.value != self._generation_seen:
+      self._catch_up()
+    return self._entries.get(name)
+
+  def __contains__(self, name):
+    return self.get(name) is not None
+
+  def __len__(self):
+    self._catch_up()
+    return len(self._entries)
+
+  def items(self):
+    self._catch_up()
+    with self._lock:
+      return self._entries.items()
+
+  def put(self, name, value):
+    self._publish('+%s\t%s\n' % (name, self.encode(value)))
+
+  def discard(self, name):
+    self._publish('-%s\n' % name)
+
+  def replace(self, name, old, new):
+    """Set ``name`` to ``new`` only if it still maps to ``old`` when the
+    change is replayed. Every replica replays the journal in the same order,
+    so they all make the same decision."""
+    self._publish('=%s\t%s\t%s\n' % (name, self.encode(old), self.encode(new)))
+
+  def notify(self, event):
+    """Pass the string ``event`` to :meth:`on_event` in every process."""
+    self._publish('!%s\n' % event)
+
+  #......................................................................
+  def _publish(self, record):
+    if self._write_fd is None:
+      # map was never reset (e.g. cache disabled); keep it local
+      with self._lock:
+        self._apply(record)
+      return
+    self._journal_lock.acquire()
+    try:
+      if self._generation.value != self._generation_seen:
+        with self._lock:
+          self._move_on()
+      os.write(self._write_fd, record)
+      self._journal_size.value += len(record)
+    finally:
+      self._journal_lock.release()
+    self._catch_up()
+
+  def _catch_up(self):
+    if self._generation.value != self._generation_seen:
+      # a checkpoint started a new journal; waits for it to finish
+      self._journal_lock.acquire()
+      try:
+        with self._lock:
+          if self._generation.value != self._generation_seen:
+            self._move_on()
+      finally:
+        self._journal_lock.release()
+    with self._lock:
+      generation = self._generation_seen
+      end = self._journal_size.value
+      if end == self._replayed:
+        return
+      opened = self._read_pid != os.getpid()
+      if opened:
+        # file offsets are shared across fork; every process needs its own
+        self._read_fd = os.open(self.journal_path, os.O_RDONLY)
+        self._read_pid = os.getpid()
+      data = _read_range(self._read_fd, self._replayed, end)
+      if self._generation.value != generation:
+        # a new journal was started meanwhile: what was read is good only
+        # if it came from a descriptor on the old one
+        if opened:
+          self._forget_read_fd()
+        return
+      # only apply complete records; a torn tail is picked up next time
+      complete = data.rfind('\n') + 1
+      for record in data[:complete].splitlines(True):
+        self._apply(record)
+      self._replayed += complete
+
+  def _move_on(self):
+    """Switch to the journal the last checkpoint started. Called with the
+    journal lock and ``_lock`` held."""
+    generation = self._generation.value
+    start = self._start.value
+    rotated_at = self._rotated_at.value
+    if generation == self._generation_seen + 2 and \
+        self._replayed >= rotated_at:
+      # the new journal starts with what this process read after the
+      # snapshot point
+      replayed = self._replayed - rotated_at + start
+    elif generation == self._generation_seen + 2:
+      # read the old journal up to the snapshot point
+      if self._read_pid == os.getpid():
+        data = _read_range(self._read_fd, self._replayed, rotated_at)
+      else:
+        fd = os.open(self.journal_path + '.old', os.O_RDONLY)
+        try:
+          data = _read_range(fd, self._replayed, rotated_at)
+        finally:
+          os.close(fd)
+      for record in data.splitlines(True):
+        self._apply(record)
+      replayed = start
+    else:
+      # too far behind; start again from the snapshot, which the journal
+      # lock keeps matched with the journal
+      snapshot = self.snapshot_path and self._read_snapshot(self.snapshot_path)
+      if not snapshot:
+        raise IOError('snapshot %s is gone' % self.snapshot_path)
+      self._entries = snapshot[2]
+      replayed = snapshot[1]
+    self._forget_read_fd()
+    os.close(self._write_fd)
+    self._write_fd = os.open(self.journal_path, os.O_WRONLY | os.O_APPEND)
+    self._replayed = replayed
+    self._generation_seen = generation
+
+  def _forget_read_fd(self):
+    if self._read_pid == os.getpid():
+      os.close(self._read_fd)
+    self._read_fd = self._read_pid = None
+
+  def _apply(self, record):
+    record = record.rstrip('\n')
+    op = record[:1]
+    if op == '+':
+      name, value = record[1:].split('\t', 1)
+      self._entries[name] = self.decode(value)
+    elif op == '-':
+      self._entries.pop(record[1:], None)
+    elif op == '=':
+      name, old, new = record[1:].split('\t', 2)
+      if name in self._entries and self.encode(self._entries[name]) == old:
+        self._entries[name] = self.decode(new)
+    elif op == '!':
+      self.on_event(record[1:])
+    # '#' starts a journal
+
+def _read_range(fd, start, end):
+  """Bytes ``start`` to ``end`` of the file open as ``fd``, or as many of
+  them as it has."""
+  os.lseek(fd, start, os.SEEK_SET)
+  chunks = []
+  left = end - start
+  while left > 0:
+    data = os.read(fd, left)
+    if not data:
+      break
+    chunks.append(data)
+    left -= len(data)
+  return ''.join(chunks)
+
+class CacheIndex(SharedMap):
+
+  """Map from the path of every entry under ``root`` to its
+  ``(size, mtime)``."""
+
+  def __init__(self, root):
+    SharedMap.__init__(self, os.path.join(root, JOURNAL_NAME))
+    self.root = root
+
+  def encode(self, value):
+    return '%d %r' % value
+
+  def decode(self, text):
+    size, mtime = text.split(' ')
+    return int(size), float(mtime)
+
+  def _walk(self, before):
+    """Yield ``(path, stat)`` for every entry under ``root``, removing the
+    temporary files of unfinished writes last changed before the time
+    ``before`` on the way; newer ones may belong to a write in progress."""
+    for dirpath, dirnames, filenames in os.walk(self.root):
+      for name in filenames:
+        path = os.path.join(dirpath, name)
+        if name.startswith('.index.'):
+          # the journal and snapshots
+          continue
+        try:
+          st = os.stat(path)
+        except OSError:
+          continue
+        if TEMP_MARK in name:
+          if st.st_mtime < before:
+            # a write that never completed
+            try:
+              os.remove(path)
+            except OSError:
+              pass
+          continue
+        yield path, st
+
+  def scan(self):
+    """Rebuild the index from the cache directory and start a new journal.
+    Must run before the worker processes are forked."""
+    # nothing writes before the workers are forked
+    entries = dict((path, (st.st_size, st.st_mtime))
+                   for path, st in self._walk(float('inf')))
+    self.reset(entries)
+    self.from_snapshot = False
+    return len(entries)
+
+  def load(self, snapshot_path):
+    """Like :meth:`scan`, but start from the snapshot at
+    ``snapshot_path`` if there is a usable one. The index is then only as
+    good as the snapshot and the journal, so :meth:`reconcile` should run
+    soon after."""
+    loaded = self.load_snapshot(snapshot_path)
+    if loaded is None or not loaded[1]:
+      # none, or changes made after it are missing
+      return self.scan()
+    self.reset(loaded[0])
+    self.from_snapshot = True
+    return len(loaded[0])
+
+  def reconcile(self, pause_every=1000, pause=0.01):
+    """Walk the cache directory and correct the index where it disagrees,
+    sleeping ``pause`` seconds every ``pause_every`` files so the disk stays
+    available to the workers."""
+    seen = set()
+    for i, (path, st) in enumerate(self._walk(self.started)):
+      seen.add(path)
+      if self.get(path) != (st.st_size, st.st_mtime):
+        self.add(path, st.st_size, st.st_mtime)
+      if i % pause_every == pause_every - 1:
+        time.sleep(pause)
+    for path, value in self.items():
+      # written since the walk went past, or really gone
+      if path not in seen and not os.path.exists(path):
+        self.remove(path)
+
+  #......................................................................
+  def lookup(self, path):
+    """Return ``(size, mtime)`` for the entry stored at ``path``, or None."""
+    return self.get(path)
+
+  def add(self, path, size=None, mtime=None):
+    """Record that ``path`` now holds an entry (stat-ing it if needed).
+    Returns the ``(size, mtime)`` recorded."""
+    if size is None or mtime is None:
+      try:
+        st = os.stat(path)
+      except OSError:
+        return None
+      size, mtime = st.st_size, st.st_mtime
+    self.put(path, (size, mtime))
+    return size, mtime
+
+  def remove(self, path):
+    """Forget the entry at ``path``. Does not touch the file itself."""
+    self.discard(path)
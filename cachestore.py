@@ -0,0 +1,261 @@
+"""
+On-disk layout of the cache directory.
+
+Layout version 2::
+
+    <cache_dir>/VERSION              the layout version, "2"
+    <cache_dir>/v2/9e/10/9e107d9d... one file per cache key
+
+An entry is named by the MD5 of its key in hex (fixed width, and fast; this
+is not a security boundary), fanned out over two levels of 256 directories
+by its first four hex digits. Ten million keys still leave only ~150 files
+per directory.
+
+Each entry starts with the key it was stored under, on a line of its own,
+followed by the response: its header block (see entrymeta.py), then the
+body. Readers compare that line with the key they are
+looking for, so a hash collision reads as a miss rather than as the wrong
+page, and tools can list the keys without a side table.
+
+Caches written before the layout was versioned (``<cache_dir>/<host>/<mangled
+key>``) are converted with ``migrate_cache.py``.
+
+The proxy talks to a store only through :meth:`FileStore.open_entry`,
+:meth:`FileStore.writer` and :meth:`FileStore.remove`, so another layout
+(:class:`packstore.PackStore`) can take its place.
+"""
+
+import os, time, errno, hashlib, threading, traceback
+from multiprocessing import Process
+import zerocopy, entrymeta
+from cacheindex import CacheIndex, TEMP_MARK, SNAPSHOT_NAME
+
+LAYOUT_VERSION = 2
+VERSION_FILE = 'VERSION'
+
+def key_hash(key):
+  return hashlib.md5(key).hexdigest()
+
+def key_line(key):
+  return key + '\n'
+
+def legacy_filename(key):
+  """The file name the unversioned layout used for ``key`` (before any
+  hashing of over-long names)."""
+  return key.replace("/","#").replace("&","~").replace(";",":").replace("|","-").replace("<","[").replace(">","]").replace("?",",").replace("(","{").replace(")","}").replace("$","%")
+
+# bytes of an entry read up front on a hit; enough for most response heads
+PREFIX_SIZE = 8192
+
+class Entry(object):
+
+  """A stored response open for reading: ``length`` bytes of ``fd``
+  starting at ``offset``. ``prefix`` holds the first bytes of it (at most
+  :data:`PREFIX_SIZE`), already read. Call :meth:`close` when done."""
+
+  def __init__(self, fd, offset, length, prefix, on_close=os.close):
+    self.fd = fd
+    self.offset = offset
+    self.length = length
+    self.prefix = prefix
+    self._on_close = on_close
+    self._meta = None
+
+  def read(self, count, at):
+    """Read up to ``count`` bytes from position ``at`` of the response."""
+    count = max(0, min(count, self.length - at))
+    return zerocopy.pread(self.fd, count, self.offset + at)
+
+  def meta(self):
+    """The :class:`entrymeta.EntryMeta` of the response, read past the
+    prefix only for a head that does not fit in it."""
+    if self._meta is None:
+      data = self.prefix
+      while True:
+        size = entrymeta.block_size(data, len(data) >= self.length)
+        if size is not None:
+          break
+        more = self.read(max(len(data), PREFIX_SIZE), len(data))
+        if not more:
+          size = len(data)
+          break
+        data += more
+      self._meta = entrymeta.parse(data[:size])
+    return self._meta
+
+  def close(self):
+    on_close, self._on_close = self._on_close, None
+    if on_close is not None:
+      on_close(self.fd)
+
+class FileWriter(object):
+
+  """Writes one entry to a temporary file; :meth:`commit` moves it into
+  place (and returns its new :meth:`FileStore.version`), :meth:`abort`
+  throws it away. Exactly one of them must be called."""
+
+  def __init__(self, store, key):
+    self.store = store
+    self.path = store.path_for(key)
+    self.tmppath = '%s%s%d.%d' % (self.path, TEMP_MARK, os.getpid(),
+                                  threading.current_thread().ident)
+    self._file = store.create(self.tmppath)
+    self._file.write(key_line(key))
+
+  def write(self, data):
+    self._file.write(data)
+
+  def commit(self):
+    self._file.close()
+    os.rename(self.tmppath, self.path)
+    return self.store.index.add(self.path)
+
+  def abort(self):
+    self._file.close()
+    try:
+      os.remove(self.tmppath)
+    except OSError:
+      pass
+
+class FileStore(object):
+
+  def __init__(self, cache_dir):
+    self.cache_dir = cache_dir
+    self.root = os.path.join(cache_dir, 'v%d' % LAYOUT_VERSION)
+    self.index = CacheIndex(self.root)
+    self.snapshot_path = os.path.join(self.root, SNAPSHOT_NAME)
+    self._made = set()
+
+  def legacy_names(self):
+    """Names at the top of ``cache_dir`` that predate the versioned layout
+    (the per-host directories of the old one)."""
+    return [name for name in os.listdir(self.cache_dir)
+            if name not in (VERSION_FILE, os.path.basename(self.root))
+            and not name.startswith('.')]
+
+  def init(self):
+    """Create the versioned root. Returns :meth:`legacy_names`."""
+    if not os.path.isdir(self.root):
+      os.makedirs(self.root)
+    version_path = os.path.join(self.cache_dir, VERSION_FILE)
+    if not os.path.exists(version_path):
+      f = open(version_path, 'w')
+      f.write('%d\n' % LAYOUT_VERSION)
+      f.close()
+    return self.legacy_names()
+
+  def path_for(self, key):
+    h = key_hash(key)
+    return os.path.join(self.root, h[0:2], h[2:4], h)
+
+  def make_dirs(self, path):
+    """Make sure the fan-out directory for ``path`` exists."""
+    dirname = os.path.dirname(path)
+    if dirname in self._made:
+      return
+    try:
+      os.makedirs(dirname)
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
+    self._made.add(dirname)
+
+  def create(self, path):
+    """Open ``path`` for writing a new entry, creating its directory."""
+    self.make_dirs(path)
+    return open(path, 'w')
+
+  def load(self):
+    """Build the index of stored entries, from the last snapshot if there
+    is one; returns how many there are. Must run before the worker processes
+    are forked."""
+    return self.index.load(self.snapshot_path)
+
+  def start_checkpointer(self, interval=300.0):
+    """Fork a process that reconciles an index loaded from a snapshot
+    with the directory, then snapshots the index every ``interval``
+    seconds. Call after :meth:`load`."""
+    p = Process(target=self._checkpoint_loop, args=(interval,))
+    p.daemon = True
+    p.start()
+    return p
+
+  def _checkpoint_loop(self, interval):
+    try:
+      if self.index.from_snapshot:
+        try:
+          self.index.reconcile()
+        except Exception:
+          traceback.print_exc()
+      while True:
+        try:
+          self.index.checkpoint(self.snapshot_path)
+        except Exception:
+          traceback.print_exc()
+        time.sleep(interval)
+    except KeyboardInterrupt:
+      pass
+
+  def __len__(self):
+    return len(self.index)
+
+  #......................................................................
+  def version(self, key):
+    """The index value of the entry for ``key``, or None. It changes
+    whenever the entry is replaced or removed, in any process."""
+    return self.index.get(self.path_for(key))
+
+  def open_entry(self, key):
+    """Return an :class:`Entry` for ``key``, or None if nothing is stored
+    under it."""
+    path = self.path_for(key)
+    if path not in self.index:
+      return None
+    try:
+      fd = os.open(path, os.O_RDONLY)
+    except OSError:
+      # deleted since the lookup (e.g. a redirect cycle)
+      self.index.remove(path)
+      return None
+    try:
+      expected = key_line(key)
+      size = os.fstat(fd).st_size
+      data = zerocopy.pread(fd, len(expected) + PREFIX_SIZE, 0)
+    except:
+      os.close(fd)
+      raise
+    if not data.startswith(expected):
+      # a hash collision: stored for a different key
+      os.close(fd)
+      return None
+    start = len(expected)
+    return Entry(fd, start, size - start, data[start:])
+
+  def writer(self, key):
+    return FileWriter(self, key)
+
+  def remove(self, key):
+    self.discard(self.path_for(key))
+
+  #......................................................................
+  # Entries by index name (here, the path), for maintenance that does not
+  # know the keys, such as eviction.
+
+  def name(self, key):
+    return self.path_for(key)
+
+  def size(self, version):
+    return version[0]
+
+  def entries(self):
+    """``(name, size, age)`` of every entry, ``age`` ordering them from
+    oldest to newest write."""
+    return [(path, size, mtime)
+            for path, (size, mtime) in self.index.items()]
+
+  def discard(self, name):
+    self.index.remove(name)
+    try:
+      os.remove(name)
+    except OSError:
+      pass
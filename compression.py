@@ -0,0 +1,63 @@
+"""
+Optional gzip compression of stored response bodies.
+
+A compressed entry is flagged in its header block (:data:`entrymeta.GZIP`)
+and its body is a gzip stream of what the origin sent. The block also gives
+the uncompressed length, when it was known as the block was written.
+
+A client that accepts gzip gets the stored bytes as they are, with
+``Content-Encoding: gzip``. Any other client gets them decompressed on the
+way out.
+"""
+
+import zlib
+
+# worth compressing; everything else is usually compressed already
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript',
+                      'application/x-javascript', 'application/json',
+                      'application/xml', 'application/xhtml+xml',
+                      'application/rss+xml', 'image/svg+xml')
+# below this the gzip framing eats the savings
+MIN_SIZE = 256
+LEVEL = 6
+
+def compressible(content_type, content_encoding, length):
+  """Whether a body of this type, coding and length (None if not known yet)
+  should be stored compressed."""
+  if content_encoding and \
+      [c for c in content_encoding if c.lower() != 'identity']:
+    return False
+  if length is not None and length < MIN_SIZE:
+    return False
+  content_type = (content_type or '').lower()
+  return any(content_type.startswith(t) for t in COMPRESSIBLE_TYPES)
+
+def compressor():
+  return zlib.compressobj(LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+def decompressor():
+  return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+def compress(data):
+  c = compressor()
+  return c.compress(data) + c.flush()
+
+def accepts_gzip(accept_encoding):
+  """Whether a request with these :mailheader:`Accept-Encoding` items
+  (None if it had none) accepts a gzip-coded response."""
+  qualities = {}
+  for item in accept_encoding or ():
+    parts = item.split(';')
+    q = 1.0
+    for param in parts[1:]:
+      name, _, value = param.partition('=')
+      if name.strip().lower() == 'q':
+        try:
+          q = float(value)
+        except ValueError:
+          q = 0.0
+    qualities[parts[0].strip().lower()] = q
+  for coding in ('gzip', 'x-gzip'):
+    if coding in qualities:
+      return qualities[coding] > 0
+  return qualities.get('*', 0) > 0
@@ -0,0 +1,227 @@
+"""
+Header block stored ahead of every cached response body.
+
+A stored entry is the header block followed by the body, as the origin sent
+it or gzip'd (see compression.py). The block is a fixed-size record, then
+the content type, then the response head::
+
+    record        magic 'CMH2', status, flags, identity length, time
+                  stored, Last-Modified, content type length, head length,
+                  insertion offset
+    content type
+    head          status line and header lines, CRLF separated, without
+                  the blank line that ends them
+    body          to the end of the entry
+
+So the status, type, length and validators of an entry are known from the
+first bytes read on a hit (:data:`cachestore.PREFIX_SIZE`), and HEAD,
+revalidation and statistics never read or parse the body.
+
+A response stored without any validator gets an ``ETag`` made up when it
+is stored (:func:`add_validator`), so that clients can revalidate it too.
+
+An HTML page is stored as the origin sent it, with the offset in its
+(uncompressed) body where the -i snippet goes, if it has a place for one
+(see injection.py). The snippet is spliced in as the page is served, so
+the same entries can be served with any snippet or none.
+The gzip'd form of a compressed entry goes out under its own tag
+(:func:`gzip_etag`); both are taken as the entry's when revalidating.
+
+Entries stored before the block existed, which start with the raw
+response head, are still read: the block is parsed out of the head.
+"""
+
+import os, struct, time, email.utils
+
+MAGIC = 'CMH2'
+# magic, status, flags, identity length (-1: not known), stored at (0: not
+# known), Last-Modified (0: none), content type length, head length,
+# insertion offset (-1: none)
+RECORD = struct.Struct('<4sHHqddHIq')
+
+# flags
+GZIP = 1
+# the page has no <head>: the snippet goes in with one of its own
+WRAP_HEAD = 2
+
+# appended to the ETag of the gzip'd form of a compressed entry
+GZIP_ETAG_SUFFIX = '-gzip'
+
+class EntryMeta(object):
+
+  """What is known about a stored response without reading its body.
+  ``size`` is the length of the block in the entry: the body starts
+  there. ``insert_at`` is where the -i snippet goes in the uncompressed
+  body, or None if it does not go in."""
+
+  def __init__(self, status, head, content_type='', flags=0,
+               identity_length=None, stored_at=None, last_modified=None,
+               size=None, insert_at=None):
+    self.status = status
+    self.head = head
+    self.content_type = content_type
+    self.flags = flags
+    self.identity_length = identity_length
+    self.stored_at = stored_at
+    self.last_modified = last_modified
+    self.insert_at = insert_at
+    if size is None:
+      size = RECORD.size + len(content_type) + len(head)
+    self.size = size
+
+  @classmethod
+  def from_head(cls, head, flags=0, identity_length=None, insert_at=None):
+    """The block for a response about to be stored, given its head (without
+    the final blank line). ``identity_length`` is the length of the body
+    before it is compressed, if it is and the length is known."""
+    parts = head.split('\r\n', 1)[0].split()
+    status = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 200
+    return cls(status, head, header(head, 'Content-Type') or '', flags,
+               identity_length, time.time(),
+               http_date(header(head, 'Last-Modified')),
+               insert_at=insert_at)
+
+  @property
+  def gzipped(self):
+    return bool(self.flags & GZIP)
+
+  @property
+  def wrap_head(self):
+    return bool(self.flags & WRAP_HEAD)
+
+  @property
+  def status_line(self):
+    return self.head.split('\r\n', 1)[0]
+
+  def headers(self):
+    """The header fields as a list of ``(name, value)``."""
+    fields = []
+    for line in self.head.split('\r\n')[1:]:
+      name, sep, value = line.partition(':')
+      if sep:
+        fields.append((name.strip(), value.strip()))
+    return fields
+
+  def header(self, name):
+    return header(self.head, name)
+
+  def not_modified(self, if_none_match, if_modified_since):
+    """Whether a GET or HEAD with these validators is answered with 304
+    Not Modified. ``if_none_match`` is the list of entity tags of the
+    request and ``if_modified_since`` the header value, each None if the
+    request had none."""
+    if self.status != 200:
+      return False
+    if if_none_match is not None:
+      # If-Modified-Since does not count then (RFC 7232, 3.3)
+      etag = self.header('ETag')
+      return '*' in if_none_match or (etag is not None and any(
+          same_etag(tag, etag) for tag in if_none_match))
+    since = http_date(if_modified_since)
+    modified = self.last_modified or self.stored_at
+    # a date in the future is no date at all
+    return since is not None and modified is not None and \
+        int(modified) <= since <= time.time()
+
+  def if_range(self, value):
+    """Whether an ``If-Range`` of ``value`` names this entry, so that the
+    ``Range`` of the request applies. Only a strong comparison counts."""
+    value = value.strip()
+    if value.startswith('W/'):
+      return False
+    if value.startswith('"'):
+      return value == self.header('ETag')
+    date = http_date(value)
+    return date is not None and date == self.last_modified
+
+  def pack(self):
+    length = self.identity_length
+    return RECORD.pack(MAGIC, self.status, self.flags,
+                       -1 if length is None else length,
+                       self.stored_at or 0, self.last_modified or 0,
+                       len(self.content_type), len(self.head),
+                       -1 if self.insert_at is None else self.insert_at) + \
+        self.content_type + self.head
+
+def block_size(data, complete):
+  """The length of the block at the start of ``data``, or None if more
+  of the entry must be read to tell. ``complete`` says whether ``data``
+  holds all of it."""
+  if data.startswith(MAGIC):
+    if len(data) < RECORD.size:
+      return None
+    fields = RECORD.unpack_from(data)
+    return RECORD.size + fields[6] + fields[7]
+  end = data.find('\r\n\r\n')
+  if end != -1:
+    return end + 4
+  if len(data) >= len(MAGIC) and complete:
+    return len(data)
+  return None
+
+def parse(data):
+  """The :class:`EntryMeta` at the start of ``data``, which holds at least
+  :func:`block_size` bytes of the entry."""
+  if not data.startswith(MAGIC):
+    return _parse_legacy(data)
+  at = RECORD.size
+  (magic, status, flags, length, stored_at, last_modified,
+   type_length, head_length, insert_at) = RECORD.unpack_from(data)
+  content_type = data[at:at + type_length]
+  head = data[at + type_length:at + type_length + head_length]
+  return EntryMeta(status, head, content_type, flags,
+                   None if length < 0 else length, stored_at or None,
+                   last_modified or None, at + type_length + head_length,
+                   None if insert_at < 0 else insert_at)
+
+def _parse_legacy(data):
+  end = data.find('\r\n\r\n')
+  size = end + 4 if end != -1 else len(data)
+  meta = EntryMeta.from_head(data[:end if end != -1 else len(data)])
+  meta.stored_at = None
+  meta.size = size
+  return meta
+
+def header(head, name):
+  """The value of the first ``name`` field of a response head, or None."""
+  start = head.lower().find('\r\n%s:' % name.lower())
+  if start == -1:
+    return None
+  start += len(name) + 3
+  end = head.find('\r\n', start)
+  return head[start:end if end != -1 else len(head)].strip()
+
+def add_validator(head):
+  """``head`` with a made-up ``ETag`` if it is that of a 200 response
+  without ``ETag`` or ``Last-Modified``."""
+  parts = head.split('\r\n', 1)[0].split()
+  if len(parts) < 2 or parts[1] != '200' or header(head, 'ETag') is not None \
+      or header(head, 'Last-Modified') is not None:
+    return head
+  return '%s\r\nETag: "%x-%s"' % (head, int(time.time() * 1e6),
+                                   os.urandom(4).encode('hex'))
+
+def gzip_etag(etag):
+  if etag.endswith('"'):
+    return etag[:-1] + GZIP_ETAG_SUFFIX + '"'
+  return etag
+
+def same_etag(a, b):
+  """Weak comparison of two entity tags, with the gzip'd form of a tag
+  the same as the tag. Either may have lost its quotes to list parsing."""
+  def opaque(tag):
+    tag = tag.strip()
+    if tag.startswith('W/'):
+      tag = tag[2:]
+    tag = tag.strip('"')
+    if tag.endswith(GZIP_ETAG_SUFFIX):
+      tag = tag[:-len(GZIP_ETAG_SUFFIX)]
+    return tag
+  return opaque(a) == opaque(b)
+
+def http_date(value):
+  """An HTTP-date as seconds since the epoch, or None."""
+  parsed = email.utils.parsedate_tz(value) if value else None
+  if parsed is None:
+    return None
+  return float(email.utils.mktime_tz(parsed))
@@ -0,0 +1,499 @@
+"""
+Event loop server, the alternative to :class:`PooledProcessMixIn` that
+``proxyserv.py --server event`` selects.
+
+Every worker process runs one epoll loop that owns all of its client
+connections: it accepts them, reads and parses requests (with
+:mod:`httpmessage`, from what has arrived so far) and writes responses, and
+never blocks on a client. A client that is idle between requests, slow to
+send its request or slow to read its response costs its buffers, not a
+thread, so a process keeps thousands of connections open.
+
+Each complete request goes to a small pool of executor threads in the
+process, which run the handler: cache lookups and file I/O. A request that
+has to wait for something slower (the proxy: an upstream fetch, or another
+worker's fetch of the same URL) is handed on to a second, larger pool, so
+such waits never hold up the requests the first pool can answer at once.
+Threads of either pool still block while they wait; the second pool bounds
+how many slow requests a process works on at a time.
+
+The handler's client socket is a :class:`QueuedConnection`. What the
+handler sends goes straight out if the socket takes it and is queued for
+the loop otherwise. File ranges (:func:`zerocopy.sendfile`) are queued as a
+descriptor and offsets, and go out by ``sendfile`` as the client reads
+them. A handler waits while more than HIGH_WATER bytes it sent are still
+queued, which bounds the memory one slow client can hold; so a response
+longer than that, sent other than as a file range, ties up its thread until
+the client has read all but the last HIGH_WATER bytes of it.
+
+The handler class is built as ``handler_class(connection, address)`` and
+must have ``handle_request(request)``, which answers one request and
+returns whether the connection stays open, or returns DEFER to have
+``resume()`` finish the request on the second pool; ``resume`` then returns
+whether the connection stays open.
+"""
+
+import os, errno, fcntl, socket, select, threading, time, traceback, Queue
+from collections import deque
+from cStringIO import StringIO
+from multiprocessing import Process
+from httpmessage import HttpMessage
+import httpmessage.exc as exc
+import zerocopy
+
+RECV_SIZE = 65536
+# queued response bytes above which a handler waits for its client
+HIGH_WATER = 1 << 20
+# longest request head, and most request bytes held for one connection
+MAX_HEAD = 64 << 10
+MAX_REQUEST = 16 << 20
+# how often idle connections are looked for, in seconds
+SWEEP_INTERVAL = 1.0
+
+_again = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+# returned by handle_request to finish a request on the slow pool
+DEFER = object()
+
+def parse_request(data):
+  """The first request in ``data``, with its entity read, and the length of
+  ``data`` it took up; None if ``data`` does not hold all of it yet.
+  Raises :exc:`httpmessage.exc.MalformedFirstline` for what cannot be a
+  request."""
+  start = len(data) - len(data.lstrip('\r\n'))
+  end = data.find('\r\n\r\n', start)
+  if end == -1:
+    if len(data) - start > MAX_HEAD:
+      raise exc.MalformedFirstline('request head too long')
+    return None
+  f = StringIO(data)
+  f.seek(start)
+  request = HttpMessage(fileobj=f)
+  size = request.entity_size()
+  if type(size) in (int, long):
+    if len(data) < end + 4 + size:
+      return None
+  elif not request.transfer_encoding:
+    # neither a length nor chunked: the entity would end with the
+    # connection, which leaves no way to answer
+    raise exc.MalformedFirstline('request entity without a length')
+  elif data.find('\r\n\r\n', end + 4) == -1:
+    # chunked, and the last chunk is not in yet
+    return None
+  try:
+    request.buffer_all()
+  except (ValueError, exc.EntityReadError):
+    # the chunked entity is not all there yet
+    return None
+  return request, f.tell()
+
+class FileRange(object):
+
+  def __init__(self, fd, offset, count):
+    self.fd = fd
+    self.offset = offset
+    self.count = count
+
+class QueuedConnection(object):
+
+  """A client connection of the event loop; to the handler, its socket.
+  Handler threads call :meth:`sendall` and :meth:`queue_file`, the loop
+  everything else."""
+
+  def __init__(self, loop, sock, address):
+    self.loop = loop
+    self.sock = sock
+    self.address = address
+    self.fd = sock.fileno()
+    self.inbuf = ''
+    self.handler = None
+    # a request is being handled
+    self.busy = False
+    # close once the queued output is out
+    self.closing = False
+    self.last_active = time.time()
+    self.lock = threading.Lock()
+    self.drained = threading.Condition(self.lock)
+    # lock held for these
+    self.out = deque()
+    self.pending = 0
+    self.closed = False
+    self.events = None
+
+  def fileno(self):
+    return self.fd
+
+  #......................................................................
+  # handler side
+
+  def sendall(self, data):
+    with self.lock:
+      self._check_open()
+      if not self.out:
+        data = self._send(data)
+      if len(data):
+        self.out.append(data)
+        self.pending += len(data)
+        self.loop.want_write(self)
+        while self.pending > HIGH_WATER and not self.closed:
+          self.drained.wait()
+        self._check_open()
+
+  def queue_file(self, fd, offset, count):
+    """Send ``count`` bytes of ``fd`` from ``offset`` on; the range is
+    sent by the loop if the client does not take it at once, so the
+    caller may close ``fd`` on return."""
+    with self.lock:
+      self._check_open()
+      part = FileRange(fd, offset, count)
+      if not self.out:
+        self._sendfile(part)
+      if part.count:
+        part.fd = os.dup(fd)
+        self.out.append(part)
+        self.loop.want_write(self)
+
+  def _check_open(self):
+    if self.closed:
+      raise socket.error(errno.EPIPE, 'client went away')
+
+  #......................................................................
+  # lock held from here on
+
+  def _send(self, data):
+    """Send what the socket takes of ``data``; returns the rest."""
+    sent = 0
+    while sent < len(data):
+      try:
+        sent += self.sock.send(buffer(data, sent))
+      except socket.error as e:
+        if e.args[0] in _again:
+          break
+        if e.args[0] == errno.EINTR:
+          continue
+        self._close()
+        raise
+    return buffer(data, sent) if sent else data
+
+  def _sendfile(self, part):
+    try:
+      sent = zerocopy.sendfile_some(self.sock, part.fd, part.offset,
+                                    part.count)
+    except (socket.error, EOFError):
+      self._close()
+      raise
+    part.offset += sent
+    part.count -= sent
+
+  def flush(self):
+    """Send as much of the queue as the socket takes. Returns whether the
+    queue is empty."""
+    while self.out and not self.closed:
+      part = self.out[0]
+      if isinstance(part, FileRange):
+        self._sendfile(part)
+        if part.count:
+          return False
+        os.close(part.fd)
+      else:
+        rest = self._send(part)
+        self.pending -= len(part) - len(rest)
+        if len(rest):
+          self.out[0] = rest
+          return False
+      self.out.popleft()
+      if self.pending <= HIGH_WATER:
+        self.drained.notify_all()
+    return not self.out
+
+  def _close(self):
+    if self.closed:
+      return
+    self.closed = True
+    for part in self.out:
+      if isinstance(part, FileRange):
+        os.close(part.fd)
+    self.out.clear()
+    self.pending = 0
+    self.drained.notify_all()
+
+class EventLoop(object):
+
+  """The loop of one worker process."""
+
+  def __init__(self, server):
+    self.server = server
+    self.listener = server.socket
+    self.epoll = select.epoll()
+    self.connections = {}
+    self.jobs = Queue.Queue()
+    self.slow_jobs = Queue.Queue()
+    # work handed back by the executor threads, and a pipe to wake for it
+    self.ready = deque()
+    self.wake_read, self.wake_write = os.pipe()
+    for fd in (self.wake_read, self.wake_write):
+      fcntl.fcntl(fd, fcntl.F_SETFL,
+                  fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    self.woken = False
+    self.wake_lock = threading.Lock()
+    self.accepting = False
+
+  def run(self):
+    for i in range(self.server.threads):
+      t = threading.Thread(target=self._executor_loop)
+      t.setDaemon(True)
+      t.start()
+    for i in range(self.server.slow_threads):
+      t = threading.Thread(target=self._slow_loop)
+      t.setDaemon(True)
+      t.start()
+    self.epoll.register(self.wake_read, select.EPOLLIN)
+    self._accepting(True)
+    last_sweep = time.time()
+    while True:
+      try:
+        events = self.epoll.poll(SWEEP_INTERVAL)
+      except IOError as e:
+        if e.errno == errno.EINTR:
+          continue
+        raise
+      for fd, event in events:
+        if fd == self.listener.fileno():
+          self._accept()
+        elif fd == self.wake_read:
+          self._wake_up()
+        else:
+          conn = self.connections.get(fd)
+          if conn is None:
+            continue
+          if event & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR):
+            self._read(conn)
+          if event & select.EPOLLOUT and \
+              self.connections.get(fd) is conn:
+            self._write(conn)
+      if time.time() - last_sweep >= SWEEP_INTERVAL:
+        self._sweep()
+        last_sweep = time.time()
+
+  #......................................................................
+  # executor side
+
+  def _executor_loop(self):
+    while True:
+      conn, request = self.jobs.get()
+      keep_alive = False
+      try:
+        keep_alive = conn.handler.handle_request(request)
+      except Exception:
+        traceback.print_exc()
+      if keep_alive is DEFER:
+        self.slow_jobs.put(conn)
+      else:
+        self._post(('done', conn, keep_alive))
+
+  def _slow_loop(self):
+    while True:
+      conn = self.slow_jobs.get()
+      keep_alive = False
+      try:
+        keep_alive = conn.handler.resume()
+      except Exception:
+        traceback.print_exc()
+      self._post(('done', conn, keep_alive))
+
+  def want_write(self, conn):
+    """Called by a handler thread with ``conn.lock`` held: the loop has
+    output of ``conn`` to send."""
+    self._post(('write', conn, None))
+
+  def _post(self, item):
+    self.ready.append(item)
+    with self.wake_lock:
+      if self.woken:
+        return
+      self.woken = True
+    try:
+      os.write(self.wake_write, 'x')
+    except OSError as e:
+      if e.errno not in _again:
+        raise
+
+  #......................................................................
+  # loop side
+
+  def _wake_up(self):
+    # drain before clearing the flag: a post that finds it still set has
+    # appended its item already, and one that finds it clear writes again
+    try:
+      while os.read(self.wake_read, 4096):
+        pass
+    except OSError as e:
+      if e.errno not in _again:
+        raise
+    with self.wake_lock:
+      self.woken = False
+    while self.ready:
+      kind, conn, keep_alive = self.ready.popleft()
+      if self.connections.get(conn.fd) is not conn:
+        # closed meanwhile (and the descriptor maybe taken again)
+        continue
+      if kind == 'write':
+        self._write(conn)
+      else:
+        conn.busy = False
+        conn.last_active = time.time()
+        if not keep_alive:
+          conn.closing = True
+        self._write(conn)
+        if self.connections.get(conn.fd) is conn:
+          self._dispatch(conn)
+
+  def _accepting(self, on):
+    if on != self.accepting:
+      if on:
+        self.epoll.register(self.listener.fileno(), select.EPOLLIN)
+      else:
+        self.epoll.unregister(self.listener.fileno())
+      self.accepting = on
+
+  def _accept(self):
+    while len(self.connections) < self.server.max_connections:
+      try:
+        sock, address = self.listener.accept()
+      except socket.error as e:
+        # another process took it, or nothing left
+        if e.args[0] in _again + (errno.ECONNABORTED, errno.EINTR):
+          return
+        raise
+      sock.setblocking(0)
+      sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      conn = QueuedConnection(self, sock, address)
+      conn.handler = self.server.handler_class(conn, address)
+      self.connections[conn.fd] = conn
+      self._update(conn)
+    self._accepting(False)
+
+  def _read(self, conn):
+    while len(conn.inbuf) < MAX_REQUEST:
+      try:
+        data = conn.sock.recv(RECV_SIZE)
+      except socket.error as e:
+        if e.args[0] in _again:
+          break
+        if e.args[0] == errno.EINTR:
+          continue
+        data = ''
+      if not data:
+        # the client is gone; a handler at work gets an error on its
+        # next write
+        self._close(conn)
+        return
+      conn.inbuf += data
+      conn.last_active = time.time()
+    self._dispatch(conn)
+
+  def _dispatch(self, conn):
+    if conn.busy or conn.closing:
+      self._update(conn)
+      return
+    try:
+      parsed = parse_request(conn.inbuf)
+    except Exception:
+      self._close(conn)
+      return
+    if parsed is None:
+      if len(conn.inbuf) >= MAX_REQUEST:
+        self._close(conn)
+      else:
+        self._update(conn)
+      return
+    request, used = parsed
+    conn.inbuf = conn.inbuf[used:]
+    conn.busy = True
+    self._update(conn)
+    self.jobs.put((conn, request))
+
+  def _write(self, conn):
+    try:
+      with conn.lock:
+        empty = conn.flush()
+    except (socket.error, EOFError):
+      self._close(conn)
+      return
+    if empty and conn.closing and not conn.busy:
+      self._close(conn)
+    else:
+      self._update(conn)
+
+  def _update(self, conn):
+    """Register for what ``conn`` waits on now."""
+    with conn.lock:
+      if conn.closed:
+        return
+      events = 0
+      if len(conn.inbuf) < MAX_REQUEST and not conn.closing:
+        events |= select.EPOLLIN
+      if conn.out:
+        events |= select.EPOLLOUT
+      if events == conn.events:
+        return
+      if conn.events is None:
+        self.epoll.register(conn.fd, events)
+      else:
+        self.epoll.modify(conn.fd, events)
+      conn.events = events
+
+  def _close(self, conn):
+    if self.connections.pop(conn.fd, None) is None:
+      return
+    with conn.lock:
+      conn._close()
+      if conn.events is not None:
+        self.epoll.unregister(conn.fd)
+    conn.sock.close()
+    self._accepting(True)
+
+  def _sweep(self):
+    timeout = self.server.keepalive_timeout
+    now = time.time()
+    for conn in self.connections.values():
+      if not conn.busy and not conn.out and \
+          now - conn.last_active > timeout:
+        self._close(conn)
+
+class EventLoopServer(object):
+
+  """Listens on ``server_address`` and serves it with an event loop in
+  each of ``processes`` worker processes, forked by :meth:`serve_forever`,
+  with ``threads`` executor threads and ``slow_threads`` threads for
+  deferred requests each."""
+
+  def __init__(self, server_address, handler_class, processes=8, threads=16,
+               slow_threads=64,
+               keepalive_timeout=15.0, max_connections=10000):
+    self.handler_class = handler_class
+    self.processes = processes
+    self.threads = threads
+    self.slow_threads = slow_threads
+    self.keepalive_timeout = keepalive_timeout
+    self.max_connections = max_connections
+    self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.socket.bind(server_address)
+    self.socket.listen(1024)
+    self.socket.setblocking(0)
+    self.server_address = self.socket.getsockname()
+
+  def serve_forever(self):
+    workers = [Process(target=self._process_loop)
+               for i in range(self.processes)]
+    for p in workers:
+      p.start()
+    for p in workers:
+      p.join()
+
+  def _process_loop(self):
+    try:
+      EventLoop(self).run()
+    except KeyboardInterrupt:
+      pass
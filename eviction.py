@@ -0,0 +1,346 @@
+"""
+Keeps the cache store within a byte and entry budget.
+
+Workers never evict. They note what they do: a hit, a newly stored entry, or
+a removal. The notes are batched per process and appended to an access log
+in the cache directory, one write per batch. The evictor runs in a process
+of its own. It replays the log into an eviction policy and removes a bounded
+number of entries per tick for as long as the store is over budget. Removals
+go through the store, so every worker sees them through the shared index.
+
+Policies track entries by their index name (see
+:meth:`cachestore.FileStore.name`) and implement ``insert``, ``touch``,
+``remove`` and ``victim``. Three are provided, by name in :data:`POLICIES`:
+least recently used, least frequently used, and ARC (adaptive replacement
+cache, Megiddo and Modha, 2003), which balances recency against frequency by
+remembering what it recently evicted.
+
+The access log is advisory. Records that are lost or arrive late only make
+the policy less accurate, and the evictor checks its view against the store
+index every ``resync_interval`` seconds.
+"""
+
+import os, time, threading, traceback
+from collections import OrderedDict
+from multiprocessing import Process
+
+ACCESS_LOG = '.access.log'
+
+class Policy(object):
+
+  def __init__(self):
+    self.bytes = 0
+
+  def __len__(self):
+    return len(self._sizes)
+
+  def __contains__(self, name):
+    return name in self._sizes
+
+  def names(self):
+    return self._sizes.keys()
+
+class LRUPolicy(Policy):
+
+  def __init__(self):
+    Policy.__init__(self)
+    # least recently used first
+    self._sizes = OrderedDict()
+
+  def insert(self, name, size):
+    self.remove(name)
+    self._sizes[name] = size
+    self.bytes += size
+
+  def touch(self, name):
+    size = self._sizes.pop(name, None)
+    if size is not None:
+      self._sizes[name] = size
+
+  def remove(self, name):
+    size = self._sizes.pop(name, None)
+    if size is not None:
+      self.bytes -= size
+
+  def victim(self):
+    if not self._sizes:
+      return None
+    name, size = self._sizes.popitem(last=False)
+    self.bytes -= size
+    return name
+
+class LFUPolicy(Policy):
+
+  """Evicts the least frequently used entry, the least recently used one
+  among equals. Every operation is O(1)."""
+
+  def __init__(self):
+    Policy.__init__(self)
+    self._sizes = {}
+    self._counts = {}
+    # use count -> names with that count, least recently used first
+    self._buckets = {}
+    self._min_count = 1
+
+  def insert(self, name, size):
+    self.remove(name)
+    self._sizes[name] = size
+    self.bytes += size
+    self._counts[name] = 1
+    self._buckets.setdefault(1, OrderedDict())[name] = True
+    self._min_count = 1
+
+  def touch(self, name):
+    count = self._counts.get(name)
+    if count is None:
+      return
+    self._unbucket(name, count)
+    self._counts[name] = count + 1
+    self._buckets.setdefault(count + 1, OrderedDict())[name] = True
+
+  def _unbucket(self, name, count):
+    bucket = self._buckets[count]
+    del bucket[name]
+    if not bucket:
+      del self._buckets[count]
+
+  def remove(self, name):
+    size = self._sizes.pop(name, None)
+    if size is None:
+      return
+    self.bytes -= size
+    self._unbucket(name, self._counts.pop(name))
+
+  def victim(self):
+    if not self._sizes:
+      return None
+    while self._min_count not in self._buckets:
+      self._min_count += 1
+    name = next(iter(self._buckets[self._min_count]))
+    self.remove(name)
+    return name
+
+class ARCPolicy(Policy):
+
+  """Adaptive replacement: entries seen once (``t1``) and more than once
+  (``t2``) are kept in separate LRU lists, and the ghost lists ``b1`` and
+  ``b2`` remember the names recently evicted from each. A new entry whose
+  name is in a ghost list shows that list was cut too short, and moves the
+  target size ``p`` of ``t1`` in its favour. Sizes are counted in
+  entries, as in the paper; the byte budget only decides when to evict."""
+
+  def __init__(self):
+    Policy.__init__(self)
+    self._sizes = {}
+    self.t1, self.t2 = OrderedDict(), OrderedDict()
+    self.b1, self.b2 = OrderedDict(), OrderedDict()
+    self.p = 0
+
+  def insert(self, name, size):
+    c = len(self._sizes) + 1
+    if name in self.b1:
+      self.p = min(c, self.p + max(1, len(self.b2) // len(self.b1)))
+      del self.b1[name]
+      target = self.t2
+    elif name in self.b2:
+      self.p = max(0, self.p - max(1, len(self.b1) // len(self.b2)))
+      del self.b2[name]
+      target = self.t2
+    elif name in self._sizes:
+      target = self.t2
+    else:
+      target = self.t1
+    self.remove(name)
+    target[name] = True
+    self._sizes[name] = size
+    self.bytes += size
+
+  def touch(self, name):
+    if name in self.t1:
+      del self.t1[name]
+      self.t2[name] = True
+    elif name in self.t2:
+      del self.t2[name]
+      self.t2[name] = True
+
+  def remove(self, name):
+    size = self._sizes.pop(name, None)
+    if size is None:
+      return
+    self.bytes -= size
+    self.t1.pop(name, None)
+    self.t2.pop(name, None)
+
+  def victim(self):
+    if not self._sizes:
+      return None
+    if self.t1 and (len(self.t1) > self.p or not self.t2):
+      name, ghosts = self.t1.popitem(last=False)[0], self.b1
+    else:
+      name, ghosts = self.t2.popitem(last=False)[0], self.b2
+    self.bytes -= self._sizes.pop(name)
+    ghosts[name] = True
+    # remember no more evicted names than there are live ones
+    while len(self.b1) + len(self.b2) > max(1, len(self._sizes)):
+      longer = self.b1 if len(self.b1) >= len(self.b2) else self.b2
+      longer.popitem(last=False)
+    return name
+
+POLICIES = {'lru': LRUPolicy, 'lfu': LFUPolicy, 'arc': ARCPolicy}
+
+class AccessLog(object):
+
+  """Records batched per process and appended to ``path``; a batch goes out
+  once it holds ``flush_every`` records, and a thread in every writing
+  process sends whatever is pending every ``flush_after`` seconds."""
+
+  flush_every = 256
+  flush_after = 1.0
+  # the reader empties the file once it has read this much of it
+  rotate_size = 16 << 20
+
+  def __init__(self, path):
+    self.path = path
+    # start empty; must run before the workers are forked
+    os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644))
+    self._pid = None
+    self._lock = threading.Lock()
+    self._read_fd = None
+
+  def record(self, line):
+    with self._lock:
+      if self._pid != os.getpid():
+        # the batch, the descriptor and the thread belong to one process
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        self._pending = []
+        self._pid = os.getpid()
+        t = threading.Thread(target=self._flush_loop)
+        t.setDaemon(True)
+        t.start()
+      self._pending.append(line)
+      if len(self._pending) >= self.flush_every:
+        self._flush()
+
+  def _flush(self):
+    # lock held
+    if self._pending:
+      os.write(self._fd, ''.join(self._pending))
+      self._pending = []
+
+  def _flush_loop(self):
+    while True:
+      time.sleep(self.flush_after)
+      with self._lock:
+        self._flush()
+
+  def read_new(self):
+    """Return the complete records appended since the last call (reader
+    side; one reader only)."""
+    if self._read_fd is None:
+      self._read_fd = os.open(self.path, os.O_RDONLY)
+      self._offset = 0
+    os.lseek(self._read_fd, self._offset, os.SEEK_SET)
+    chunks = []
+    while True:
+      data = os.read(self._read_fd, 1 << 20)
+      if not data:
+        break
+      chunks.append(data)
+    data = ''.join(chunks)
+    complete = data.rfind('\n') + 1
+    self._offset += complete
+    if self._offset >= self.rotate_size and complete == len(data):
+      # writers append with O_APPEND, so they follow the file back to 0
+      fd = os.open(self.path, os.O_WRONLY)
+      os.ftruncate(fd, 0)
+      os.close(fd)
+      self._offset = 0
+    return data[:complete].splitlines()
+
+class Evictor(object):
+
+  def __init__(self, store, policy='lru', max_bytes=0, max_entries=0,
+               interval=1.0, batch=256, resync_interval=300.0):
+    self.store = store
+    self.policy_name = policy
+    self.max_bytes = max_bytes
+    self.max_entries = max_entries
+    self.interval = interval
+    self.batch = batch
+    self.resync_interval = resync_interval
+    self.log = AccessLog(os.path.join(store.cache_dir, ACCESS_LOG))
+
+  # Called by the workers; cheap and never blocking on the evictor.
+
+  def hit(self, key):
+    self.log.record('h\t%s\n' % self.store.name(key))
+
+  def stored(self, key, version):
+    if version is not None:
+      self.log.record('+\t%s\t%d\n' % (self.store.name(key),
+                                       self.store.size(version)))
+
+  def removed(self, key):
+    self.log.record('-\t%s\n' % self.store.name(key))
+
+  #......................................................................
+  def over_budget(self):
+    return (self.max_bytes and self.policy.bytes > self.max_bytes) or \
+        (self.max_entries and len(self.policy) > self.max_entries)
+
+  def resync(self):
+    """Bring the policy in line with the store index: add what it missed,
+    drop what is gone. New names go in as the least recently used."""
+    present = set()
+    for name, size, age in sorted(self.store.entries(), key=lambda e: e[2]):
+      present.add(name)
+      if name not in self.policy:
+        self.policy.insert(name, size)
+    for name in self.policy.names():
+      if name not in present:
+        self.policy.remove(name)
+
+  def step(self):
+    """Replay the new access records, then evict up to ``batch`` entries if
+    over budget. Returns the number evicted."""
+    for record in self.log.read_new():
+      fields = record.split('\t')
+      if fields[0] == 'h':
+        self.policy.touch(fields[1])
+      elif fields[0] == '+' and len(fields) == 3:
+        self.policy.insert(fields[1], int(fields[2]))
+      elif fields[0] == '-':
+        self.policy.remove(fields[1])
+    evicted = 0
+    while evicted < self.batch and self.over_budget():
+      name = self.policy.victim()
+      if name is None:
+        break
+      self.store.discard(name)
+      evicted += 1
+    return evicted
+
+  def start(self):
+    """Fork the evictor process. Call after the store is loaded."""
+    p = Process(target=self._run)
+    p.daemon = True
+    p.start()
+    return p
+
+  def _run(self):
+    try:
+      self.policy = POLICIES[self.policy_name]()
+      self.resync()
+      last_resync = time.time()
+      while True:
+        try:
+          if self.step() < self.batch:
+            time.sleep(self.interval)
+          if time.time() - last_resync >= self.resync_interval:
+            self.resync()
+            last_resync = time.time()
+        except Exception:
+          traceback.print_exc()
+          time.sleep(self.interval)
+    except KeyboardInterrupt:
+      pass
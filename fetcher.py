@@ -0,0 +1,173 @@
+"""
+Upstream fetch engine.
+
+Each worker process owns a small pool of long-lived fetcher threads fed from
+a job queue. A handler hands its request to the pool and waits for the
+parsed :class:`httpmessage.ResponseMessage`; everything that used to happen
+in a throwaway forked child (redirect bookkeeping, content-type counts,
+saving) now happens back in the handler, so its effects are kept.
+
+The deadline is enforced with socket timeouts on the upstream connection and
+a bounded wait on the job, rather than by killing a process. Upstream
+connections are kept alive and reused through an :class:`UpstreamPool`.
+
+:meth:`FetchEngine.open` returns as soon as the response headers are in, so
+the handler can stream the entity to its client while it is still arriving;
+:meth:`FetchEngine.fetch` buffers the whole response first.
+"""
+
+import os, time, socket, threading, Queue
+import httpmessage.exc as exc
+from upstream import UpstreamPool, reusable
+
+class FetchTimeout(Exception): pass
+
+class FetchedResponse(object):
+
+  """A response whose entity may still be unread on its upstream connection.
+  Call :meth:`release` exactly once when done with it; the connection goes
+  back to the pool only if the entity was read to the end."""
+
+  def __init__(self, pool, sock, response, keep):
+    self.response = response
+    self._pool = pool
+    self._sock = sock
+    self._keep = keep
+
+  def release(self, complete=True):
+    sock, self._sock = self._sock, None
+    if sock is None:
+      return
+    if complete and self._keep:
+      self._pool.checkin(sock)
+    else:
+      self._pool.discard(sock)
+
+class FetchJob(object):
+
+  def __init__(self, request, deadline):
+    self.request = request
+    self.deadline = deadline
+    self.result = None
+    self.error = None
+    self.abandoned = False
+    self.lock = threading.Lock()
+    self.done = threading.Event()
+
+class FetchEngine(object):
+
+  # safe to send again if a reused connection turns out to be dead
+  retry_methods = ('GET', 'HEAD', 'OPTIONS')
+
+  def __init__(self, upstream=('127.0.0.1', 1235), workers=4, timeout=10.0,
+               pool_size=None, idle_timeout=15.0):
+    self.upstream = upstream
+    self.workers = workers
+    self.timeout = timeout
+    if pool_size is None:
+      pool_size = workers
+    self.pool = UpstreamPool(upstream, pool_size, idle_timeout)
+    self._pid = None
+    self._start_lock = threading.Lock()
+
+  def _start(self):
+    # threads do not survive fork, so every worker process starts its own
+    with self._start_lock:
+      if self._pid == os.getpid():
+        return
+      self._jobs = Queue.Queue()
+      for i in range(self.workers):
+        t = threading.Thread(target=self._worker_loop)
+        t.setDaemon(True)
+        t.start()
+      self._pid = os.getpid()
+
+  def _worker_loop(self):
+    while True:
+      job = self._jobs.get()
+      result = error = None
+      if time.time() < job.deadline:
+        try:
+          result = self.open_now(job.request, job.deadline)
+        except Exception as e:
+          error = e
+      with job.lock:
+        if job.abandoned:
+          # the handler already gave up on this one
+          if result is not None:
+            result.release(complete=False)
+        else:
+          job.result, job.error = result, error
+        job.done.set()
+
+  #......................................................................
+  def open_now(self, request, deadline):
+    """Send ``request`` on the calling thread and read the response headers.
+    Connecting and reading the headers are bounded by the time left until
+    ``deadline``; each later read of the entity by the engine's timeout."""
+    request.connection = 'keep-alive'
+    while True:
+      sock, reused = self.pool.checkout(max(0.001, deadline - time.time()))
+      try:
+        response = request.fetch_response(sock=sock)
+        keep = reusable(response)
+        sock.settimeout(self.timeout)
+      except (socket.error, exc.MalformedFirstline):
+        self.pool.discard(sock)
+        # the upstream may have dropped an idle connection just as we
+        # picked it; that is worth one more try on a fresh socket
+        if reused and request.method in self.retry_methods:
+          continue
+        raise
+      except:
+        self.pool.discard(sock)
+        raise
+      return FetchedResponse(self.pool, sock, response, keep)
+
+  def fetch_now(self, request, deadline):
+    """Like :meth:`open_now`, but buffer the whole response."""
+    fetched = self.open_now(request, deadline)
+    try:
+      fetched.response.buffer_all()
+    except:
+      fetched.release(complete=False)
+      raise
+    fetched.release()
+    return fetched.response
+
+  def open(self, request, timeout=None):
+    """Queue ``request`` for a fetcher thread and wait for the response
+    headers. Returns a :class:`FetchedResponse` the caller must release.
+    Raises :exc:`FetchTimeout` if the headers are not in within ``timeout``
+    seconds (the engine default if not given)."""
+    if self._pid != os.getpid():
+      self._start()
+    if timeout is None:
+      timeout = self.timeout
+    job = FetchJob(request, time.time() + timeout)
+    self._jobs.put(job)
+    job.done.wait(timeout)
+    with job.lock:
+      if not job.done.is_set():
+        job.abandoned = True
+        raise FetchTimeout('no response within %rs' % timeout)
+    if job.error is not None:
+      if isinstance(job.error, socket.timeout):
+        raise FetchTimeout(str(job.error))
+      raise job.error
+    return job.result
+
+  def fetch(self, request, timeout=None):
+    """Like :meth:`open`, but buffer the whole response before returning
+    it."""
+    fetched = self.open(request, timeout)
+    try:
+      fetched.response.buffer_all()
+    except socket.timeout as e:
+      fetched.release(complete=False)
+      raise FetchTimeout(str(e))
+    except:
+      fetched.release(complete=False)
+      raise
+    fetched.release()
+    return fetched.response
@@ -0,0 +1,39 @@
+"""
+Resources the proxy serves itself, on any host, under a reserved path.
+
+A hosted file is read once at startup and answered from memory. Its URL
+holds a digest of its content, so the URL changes whenever the file does and
+a response can be cached by browsers for as long as they like: it goes out
+with ``Cache-Control: public, max-age=<a year>, immutable`` and a strong
+``ETag`` made from the same digest.
+
+The -i script (determinize.js) is served this way, so pages only get a
+``<script src>`` for it and browsers fetch it once for every page.
+"""
+
+import os, hashlib, email.utils
+import entrymeta
+
+# never a path an origin serves; the same on every host
+PREFIX = '/__cacheall__/'
+MAX_AGE = 365 * 24 * 3600
+
+class HostedFile(object):
+
+  def __init__(self, path, content_type):
+    f = open(path, 'rb')
+    try:
+      self.data = f.read()
+    finally:
+      f.close()
+    digest = hashlib.sha1(self.data).hexdigest()[:16]
+    root, ext = os.path.splitext(os.path.basename(path))
+    self.url = '%s%s.%s%s' % (PREFIX, root, digest, ext)
+    head = '\r\n'.join([
+        'HTTP/1.1 200 OK',
+        'Content-Type: %s' % content_type,
+        'Cache-Control: public, max-age=%d, immutable' % MAX_AGE,
+        'ETag: "%s"' % digest,
+        'Last-Modified: %s' % email.utils.formatdate(
+            os.path.getmtime(path), usegmt=True)])
+    self.meta = entrymeta.EntryMeta.from_head(head)
@@ -0,0 +1,77 @@
+"""
+Per-process in-memory tier in front of the cache store.
+
+Holds the stored bytes (response head and body) of recently served small
+entries, so a repeated hit is a dict probe and one ``sendall`` with no system
+calls on the store. Bounded by a byte budget; entries larger than
+``max_object`` are never kept, and the least recently used ones are evicted
+first.
+
+Every worker process has its own tier, but the store index is shared. An
+entry is kept together with the index value ("version") it was read under
+and is only served while the index still says the same thing, so an entry
+that any process removed or replaced since is dropped at its next lookup.
+"""
+
+import threading
+from collections import OrderedDict
+
+class HotCache(object):
+
+  def __init__(self, max_bytes=32 << 20, max_object=256 << 10):
+    self.max_bytes = max_bytes
+    self.max_object = max_object
+    self.size = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._entries)
+
+  def fits(self, size, key=''):
+    return size <= self.max_object and size <= self.max_bytes
+
+  def get(self, key, version):
+    """Return the data cached for ``key`` if it was stored under
+    ``version``, else None."""
+    with self._lock:
+      item = self._entries.pop(key, None)
+      if item is not None and item[0] == version:
+        # back in as the most recently used
+        self._entries[key] = item
+        self.hits += 1
+        return item[1]
+      if item is not None:
+        self.size -= len(item[1])
+      self.misses += 1
+      return None
+
+  def put(self, key, version, data):
+    if version is None or not self.fits(len(data)):
+      return
+    with self._lock:
+      old = self._entries.pop(key, None)
+      if old is not None:
+        self.size -= len(old[1])
+      self._entries[key] = (version, data)
+      self.size += len(data)
+      while self.size > self.max_bytes:
+        k, (v, d) = self._entries.popitem(last=False)
+        self.size -= len(d)
+        self.evictions += 1
+
+  def invalidate(self, key):
+    with self._lock:
+      item = self._entries.pop(key, None)
+      if item is not None:
+        self.size -= len(item[1])
+
+  def stats(self):
+    lookups = self.hits + self.misses
+    return ('%d hits, %d misses (%.1f%% hit rate), %d entries, %d bytes, '
+            '%d evicted' % (self.hits, self.misses,
+                            100.0 * self.hits / lookups if lookups else 0.0,
+                            len(self._entries), self.size, self.evictions))
@@ -112,6 +112,26 @@ class EntityIO(object):
                         'received response.ABORT while buffering', responses)
         return data, raw_data
 
+    #......................................................................
+    def iterchunks(self):
+        """Yield ``(data, raw_data)`` chunks straight from the underlying
+        :class:`httpmessage._entityreader.EntityReader`, without keeping
+        them.
+
+        This is for passing an entity through (e.g. from one socket to
+        another) in constant memory. It consumes the entity: only use it
+        before anything has been buffered, and do not use the file-like
+        methods afterwards."""
+        if self._is_dispatching: raise exc.ReentrantDispatch('iterchunks')
+        if self.buffering_started:
+            raise ValueError('entity is already being buffered')
+        self.buffering_started = True
+        while True:
+            data, raw_data = self._entityreader.readchunk()
+            if not raw_data:
+                break
+            yield data, raw_data
+
     #......................................................................
     def buffer_all(self):
 
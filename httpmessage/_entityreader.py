@@ -43,7 +43,7 @@ class SimpleEntityReader(EntityReader):
 
 
     _pos = 0
-    read_size = 4096
+    read_size = 16384
 
     def readchunk(self):
         EntityReader.readchunk.__doc__
@@ -70,7 +70,7 @@ class TilCloseEntityReader(EntityReader):
     until the end of file, or the socket closes."""
 
 
-    read_size = 4096
+    read_size = 16384
 
     def readchunk(self):
         EntityReader.readchunk.__doc__
@@ -145,12 +145,35 @@ class ChunkedEntityReader(EntityReader):
 #======================================================================
 class MultipartEntityReader(EntityReader):
 
-    """:class:`EntityReader` subclass...  Not implemented yet."""
-    
-    
+    """:class:`EntityReader` subclass for *multipart/byteranges* entities
+    sent without a :mailheader:`Content-Length`, which end with the close
+    delimiter of the multipart body (see :rfc:`2046` section 5.1.1).
+
+    The boundary is taken from the first delimiter line of the body. Chunks
+    are lines, and since the entity is not transfer-coded, ``data`` and
+    ``raw_data`` are the same."""
+
+    finished = False
+    boundary = None
+
     def readchunk(self):
         EntityReader.readchunk.__doc__
-        raise NotImplementedError
+        if self.finished:
+            return '', ''
+
+        raw_data = self._fileobj.readline()
+        if not raw_data:
+            msg = 'data stream ended before the multipart close delimiter'
+            raise exc.EntityReadError(msg, raw_data)
+
+        # delimiter lines may carry trailing whitespace ("transport padding")
+        line = raw_data.rstrip('\r\n').rstrip(' \t')
+        if line.startswith('--'):
+            if self.boundary is None:
+                self.boundary = line[2:]
+            elif line == '--%s--' % self.boundary:
+                self.finished = True
+        return raw_data, raw_data
 
 #======================================================================
 class NullEntityReader(EntityReader):
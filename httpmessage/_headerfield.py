@@ -1797,10 +1797,80 @@ class Range(HeaderField):
     A header; inherits from
     :class:`httpmessage._headerfield.HeaderField`.
 
-    Represents a :mailheader:`Range` field.
+    Represents a :mailheader:`Range` field, as a tuple of ``(first, last)``
+    byte positions, either of which may be ``None``.
+
+    **Usage**:
+
+    >>> obj.range = 'bytes=0-499, 9500-, -500'
+    >>> obj.range
+    ((0, 499), (9500, None), (None, 500))
+    >>> obj.range = [(500, 999)]
+    >>> obj.range
+    ((500, 999),)
+
+    A value that is not a valid byte-ranges-specifier reads as ``None``,
+    since the field must then be ignored. :meth:`satisfiable` gives the
+    ranges of an entity of a known length.
 
     See :rfc:`2616` section 14.35 for formatting details. """
-    pass
+
+    def value_decode(self, value):
+        """Converts the byte-ranges-specifier to a tuple of ``(first,
+        last)`` pairs."""
+        if value is None:
+            return None
+        unit, sep, specs = value.partition('=')
+        if not sep or unit.strip().lower() != 'bytes':
+            return None
+        ranges = []
+        for spec in specs.split(','):
+            spec = spec.strip()
+            if not spec:
+                continue
+            first, sep, last = [part.strip() for part in spec.partition('-')]
+            if not sep or not (first or last) or \
+                    (first and not first.isdigit()) or \
+                    (last and not last.isdigit()):
+                return None
+            first = int(first) if first else None
+            last = int(last) if last else None
+            if first is not None and last is not None and last < first:
+                return None
+            ranges.append((first, last))
+        return tuple(ranges) or None
+
+    def value_encode(self, value):
+        """Expects a sequence of ``(first, last)`` pairs, or a properly
+        formatted header value, which is set as is."""
+        if value is None:
+            return None
+        if isinstance(value, basestring):
+            return value
+        return 'bytes=' + ','.join(
+                '%s-%s' % ('' if first is None else first,
+                           '' if last is None else last)
+                for first, last in value)
+
+    @staticmethod
+    def satisfiable(ranges, length):
+        """The ranges of ``ranges`` (as read from the field) that select any
+        of an entity of ``length`` bytes, as inclusive ``(first, last)``
+        positions in it, in the order requested. An empty list means the
+        field is unsatisfiable."""
+        positions = []
+        for first, last in ranges:
+            if first is None:
+                # suffix-byte-range-spec
+                if not last or not length:
+                    continue
+                first, last = max(0, length - last), length - 1
+            elif first >= length:
+                continue
+            elif last is None or last >= length:
+                last = length - 1
+            positions.append((first, last))
+        return positions
 
 #----------------------------------------------------------------------
 class Referer(HeaderField):
@@ -2685,10 +2755,54 @@ class ContentRange(HeaderField):
     A header; inherits from
     :class:`httpmessage._headerfield.HeaderField`.
 
-    Represents a :mailheader:`Content-Range` field.
+    Represents a :mailheader:`Content-Range` field, as a tuple of
+    ``(first, last, length)``. ``first`` and ``last`` are ``None`` for an
+    unsatisfied range (``*``), and ``length`` is ``None`` when the length
+    of the entity is not known (``*``).
+
+    **Usage**:
+
+    >>> obj.content_range = 'bytes 21010-47021/47022'
+    >>> obj.content_range
+    (21010, 47021, 47022)
+    >>> obj.content_range = (None, None, 47022)
+    >>> str(obj['Content-Range'])
+    'bytes */47022'
+
+    A value that cannot be parsed reads as ``None``.
 
     See :rfc:`2616` section 14.16 for formatting details. """
-    pass
+
+    def value_decode(self, value):
+        """Converts the content-range-spec to ``(first, last, length)``."""
+        if value is None:
+            return None
+        unit, sep, spec = value.strip().partition(' ')
+        if not sep or unit.lower() != 'bytes':
+            return None
+        positions, sep, length = [part.strip() for part in spec.partition('/')]
+        if not sep or not (length == '*' or length.isdigit()):
+            return None
+        length = None if length == '*' else int(length)
+        if positions == '*':
+            return None, None, length
+        first, sep, last = [part.strip() for part in positions.partition('-')]
+        if not sep or not first.isdigit() or not last.isdigit() or \
+                int(last) < int(first):
+            return None
+        return int(first), int(last), length
+
+    def value_encode(self, value):
+        """Expects ``(first, last, length)``, or a properly formatted header
+        value, which is set as is."""
+        if value is None:
+            return None
+        if isinstance(value, basestring):
+            return value
+        first, last, length = value
+        return 'bytes %s/%s' % (
+                '*' if first is None else '%d-%d' % (first, last),
+                '*' if length is None else length)
 
 #----------------------------------------------------------------------
 class ContentType(HeaderField):
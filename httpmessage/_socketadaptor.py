@@ -7,7 +7,10 @@ if __name__ == "__main__":
 import socket
 
 class SocketAdaptor(object):
+    # readline peeks this much at a time looking for the newline
     recv_size = 1024
+    # read() has no delimiter to look for, so it can take bigger bites
+    read_recv_size = 65536
 
     def __init__(self, sock):
         self._sock = sock
@@ -40,7 +43,7 @@ class SocketAdaptor(object):
 
         if count is None:
             while True:
-                data = self._sock.recv(self.recv_size)
+                data = self._sock.recv(self.read_recv_size)
                 if not data:
                     break
                 buffers.append(data)
@@ -55,7 +58,7 @@ class SocketAdaptor(object):
                     # than I ask it for, which it should never do...
                     raise Exception('overran socket; should never happen')
 
-                this_recv_size = min(left, self.recv_size)
+                this_recv_size = min(left, self.read_recv_size)
                 data = self._sock.recv(this_recv_size)
                 if not data:
                     break
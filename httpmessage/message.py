@@ -290,8 +290,8 @@ class HttpMessage(_mapio.MapIOHybrid):
             return const.ZERO_BYTE_CHUNK
         elif self.content_length is not None:
             return self.content_length
-        elif self.content_type and \
-                self.content_type.lower() == 'multipart/byteranges':
+        elif self.content_type and self.content_type.split(';')[0] \
+                .strip().lower() == 'multipart/byteranges':
             return const.MULTIPART_BYTERANGE
         else:
             return const.CONNECTION_CLOSE
@@ -307,6 +307,19 @@ class HttpMessage(_mapio.MapIOHybrid):
         if hasattr(self._fileobj, 'buffer_all'):
             self._fileobj.buffer_all()
 
+    #......................................................................
+    def iter_entity(self):
+        """
+        Iterate over the entity as ``(data, raw_data)`` chunks, read directly
+        from the message's data source and not buffered in memory. ``data``
+        is transfer-decoded; ``raw_data`` is exactly what was read.
+
+        This consumes the entity; it may only be used on a message whose
+        entity has not been read yet, and the file-like API will not see
+        the data afterwards.
+        """
+        return self._fileobj.iterchunks()
+
     #......................................................................
     def __getattr__(self, attrname):
         #print 'HttpMessage getattr', attrname
@@ -429,6 +442,21 @@ class RequestMessage(HttpMessage):
         if method in 'GET HEAD'.split():
             return 0
         return super(RequestMessage,self).entity_size()
+
+    #......................................................................
+    def byte_ranges(self, length):
+        """
+        The byte ranges of an entity of ``length`` bytes that the
+        :mailheader:`Range` field asks for, as inclusive ``(first, last)``
+        positions, in the order requested.
+
+        Returns ``None`` if there is no valid :mailheader:`Range` field, and
+        an empty list if none of the ranges is satisfiable.
+        """
+        ranges = self.range
+        if ranges is None:
+            return None
+        return field.Range.satisfiable(ranges, length)
     
     #......................................................................
     def fetch_response(self, sock=None):
@@ -442,6 +470,11 @@ class RequestMessage(HttpMessage):
         :class:`socket` is not specified, a new one will be created to the
         server referenced by :attr:`host` or :attr:`request_uri`.
 
+        The response is read from ``sock`` lazily and never past the end of
+        its entity, so a persistent connection can be handed to another
+        :meth:`fetch_response` call once the returned response has been fully
+        read (see :meth:`HttpMessage.buffer_all`), provided its entity was not
+        delimited by the server closing the connection.
         """
         requri = urlparse.urlparse(self.request_uri)
         if requri.hostname and not self.host:
@@ -455,7 +488,7 @@ class RequestMessage(HttpMessage):
             sock = socket.socket()
             sock.connect((self.host, port))
         
-        sock.send(str(self))
+        sock.sendall(str(self))
         resp = ResponseMessage(socket=sock)
         resp.request_method = self.method
         return resp
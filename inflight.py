@@ -0,0 +1,104 @@
+"""
+Cross-process registry of cache keys that are currently being fetched.
+
+The first handler to miss on a key claims it and fetches; everyone else who
+misses on the same key blocks until the fetch publishes or fails, instead of
+polling the filesystem. Claims live in a fixed table in shared memory, split
+into stripes; each stripe has its own :class:`multiprocessing.Condition`, so
+a finished fetch wakes only the waiters that hash to its stripe.
+
+A claim records the process that took it. Waiters look every
+``check_every`` seconds whether that process still exists, and take over the
+claim of one that died mid-fetch; a fetch that is alive is waited for however
+long its download takes.
+"""
+
+import os, errno, time, struct, hashlib, ctypes
+from multiprocessing import Condition, Lock, Array
+
+def _alive(pid):
+  try:
+    os.kill(pid, 0)
+  except OSError as e:
+    return e.errno == errno.EPERM
+  return True
+
+class InFlightRegistry(object):
+
+  def __init__(self, stripes=64, slots=16, check_every=1.0):
+    self._stripes = stripes
+    self._slots = slots
+    self.check_every = check_every
+    self._conds = [Condition(Lock()) for i in range(stripes)]
+    # fingerprint of the claimed key (0 = free), when it was claimed and by
+    # which process
+    self._keys = Array(ctypes.c_ulonglong, stripes * slots, lock=False)
+    self._since = Array(ctypes.c_double, stripes * slots, lock=False)
+    self._owners = Array(ctypes.c_int, stripes * slots, lock=False)
+
+  def _fingerprint(self, key):
+    return struct.unpack('<Q', hashlib.md5(key).digest()[:8])[0] or 1
+
+  def _find(self, base, fp):
+    for i in xrange(base, base + self._slots):
+      if self._keys[i] == fp:
+        return i
+    return -1
+
+  def acquire(self, key):
+    """Claim ``key`` for fetching.
+
+    Returns a claim token if the caller should fetch. If another fetch of
+    ``key`` is in flight, blocks until it ends and returns None; the caller
+    should then look in the cache again (and call :meth:`acquire` again if
+    the entry still is not there, e.g. because that fetch failed)."""
+    fp = self._fingerprint(key)
+    stripe = fp % self._stripes
+    base = stripe * self._slots
+    cond = self._conds[stripe]
+    waited = False
+
+    cond.acquire()
+    try:
+      while True:
+        i = self._find(base, fp)
+        if i == -1:
+          if waited:
+            return None
+          i = self._find(base, 0)
+          if i == -1:
+            # stripe is full; fetch without coalescing rather than stall
+            return -1.0
+          return self._claim(i, fp)
+        if not _alive(self._owners[i]):
+          # owner died without releasing; take the claim over
+          return self._claim(i, fp)
+        waited = True
+        cond.wait(self.check_every)
+    finally:
+      cond.release()
+
+  def _claim(self, i, fp):
+    token = time.time()
+    self._keys[i] = fp
+    self._since[i] = token
+    self._owners[i] = os.getpid()
+    return token
+
+  def release(self, key, token):
+    """Drop the claim taken by :meth:`acquire` and wake all waiters on it,
+    whether the fetch succeeded or not."""
+    fp = self._fingerprint(key)
+    stripe = fp % self._stripes
+    base = stripe * self._slots
+    cond = self._conds[stripe]
+
+    cond.acquire()
+    try:
+      i = self._find(base, fp)
+      if i != -1 and self._since[i] == token:
+        self._keys[i] = 0
+        self._since[i] = 0.0
+      cond.notify_all()
+    finally:
+      cond.release()
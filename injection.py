@@ -0,0 +1,105 @@
+"""
+Insertion of a snippet (the -i script) into HTML pages.
+
+Pages are stored as the origin sent them, with the offset in the body
+where the snippet goes (see entrymeta.py), and the snippet is spliced in as
+a page is served. So a cache recorded under one snippet, or none, can be
+replayed under any other. Stored bodies are sent around the snippet
+unchanged, straight from the file for entries on disk.
+
+Only the start of a page is looked at when it is stored (:func:`locate`):
+chunks are held back until the ``<head>`` tag is found, or until SCAN_LIMIT
+bytes are held, or the page ends. The snippet goes right after ``<head>``.
+A page with ``<html>`` but no ``<head>`` in that prefix gets the snippet in
+a ``<head>`` of its own after ``<html>`` (:func:`snippet`), and a page with
+neither is left alone. Everything after the prefix is passed on as it
+comes, so the cost of a page does not depend on its size.
+"""
+
+import re
+
+# bytes of a page held back while looking for the insertion point
+SCAN_LIMIT = 32 << 10
+
+HEAD_TAG = re.compile(r'<\s*head(\s[^>]*)?>', re.IGNORECASE)
+HTML_TAG = re.compile(r'<\s*html(\s[^>]*)?>', re.IGNORECASE)
+# past the head, if there was one
+BODY_TAG = re.compile(r'<\s*body[\s>]', re.IGNORECASE)
+
+def should_inject(content_type, content_encoding):
+  """Whether a response is a page the snippet can go into: HTML with its
+  body not compressed or otherwise coded (the items of the
+  :mailheader:`Content-Encoding`, or None if there is none)."""
+  if content_encoding and \
+      [c for c in content_encoding if c.lower() != 'identity']:
+    return False
+  media_type = (content_type or '').split(';')[0].strip().lower()
+  return media_type == 'text/html'
+
+def insertion(prefix, final):
+  """Where the snippet goes in ``prefix``, the start of a page, as
+  ``(offset, wrap_head)``; ``(None, False)`` if it does not go in; None if
+  more of the page is needed to tell. ``final`` says no more is coming."""
+  found = HEAD_TAG.search(prefix)
+  if found:
+    return found.end(), False
+  if final or BODY_TAG.search(prefix):
+    found = HTML_TAG.search(prefix)
+    if found:
+      return found.end(), True
+    return None, False
+  return None
+
+def locate(chunks, limit=SCAN_LIMIT):
+  """Find where the snippet goes in the page read from the iterator
+  ``chunks``, reading at most ``limit`` bytes (or one chunk past) ahead.
+  Returns the offset and whether to wrap, as :func:`insertion` does, and an
+  iterator over the same page that has a chunk end at the offset."""
+  chunks = iter(chunks)
+  held = []
+  held_size = 0
+  for data in chunks:
+    if not data:
+      continue
+    held.append(data)
+    held_size += len(data)
+    found = insertion(''.join(held), held_size >= limit)
+    if found is not None:
+      break
+  else:
+    found = insertion(''.join(held), True)
+  prefix = ''.join(held)
+  offset, wrap_head = found
+  if offset is not None:
+    parts = [prefix[:offset], prefix[offset:]]
+  else:
+    parts = [prefix]
+  return offset, wrap_head, _chain(parts, chunks)
+
+def snippet(text, wrap_head):
+  """What goes into a page for the snippet ``text``."""
+  return '<head>' + text + '</head>' if wrap_head else text
+
+def splice(chunks, offset, text):
+  """The pieces of a body read from ``chunks``, with ``text`` inserted
+  ``offset`` bytes in. Only the chunk the offset falls in is split."""
+  position = 0
+  for data in chunks:
+    if position <= offset < position + len(data):
+      yield buffer(data, 0, offset - position)
+      yield text
+      yield buffer(data, offset - position)
+    elif data:
+      yield data
+    position += len(data)
+  if position <= offset:
+    # the body ended early; the insertion point was counted from the
+    # stored body, so this is only a truncated entry
+    yield text
+
+def _chain(parts, chunks):
+  for data in parts:
+    if data:
+      yield data
+  for data in chunks:
+    yield data
@@ -0,0 +1,277 @@
+"""
+Counters and histograms shared by all worker processes.
+
+A :class:`Registry` declares its metrics up front and then lays them out in
+one anonymous shared memory map, created before the workers are forked::
+
+    header      shards claimed, labels known
+    labels      up to ``max_labels`` label strings (content types, ...)
+    shards      one per process: per label, one row of 64-bit cells for
+                every metric
+
+A counter is one cell. A histogram is one cell per bucket (the last one
+counting values above every bound) and one for the sum of the values.
+
+Every process claims a shard of its own the first time it updates a metric
+and only ever writes that one, under a lock private to the process, so
+workers never wait on each other to count. Labels are numbered across
+processes under a shared lock, taken only the first time a process sees a
+label. Readers add the shards up without locking; a value read while it is
+being updated is at most one update behind.
+
+A :class:`Flusher` process writes a snapshot of the registry every
+``interval`` seconds, as JSON and as a CSV table, replacing the files whole.
+"""
+
+import os, mmap, struct, time, json, threading, traceback
+from multiprocessing import Lock, Process
+
+# shards claimed, labels known
+HEADER = struct.Struct('<II')
+CELL = struct.Struct('<Q')
+LABEL = struct.Struct('<H126s')
+# where a label goes once the table is full
+OVERFLOW_LABEL = 'other'
+
+class Counter(object):
+
+  width = 1
+
+  def __init__(self, registry, name, at):
+    self.registry = registry
+    self.name = name
+    self.at = at
+
+  def add(self, label, n=1):
+    self.registry._add(label, self.at, n)
+
+  def value(self, cells):
+    return cells[0]
+
+class Histogram(object):
+
+  """Values counted in the bucket of the first bound they do not exceed;
+  ``bounds`` are increasing."""
+
+  def __init__(self, registry, name, at, bounds):
+    self.registry = registry
+    self.name = name
+    self.at = at
+    self.bounds = tuple(bounds)
+    # a bucket per bound, one above them all, the sum
+    self.width = len(self.bounds) + 2
+
+  def observe(self, label, value):
+    bucket = 0
+    while bucket < len(self.bounds) and value > self.bounds[bucket]:
+      bucket += 1
+    self.registry._observe(label, self.at + bucket,
+                           self.at + len(self.bounds) + 1, int(value))
+
+  def value(self, cells):
+    buckets = cells[:-1]
+    count = sum(buckets)
+    return {'count': count, 'sum': cells[-1],
+            'buckets': zip(list(self.bounds) + ['+Inf'], buckets),
+            'p50': self.quantile(buckets, 0.5),
+            'p99': self.quantile(buckets, 0.99)}
+
+  def quantile(self, buckets, q):
+    """The bound of the bucket holding quantile ``q``, None if empty."""
+    count = sum(buckets)
+    if not count:
+      return None
+    seen = 0
+    for bucket, n in enumerate(buckets):
+      seen += n
+      if seen >= q * count:
+        return self.bounds[bucket] if bucket < len(self.bounds) else '+Inf'
+
+class Registry(object):
+
+  def __init__(self, max_labels=128, max_processes=32):
+    self.max_labels = max_labels
+    self.max_processes = max_processes
+    self.metrics = []
+    self._row = 0
+    self._arena = None
+    self._lock = Lock()
+    self._pid = None
+    self._local_lock = threading.Lock()
+
+  def counter(self, name):
+    return self._declare(Counter(self, name, self._row))
+
+  def histogram(self, name, bounds):
+    return self._declare(Histogram(self, name, self._row, bounds))
+
+  def _declare(self, metric):
+    assert self._arena is None, 'metrics are declared before create()'
+    self.metrics.append(metric)
+    self._row += metric.width
+    return metric
+
+  def create(self):
+    """Lay out the declared metrics. Must run before the worker processes
+    are forked."""
+    self._labels_at = HEADER.size
+    self._shards_at = self._labels_at + self.max_labels * LABEL.size
+    self._shard_size = self.max_labels * self._row * CELL.size
+    # the last shard is shared by the processes beyond max_processes
+    self.size = self._shards_at + (self.max_processes + 1) * self._shard_size
+    # anonymous maps are shared with the processes forked later
+    self._arena = mmap.mmap(-1, self.size)
+
+  #......................................................................
+  # updates
+
+  def _local(self):
+    """This process's shard and label numbers, set up on first use."""
+    if self._pid != os.getpid():
+      with self._local_lock:
+        if self._pid != os.getpid():
+          with self._lock:
+            shards, labels = HEADER.unpack_from(self._arena)
+            if shards < self.max_processes:
+              HEADER.pack_into(self._arena, 0, shards + 1, labels)
+              self._shard_lock = threading.Lock()
+            else:
+              # shared with other processes, so under the shared lock
+              shards = self.max_processes
+              self._shard_lock = self._lock
+          self._shard_at = self._shards_at + shards * self._shard_size
+          self._label_numbers = {}
+          self._pid = os.getpid()
+    return self._shard_at
+
+  def _label(self, label):
+    number = self._label_numbers.get(label)
+    if number is None:
+      with self._lock:
+        number = self._find_label(label)
+      self._label_numbers[label] = number
+    return number
+
+  def _find_label(self, label):
+    # shared lock held
+    label = label[:LABEL.size - 2]
+    shards, labels = HEADER.unpack_from(self._arena)
+    for number, name in enumerate(self._label_names(labels)):
+      if name == label:
+        return number
+    if labels >= self.max_labels - 1 and label != OVERFLOW_LABEL:
+      return self._find_label(OVERFLOW_LABEL)
+    LABEL.pack_into(self._arena, self._labels_at + labels * LABEL.size,
+                    len(label), label)
+    HEADER.pack_into(self._arena, 0, shards, labels + 1)
+    return labels
+
+  def _label_names(self, labels):
+    names = []
+    for number in range(labels):
+      length, name = LABEL.unpack_from(self._arena,
+                                       self._labels_at + number * LABEL.size)
+      names.append(name[:length])
+    return names
+
+  def _cell(self, shard_at, label, cell):
+    return shard_at + (self._label(label) * self._row + cell) * CELL.size
+
+  def _add(self, label, cell, n):
+    if self._arena is None:
+      return
+    shard_at = self._local()
+    at = self._cell(shard_at, label, cell)
+    with self._shard_lock:
+      CELL.pack_into(self._arena, at, CELL.unpack_from(self._arena, at)[0] + n)
+
+  def _observe(self, label, bucket, total, value):
+    if self._arena is None:
+      return
+    shard_at = self._local()
+    bucket_at = self._cell(shard_at, label, bucket)
+    total_at = self._cell(shard_at, label, total)
+    arena = self._arena
+    with self._shard_lock:
+      CELL.pack_into(arena, bucket_at,
+                     CELL.unpack_from(arena, bucket_at)[0] + 1)
+      CELL.pack_into(arena, total_at,
+                     CELL.unpack_from(arena, total_at)[0] + value)
+
+  #......................................................................
+  def snapshot(self):
+    """``{metric name: {label: value}}`` summed over every process, leaving
+    out labels a metric was never updated with."""
+    shards, labels = HEADER.unpack_from(self._arena)
+    names = self._label_names(labels)
+    shards = range(min(shards, self.max_processes)) + [self.max_processes]
+    row = struct.Struct('<%dQ' % self._row)
+    totals = [[0] * self._row for _ in names]
+    for shard in shards:
+      at = self._shards_at + shard * self._shard_size
+      for number in range(len(names)):
+        cells = row.unpack_from(self._arena, at + number * row.size)
+        total = totals[number]
+        for i, value in enumerate(cells):
+          total[i] += value
+    snapshot = {}
+    for metric in self.metrics:
+      values = snapshot[metric.name] = {}
+      for name, total in zip(names, totals):
+        cells = total[metric.at:metric.at + metric.width]
+        if any(cells):
+          values[name] = metric.value(cells)
+    return snapshot
+
+class Flusher(object):
+
+  """Writes the registry to ``json_path`` and ``csv_path`` every
+  ``interval`` seconds. The CSV has a row per label and the columns that
+  ``table(snapshot)`` gives as ``(header, rows)``."""
+
+  def __init__(self, registry, table, csv_path, json_path, interval=10.0):
+    self.registry = registry
+    self.table = table
+    self.csv_path = csv_path
+    self.json_path = json_path
+    self.interval = interval
+    self.started_at = time.time()
+
+  def start(self):
+    """Fork the flusher process. Call after the registry is created."""
+    p = Process(target=self._run)
+    p.daemon = True
+    p.start()
+    return p
+
+  def _run(self):
+    try:
+      while True:
+        time.sleep(self.interval)
+        try:
+          self.flush()
+        except Exception:
+          traceback.print_exc()
+    except KeyboardInterrupt:
+      pass
+
+  def flush(self):
+    snapshot = self.registry.snapshot()
+    header, rows = self.table(snapshot)
+    lines = [','.join(header)]
+    for row in rows:
+      lines.append(','.join(str(value) for value in row))
+    self._replace(self.csv_path, '\n'.join(lines) + '\n')
+    self._replace(self.json_path, json.dumps(
+        {'time': time.time(), 'uptime': time.time() - self.started_at,
+         'metrics': snapshot}, indent=1, sort_keys=True) + '\n')
+
+  def _replace(self, path, data):
+    # readers see the old file or the new one, never a part of it
+    tmp = '%s.tmp' % path
+    f = open(tmp, 'w')
+    try:
+      f.write(data)
+    finally:
+      f.close()
+    os.rename(tmp, path)
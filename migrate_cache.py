@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+"""
+Convert a cache directory from the unversioned layout
+(``<cache_dir>/<host>/<mangled key>``) to the hashed, versioned layout of
+:mod:`cachestore`.
+
+The old file names were made from the key by substituting characters, and
+the substitutions are not one-to-one, so keys are reconstructed by guessing:
+``#`` becomes ``/``, the first ``,`` becomes ``?``, and ``~`` after it
+becomes ``&`` (a key that had a literal ``,`` or ``~`` there is guessed
+wrong). ``:``, ``-``, ``[``, ``]``, ``{``, ``}`` and ``%`` each stand for
+either themselves or another character (``;``, ``|``, ``<``, ``>``, ``(``,
+``)``, ``$``), which nothing in the name tells apart, so names containing
+them after the host are reported and left in place; with ``--assume-literal`` they are
+migrated taking those characters as they are. Names that were replaced by a
+SHA-512 digest (keys over 255 characters) cannot be reversed either. Files
+left in place are fetched again by the proxy when they are requested.
+
+    python migrate_cache.py -d .cache [--dry-run] [--keep] [--assume-literal]
+"""
+
+import os, sys, re
+from optparse import OptionParser
+
+from cacheindex import PLACEHOLDER, TEMP_MARK
+from cachestore import FileStore, key_line, legacy_filename
+
+digest_name = re.compile('^[0-9a-f]{128}$')
+# characters legacy_filename also produces from other characters; in the
+# host, before the first ``#``, they can only be themselves
+ambiguous = re.compile(r'[-:\[\]{}%]')
+
+def guess_key(name, assume_literal=False):
+  path = name.find('#')
+  if path != -1 and not assume_literal and ambiguous.search(name, path):
+    return None
+  q = name.find(',')
+  if q == -1:
+    key = name.replace('#', '/')
+  else:
+    key = name[:q].replace('#', '/') + '?' + \
+        name[q+1:].replace('#', '/').replace('~', '&')
+  if legacy_filename(key) != name:
+    return None
+  return key
+
+def is_placeholder(path):
+  f = open(path, 'r')
+  try:
+    return f.readline().rstrip('\n') == PLACEHOLDER
+  finally:
+    f.close()
+
+def migrate(store, path, key, keep):
+  target = store.path_for(key)
+  tmppath = target + TEMP_MARK + 'migrate'
+  src = open(path, 'r')
+  dst = store.create(tmppath)
+  try:
+    dst.write(key_line(key))
+    while True:
+      data = src.read(65536)
+      if not data:
+        break
+      dst.write(data)
+  finally:
+    src.close()
+    dst.close()
+  os.rename(tmppath, target)
+  if not keep:
+    os.remove(path)
+
+if __name__ == "__main__":
+
+  parser = OptionParser()
+  parser.add_option("-d", "--cache-dir", default=".cache")
+  parser.add_option("-n", "--dry-run", action="store_true", default=False)
+  parser.add_option("-k", "--keep", action="store_true", default=False,
+                    help="leave the old files in place")
+  parser.add_option("--assume-literal", action="store_true", default=False,
+                    help="migrate names with : - [ ] { } %, taking those "
+                         "characters as they are")
+  (options, args) = parser.parse_args()
+
+  cache_dir = os.path.normpath(options.cache_dir)
+  store = FileStore(cache_dir)
+  if options.dry_run:
+    legacy = store.legacy_names()
+  else:
+    legacy = store.init()
+
+  migrated = skipped = unrecoverable = 0
+  for top in legacy:
+    top = os.path.join(cache_dir, top)
+    for dirpath, dirnames, filenames in os.walk(top):
+      for name in filenames:
+        path = os.path.join(dirpath, name)
+        if TEMP_MARK in name or is_placeholder(path):
+          skipped += 1
+          if not options.dry_run:
+            os.remove(path)
+          continue
+        key = None if digest_name.match(name) else \
+            guess_key(name, options.assume_literal)
+        if key is None:
+          unrecoverable += 1
+          print "cannot recover key:", path
+          continue
+        migrated += 1
+        if not options.dry_run:
+          migrate(store, path, key, options.keep)
+
+    if not options.dry_run and not options.keep:
+      # drop the per-host directories that are now empty
+      for dirpath, dirnames, filenames in os.walk(top, topdown=False):
+        try:
+          os.rmdir(dirpath)
+        except OSError:
+          pass
+
+  print "%d migrated, %d unfinished writes removed, %d left in place" % (
+      migrated, skipped, unrecoverable)
+  if options.dry_run:
+    print "(dry run; nothing was changed)"
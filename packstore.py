@@ -0,0 +1,413 @@
+"""
+Log-structured cache store.
+
+Instead of one file per entry, responses are appended to large segment files
+and found through an index of ``key -> (segment, offset, length, seq)``. A
+hit is a dict probe, one ``pread`` of the record header and response head,
+and a ``sendfile`` of the body range: no open, close or directory lookup, and
+no inode per entry. Each worker process appends to a segment of its own, so
+writers never share a file.
+
+Layout::
+
+    <cache_dir>/pack/00000001.seg    segments, numbered in creation order
+    <cache_dir>/pack/.index.journal  index changes, shared between processes
+
+A record is a fixed header (magic, flags, sequence number, key length, data
+length), the key, and the data: the response, as :class:`cachestore.FileStore`
+stores it after its key line. Deleting a key appends a tombstone record.
+Sequence numbers are global, so rebuilding the index at startup keeps the
+newest record of every key whatever segment it ended up in.
+
+A segment is sealed once it has grown to ``segment_size`` and is never
+appended to again; so is every segment left by an earlier run. The compactor
+(a separate process, see :meth:`PackStore.start_compactor`) copies the live
+records out of sealed segments that are mostly garbage, then deletes them.
+Readers that have such a segment open keep reading it until they are done.
+Tombstones are carried over for as long as their key stays deleted.
+"""
+
+import os, time, struct, threading, traceback, tempfile
+from multiprocessing import Lock, Value, Process
+
+import zerocopy
+from cacheindex import SharedMap, JOURNAL_NAME
+from cachestore import Entry, PREFIX_SIZE
+
+MAGIC = 'CPK1'
+# magic, flags, sequence number, key length, data length
+HEADER = struct.Struct('>4sBxxxQIQ')
+TOMBSTONE = 0x01
+SEGMENT_SUFFIX = '.seg'
+
+class PackIndex(SharedMap):
+
+  """Map from cache key to the ``(segment, offset, length, seq)`` of its
+  newest record; ``offset`` and ``length`` span the whole record."""
+
+  def __init__(self, store, journal_path):
+    SharedMap.__init__(self, journal_path)
+    self.store = store
+
+  def encode(self, value):
+    return '%d %d %d %d' % value
+
+  def decode(self, text):
+    return tuple(int(field) for field in text.split(' '))
+
+  def on_event(self, event):
+    op, segment = event.split(' ')
+    if op == 'retire':
+      self.store._retire(int(segment))
+
+class PackWriter(object):
+
+  """Collects one entry (in memory, or in an anonymous temporary file once
+  it outgrows ``spill_size``) and appends it to the segment of this process
+  on :meth:`commit`, which returns its location. Exactly one of
+  :meth:`commit` and :meth:`abort` must be called."""
+
+  spill_size = 1 << 20
+
+  def __init__(self, store, key):
+    self.store = store
+    self.key = key
+    self._chunks = []
+    self._size = 0
+    self._file = None
+
+  def write(self, data):
+    if self._file is None and self._size + len(data) > self.spill_size:
+      self._file = tempfile.TemporaryFile(dir=self.store.root)
+      self._file.write(''.join(self._chunks))
+      self._chunks = []
+    if self._file is None:
+      self._chunks.append(data)
+    else:
+      self._file.write(data)
+    self._size += len(data)
+
+  def _data(self):
+    if self._file is None:
+      yield ''.join(self._chunks)
+      return
+    self._file.seek(0)
+    while True:
+      data = self._file.read(65536)
+      if not data:
+        break
+      yield data
+
+  def commit(self):
+    try:
+      return self.store.put(self.key, self._size, self._data())
+    finally:
+      self.abort()
+
+  def abort(self):
+    self._chunks = []
+    if self._file is not None:
+      self._file.close()
+      self._file = None
+
+class PackStore(object):
+
+  def __init__(self, cache_dir, segment_size=64 << 20):
+    self.cache_dir = cache_dir
+    self.root = os.path.join(cache_dir, 'pack')
+    self.segment_size = segment_size
+    self.index = PackIndex(self, os.path.join(self.root, JOURNAL_NAME))
+    # shared between every process forked after this point
+    self._counter_lock = Lock()
+    self._next_segment = Value('L', 1, lock=False)
+    self._next_seq = Value('L', 1, lock=False)
+    # segments numbered below this were written by an earlier run
+    self._first_segment = 1
+    self._pid = None
+    self._local_lock = threading.Lock()
+
+  def init(self):
+    """Create the store directory. Returns the names left over from older
+    layouts (none; the file layout lives elsewhere)."""
+    if not os.path.isdir(self.root):
+      os.makedirs(self.root)
+    return []
+
+  def segment_path(self, segment):
+    return os.path.join(self.root, '%08d%s' % (segment, SEGMENT_SUFFIX))
+
+  def segments(self):
+    return sorted(int(name[:-len(SEGMENT_SUFFIX)])
+                  for name in os.listdir(self.root)
+                  if name.endswith(SEGMENT_SUFFIX))
+
+  def _local(self):
+    # descriptors and the segment being appended to belong to one process
+    if self._pid == os.getpid():
+      return
+    with self._local_lock:
+      if self._pid == os.getpid():
+        return
+      self._append_lock = threading.Lock()
+      self._active = None
+      self._readers_lock = threading.Lock()
+      self._readers = {}
+      self._retired = set()
+      self._pid = os.getpid()
+
+  def _allocate(self, counter):
+    with self._counter_lock:
+      value = counter.value
+      counter.value += 1
+    return value
+
+  #......................................................................
+  def _records(self, segment):
+    """Yield ``(offset, flags, seq, key, length)`` for every record of
+    ``segment``. A torn or corrupt tail (a crash mid-append) ends it."""
+    f = open(self.segment_path(segment), 'rb')
+    try:
+      size = os.fstat(f.fileno()).st_size
+      offset = 0
+      while offset + HEADER.size <= size:
+        f.seek(offset)
+        magic, flags, seq, key_size, data_size = \
+            HEADER.unpack(f.read(HEADER.size))
+        length = HEADER.size + key_size + data_size
+        if magic != MAGIC or offset + length > size:
+          break
+        yield offset, flags, seq, f.read(key_size), length
+        offset += length
+    finally:
+      f.close()
+
+  def load(self):
+    """Rebuild the index from the record headers of every segment and start
+    a new journal; returns the number of entries. Must run before the worker
+    processes are forked."""
+    newest = {}
+    last_segment = last_seq = 0
+    for segment in self.segments():
+      last_segment = max(last_segment, segment)
+      for offset, flags, seq, key, length in self._records(segment):
+        last_seq = max(last_seq, seq)
+        if key not in newest or newest[key][0] < seq:
+          location = None if flags & TOMBSTONE else \
+              (segment, offset, length, seq)
+          newest[key] = (seq, location)
+    self._next_segment.value = self._first_segment = last_segment + 1
+    self._next_seq.value = last_seq + 1
+    self.index.reset(dict((key, location)
+                          for key, (seq, location) in newest.iteritems()
+                          if location is not None))
+    return len(self.index)
+
+  def __len__(self):
+    return len(self.index)
+
+  #......................................................................
+  def _append(self, key, flags, size, chunks, seq=None):
+    """Append a record holding the ``size`` bytes yielded by ``chunks`` to
+    this process's segment. Returns its location."""
+    self._local()
+    with self._append_lock:
+      if seq is None:
+        seq = self._allocate(self._next_seq)
+      if self._active is None:
+        segment = self._allocate(self._next_segment)
+        fd = os.open(self.segment_path(segment),
+                     os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0644)
+        self._active = (segment, fd, 0)
+      segment, fd, offset = self._active
+      try:
+        written = _write(fd, HEADER.pack(MAGIC, flags, seq, len(key), size))
+        written += _write(fd, key)
+        for data in chunks:
+          written += _write(fd, data)
+        if written != HEADER.size + len(key) + size:
+          raise ValueError('record for %r is %d bytes, expected %d' % (
+              key, written - HEADER.size - len(key), size))
+      except:
+        # leave no partial record behind for the next append to follow
+        os.ftruncate(fd, offset)
+        raise
+      if offset + written >= self.segment_size:
+        os.close(fd)
+        self._active = None
+      else:
+        self._active = (segment, fd, offset + written)
+    return (segment, offset, written, seq)
+
+  def put(self, key, size, chunks):
+    """Store the ``size`` bytes yielded by ``chunks`` under ``key``.
+    Returns the location of the new record."""
+    location = self._append(key, 0, size, chunks)
+    self.index.put(key, location)
+    return location
+
+  def writer(self, key):
+    return PackWriter(self, key)
+
+  def remove(self, key):
+    if key not in self.index:
+      return
+    self._append(key, TOMBSTONE, 0, ())
+    self.index.discard(key)
+
+  # see cachestore.FileStore; entries are named by their key here
+  def name(self, key):
+    return key
+
+  def size(self, version):
+    return version[2]
+
+  def entries(self):
+    return [(key, length, seq)
+            for key, (segment, offset, length, seq) in self.index.items()]
+
+  discard = remove
+
+  #......................................................................
+  def version(self, key):
+    """The location of the entry for ``key``, or None; see
+    :meth:`cachestore.FileStore.version`."""
+    return self.index.get(key)
+
+  def _open_segment(self, segment):
+    with self._readers_lock:
+      if segment in self._retired:
+        raise OSError('segment %d was compacted' % segment)
+      reader = self._readers.get(segment)
+      if reader is None:
+        fd = os.open(self.segment_path(segment), os.O_RDONLY)
+        # [fd, entries open on it, retired]
+        reader = self._readers[segment] = [fd, 0, False]
+      reader[1] += 1
+      return reader[0]
+
+  def _close_segment(self, segment):
+    with self._readers_lock:
+      reader = self._readers[segment]
+      reader[1] -= 1
+      if reader[2] and reader[1] == 0:
+        os.close(reader[0])
+        del self._readers[segment]
+
+  def _retire(self, segment):
+    self._local()
+    with self._readers_lock:
+      self._retired.add(segment)
+      reader = self._readers.get(segment)
+      if reader is None:
+        return
+      if reader[1] == 0:
+        os.close(reader[0])
+        del self._readers[segment]
+      else:
+        reader[2] = True
+
+  def open_entry(self, key):
+    """Return an :class:`cachestore.Entry` for ``key``, or None if nothing
+    is stored under it."""
+    self._local()
+    for attempt in range(2):
+      location = self.index.get(key)
+      if location is None:
+        return None
+      segment, offset, length, seq = location
+      try:
+        fd = self._open_segment(segment)
+      except OSError:
+        # compacted away since the lookup; the index has moved on
+        continue
+      start = HEADER.size + len(key)
+      try:
+        data = zerocopy.pread(fd, min(length, start + PREFIX_SIZE), offset)
+      except:
+        self._close_segment(segment)
+        raise
+      if len(data) < start or data[:4] != MAGIC or data[HEADER.size:start] != key:
+        self._close_segment(segment)
+        return None
+      magic, flags, seq, key_size, size = HEADER.unpack_from(data)
+      return Entry(fd, offset + start, size, data[start:],
+                   lambda fd, segment=segment: self._close_segment(segment))
+    return None
+
+  #......................................................................
+  def compact(self, min_garbage=0.5):
+    """Rewrite every sealed segment of which at least ``min_garbage`` (a
+    fraction) is no longer live. Returns the number of segments
+    rewritten."""
+    self._local()
+    live = {}
+    for key, (segment, offset, length, seq) in self.index.items():
+      live[segment] = live.get(segment, 0) + length
+    compacted = 0
+    for segment in self.segments():
+      try:
+        size = os.path.getsize(self.segment_path(segment))
+      except OSError:
+        continue
+      if segment >= self._first_segment and size < self.segment_size:
+        # possibly still being appended to
+        continue
+      if live.get(segment, 0) <= size * (1 - min_garbage):
+        self._compact_segment(segment)
+        compacted += 1
+    return compacted
+
+  def _compact_segment(self, segment):
+    fd = os.open(self.segment_path(segment), os.O_RDONLY)
+    try:
+      for offset, flags, seq, key, length in self._records(segment):
+        if flags & TOMBSTONE:
+          if key not in self.index:
+            self._append(key, TOMBSTONE, 0, (), seq)
+          continue
+        old = (segment, offset, length, seq)
+        if self.index.get(key) != old:
+          continue
+        start = HEADER.size + len(key)
+        new = self._append(key, 0, length - start,
+                           _chunks(fd, offset + start, length - start), seq)
+        # unless a worker stored or removed the key in the meantime
+        self.index.replace(key, old, new)
+    finally:
+      os.close(fd)
+    self.index.notify('retire %d' % segment)
+    os.remove(self.segment_path(segment))
+
+  def start_compactor(self, interval=60.0, min_garbage=0.5):
+    """Fork a process that runs :meth:`compact` every ``interval`` seconds.
+    Call after :meth:`load`."""
+    p = Process(target=self._compact_loop, args=(interval, min_garbage))
+    p.daemon = True
+    p.start()
+    return p
+
+  def _compact_loop(self, interval, min_garbage):
+    try:
+      while True:
+        time.sleep(interval)
+        try:
+          self.compact(min_garbage)
+        except Exception:
+          traceback.print_exc()
+    except KeyboardInterrupt:
+      pass
+
+def _write(fd, data):
+  view = buffer(data)
+  while view:
+    view = view[os.write(fd, view):]
+  return len(data)
+
+def _chunks(fd, offset, count):
+  while count > 0:
+    data = zerocopy.pread(fd, min(count, 65536), offset)
+    if not data:
+      raise EOFError('segment ended %d bytes early' % count)
+    yield data
+    offset += len(data)
+    count -= len(data)
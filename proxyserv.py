@@ -1,6 +1,6 @@
 #!/usr/bin/evn python
 
-import sys, re
+import sys
 from optparse import OptionParser
 
 try:
@@ -13,32 +13,99 @@ from SocketServer import TCPServer, StreamRequestHandler, ThreadingMixIn
 from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 from httpmessage import HttpMessage
 from PooledProcessMixIn import PooledProcessMixIn
+from eventserver import EventLoopServer, DEFER
+from cachestore import FileStore
+from packstore import PackStore
+from hotcache import HotCache
+from sharedcache import SharedHotCache
+from eviction import Evictor, POLICIES
+from inflight import InFlightRegistry
+from variants import VaryIndex, vary_names, variant_key
+from redirects import RedirectGraph
+from metrics import Registry, Flusher
+from hosted import HostedFile
+from fetcher import FetchEngine, FetchTimeout
+import zerocopy
+import compression, entrymeta, injection
 import httpmessage.exc as exc
-import socket
+import socket, select
 
-from multiprocessing import Lock, Process
-import commands, os, hashlib, threading, traceback
+from multiprocessing import Lock, RawValue
+import os, time, traceback
 
 n_process = 8
 n_thread = 16
+# each worker accepts on its own SO_REUSEPORT socket (see PooledProcessMixIn)
+reuse_port = False
 
 read_from_cache = True
 save_to_cache = True
-lock = Lock()
-redirect_map = {}
-
-working = []
-working_lock = Lock()
+# redirects seen from the origin (see redirects.py)
+redirect_graph = None
 
 cache_dir = None
+cache_store = None
+vary_index = None
+hot_cache = None
+evictor = None
+# for the time to first hit in the startup log
+started_at = time.time()
+first_hit = RawValue('b', 0)
+first_hit_lock = Lock()
+in_flight = None
+fetch_engine = None
 determinize = None
-
-# Set type_on = False if do not want to dump content-type counts
-type_on = None
+# served by the proxy itself, by path (see hosted.py)
+hosted = {}
+# store compressible bodies gzip'd (see compression.py)
+compress = False
+
+# Counts by content type and service times, kept with -c (see metrics.py);
+# updating them costs nothing until the registry is created.
+registry = Registry()
+hit_count = registry.counter('hits')
+miss_count = registry.counter('misses')
+store_count = registry.counter('stored')
+stored_bytes = registry.counter('stored_bytes')
+hit_bytes = registry.counter('hit_bytes')
+# the hits answered from the hot tier
+hot_hit_count = registry.counter('hot_hits')
+service_ms = registry.histogram('service_ms', (1, 2, 5, 10, 20, 50, 100, 200,
+                                               500, 1000, 2000, 5000))
 type_file = "content-type.csv"
-type_map = {}
-type_lock = Lock()
-count = 0
+metrics_file = "metrics.json"
+metrics_interval = 10.0
+
+# Persistent client connections: how long to wait for the next request on an
+# idle connection, and how many requests to serve before closing it.
+keepalive_timeout = 15.0
+max_keepalive_requests = 100
+
+# headers that describe a single connection and are never stored or replayed
+hop_by_hop = set(['connection', 'keep-alive', 'proxy-connection',
+                  'transfer-encoding', 'content-length'])
+# headers of a stored response repeated in a 304 for it (RFC 7232, 4.1)
+not_modified_headers = set(['cache-control', 'content-location', 'date',
+                            'etag', 'expires', 'last-modified', 'vary'])
+
+def media_type(content_type):
+  """The media type of a Content-Type value, as metrics are labelled."""
+  return (content_type or '').split(';')[0].strip().lower() or 'none'
+
+def content_type_table(snapshot):
+  """The content-type.csv columns: a row per content type."""
+  columns = ('hits', 'misses', 'stored', 'stored_bytes', 'hit_bytes')
+  types = set()
+  for name in columns:
+    types.update(snapshot[name])
+  rows = []
+  for t in sorted(types):
+    values = [snapshot[name].get(t, 0) for name in columns]
+    lookups = values[0] + values[1]
+    ratio = '%.3f' % (float(values[0]) / lookups) if lookups else ''
+    rows.append([t] + values[:2] + [ratio] + values[2:])
+  return ('content_type', 'hits', 'misses', 'hit_ratio', 'stored',
+          'stored_bytes', 'hit_bytes'), rows
 
 class ThreadingProxyServer(ThreadingMixIn, TCPServer):
   allow_reuse_address = True
@@ -48,35 +115,47 @@ class PooledProxyServer(PooledProcessMixIn, HTTPServer):
   def __init__(self,address,handler):
     self._process_n=n_process  # if not set will default to number of CPU cores
     self._thread_n=n_thread  # if not set will default to number of threads
+    self._reuse_port=reuse_port
     HTTPServer.__init__(self, address, handler)
   
 class ProxyHandler(StreamRequestHandler):
   
-  """Buffers the entire request before sending it to server. Buffers entire
-  response before sending it to client. Doesn't work at all well for large
-  resources (like Youtube videos)."""
+  """Buffers the entire request before sending it to server. Streams the
+  response to the client as it arrives from the server; HTML pages that get
+  the -i insertion are held back only until the insertion point (see
+  injection.py)."""
 
   def request_to_server(self):
     request = self.request
-    filepath = self.filepath
     key = self.key
     redirect_url = None
+    breaks_loop = False
+
+    if save_to_cache:
+      # the whole entity is stored, and ranges of it served from the cache
+      del request.range
+      del request.if_range
+      # and the entity itself, not a bodiless 304 for this client's copy
+      del request.if_none_match
+      del request.if_modified_since
 
     # print "SEND REQUEST"
-    sock = socket.socket()
-    sock.connect(('127.0.0.1',1235))
-    response = request.fetch_response(sock=sock)
-    response.connection = 'close'
+    fetched = fetch_engine.open(request)
+    response = fetched.response
+    del response.connection
+    if 'Keep-Alive' in response:
+      del response['Keep-Alive']
+
+    # store a response that varies with request headers as a variant
+    self.media_type = media_type(response.content_type)
+    miss_count.add(self.media_type)
+    vary = vary_names(response.vary)
+    if vary is not None and save_to_cache:
+      vary_index.record(key, vary)
+      self.store_key = variant_key(key, vary, request) if vary else key
     # print "RESP", response.firstline, response.status_code, response.server, response.location
 
-    # count += 1
-
-    # # Clear redirect map
-    # if count > 1000:
-    #   count = 0
-    #   redirect_url = {}
-    
-    # Remove redirect cycle of size two.
+    # Remove redirect cycles.
     if response.location:
       # print "REDIRECT"
       redirect_url = response.location
@@ -89,208 +168,544 @@ class ProxyHandler(StreamRequestHandler):
         redirect_url = redirect_url[7:]
         
       redirect_url = redirect_url.replace("%3D","=")
-      redirect_map[key] = redirect_url
-      # print "MAP", key, redirect_url
-        
-      # Detect cycle.
-      if redirect_url in redirect_map and redirect_map[redirect_url] == key:
-        # print "DEL", redirect_url
-        del redirect_map[redirect_url]
-        st, o = commands.getstatusoutput("rm " + self.key_to_filepath(redirect_url))
-        # print "rm", self.key_to_filepath(redirect_url)
-        # print st, o
-    # END: Remove redirect cycle of size two.
-
-    response = str(response)
-    type_match = None
-
-    if type_on:
-      type_match = re.search('(Content-Type *: *) *([^;\n]*)',response,re.IGNORECASE)
-    
-    if determinize:
-      insert = re.search('< *head[^>]*>',response,re.IGNORECASE)
-      if insert:
-        insert = insert.end()
-        response = response[:insert] + determinize + response[insert:]
+
+      # Detect cycle: keep this response, drop the rest of the loop.
+      cycle = redirect_graph.add(key, redirect_url)
+      if cycle and None in cycle:
+        # a key in it too long to be named: break the loop here instead
+        redirect_graph.remove(key)
+        self.remove_from_cache(key)
+        breaks_loop = True
       else:
-        insert = re.search('< *html[^>]*>',response,re.IGNORECASE)
-        if insert:
-          insert = insert.end()
-          response = response[:insert] + "<head>" + determinize + "</head>" + response[insert:]
+        for member in cycle or ():
+          if member != key:
+            redirect_graph.remove(member)
+            self.remove_from_cache(member)
+    else:
+      # no longer a redirect, so it closes no cycle
+      redirect_graph.remove(key)
+    # END: Remove redirect cycles.
+
+    # a HEAD response has no body to store under the URL
+    save = save_to_cache and request.method != 'HEAD' and \
+        not (key == redirect_url) and not breaks_loop and \
+        response.status_code not in (206, 304) and vary is not None
+    try:
+      self.stream_response(response, save)
+    except:
+      fetched.release(complete=False)
+      raise
+    fetched.release()
+
+  def stream_response(self, response, save):
+    """Forward the entity to the client chunk by chunk as it arrives from
+    upstream, writing it to the cache at the same time. The entry is
+    published only once the whole entity has been read."""
+    size = response.entity_size()
+    length = size if size is not None and type(size) in (int, long) else None
+    chunks = (data for data, raw_data in response.iter_entity())
+    insert_at, flags = None, 0
+    if (save or determinize) and self.request.method != 'HEAD' and \
+        injection.should_inject(response.content_type,
+                                response.content_encoding):
+      # holds back the start of the page until the insertion point is known
+      insert_at, wrap_head, chunks = injection.locate(chunks)
+      if wrap_head:
+        flags = entrymeta.WRAP_HEAD
+    content_encoding = response.content_encoding
+    del response.transfer_encoding
+    head = response.str_head()[:-4]
+    if save:
+      head = entrymeta.add_validator(head)
+    meta = stored = entrymeta.EntryMeta.from_head(head, flags,
+                                                  insert_at=insert_at)
+    compressor = None
+    if save and compress and self.request.method != 'HEAD' and \
+        compression.compressible(meta.content_type, content_encoding, length):
+      compressor = compression.compressor()
+      stored = entrymeta.EntryMeta.from_head(head, flags | entrymeta.GZIP,
+                                             length, insert_at)
+
+    # this client gets the entity as it comes, whatever is stored
+    insertion = self.insertion(meta)
+    if insertion is not None and length is not None:
+      length += len(insertion[1])
+    head, chunked = self.frame_head(meta, length)
+    client_ok = self.send_to_client(head)
+    position = 0
+
+    writer = cache_store.writer(self.store_key) if save else None
+    block = stored.pack()
+    # also keep a copy for the hot tier, as long as it is small enough
+    hot = [block] if writer and hot_cache is not None else None
+    hot_size = len(block)
+    try:
+      if writer:
+        writer.write(block)
+      for data in chunks:
+        if writer:
+          hot_size = self.store_data(
+              writer, hot, hot_size,
+              compressor.compress(data) if compressor else data)
+        if not client_ok or not data:
+          continue
+        position += len(data)
+        if insertion is not None and position == insertion[0]:
+          # the stream has a chunk end there (see injection.locate)
+          data += insertion[1]
+        if chunked:
+          data = '%x\r\n%s\r\n' % (len(data), data)
+        client_ok = self.send_to_client(data)
+        if not client_ok and not writer:
+          raise socket.error('client went away')
+      if compressor:
+        hot_size = self.store_data(writer, hot, hot_size, compressor.flush())
+      if chunked and client_ok:
+        self.send_to_client('0\r\n\r\n')
+    except:
+      if writer:
+        writer.abort()
+      raise
+    if writer:
+      version = self.publish(writer, meta)
+      if hot:
+        hot_cache.put(self.store_key, version, ''.join(hot))
+
+  def store_data(self, writer, hot, hot_size, data):
+    """Write the next piece of the stored entry, and add it to ``hot``, the
+    copy kept for the hot tier, unless that grows too big for the tier (it
+    is then emptied for good). Returns the new size of the copy."""
+    writer.write(data)
+    if hot:
+      hot_size += len(data)
+      if hot_cache.fits(hot_size, self.store_key):
+        hot.append(data)
+      else:
+        del hot[:]
+    return hot_size
 
-    if save_to_cache and not (key == redirect_url):
-      # print "SAVE", key
+  def send_to_client(self, data):
+    # A client that hangs up mid-response must not cost us the cache entry;
+    # the caller keeps reading from upstream and just stops forwarding.
+    try:
+      self.connection.sendall(data)
+      return True
+    except socket.error:
+      self.keep_alive = False
+      return False
+
+  def publish(self, writer, meta):
+    """Make a completely written entry visible to every worker. Returns
+    its version in the store."""
+    version = writer.commit()
+    if evictor is not None:
+      evictor.stored(self.store_key, version)
+    if version is not None:
+      store_count.add(self.media_type)
+      stored_bytes.add(self.media_type, cache_store.size(version))
+    return version
+
+  def frame_head(self, meta, body_length, decoded=False):
+    """Rewrite the head of a stored response (its
+    :class:`entrymeta.EntryMeta`) for this client connection.
+    ``body_length`` is the entity length, with the -i snippet if it goes
+    in, or None if it is not known up front. The body of a compressed entry
+    goes out gzip-coded unless ``decoded``.
+
+    Returns the head to send and whether the entity must be chunked."""
+    lines = meta.head.split('\r\n')
+    status = meta.status
+
+    headers = [lines[0]]
+    length = None
+    vary = None
+    for line in lines[1:]:
+      if not line:
+        continue
+      name = line.split(':', 1)[0].strip().lower()
+      if name == 'content-length':
+        length = line
+      elif name == 'vary':
+        vary = len(headers)
+      elif name == 'etag' and meta.gzipped and not decoded:
+        # not the same bytes as the identity form, so not the same tag
+        line = 'ETag: ' + entrymeta.gzip_etag(line.split(':', 1)[1].strip())
+      if name not in hop_by_hop:
+        headers.append(line)
+    if meta.gzipped and not decoded:
+      headers.append('Content-Encoding: gzip')
+      if vary is None:
+        headers.append('Vary: Accept-Encoding')
+      elif 'accept-encoding' not in headers[vary].lower():
+        headers[vary] += ', Accept-Encoding'
+
+    chunked = False
+    if self.request.method == 'HEAD':
+      # keep the length of the entity the GET would have returned
+      insertion = self.insertion(meta)
+      if length and insertion is not None and \
+          length.split(':', 1)[1].strip().isdigit():
+        length = 'Content-Length: %d' % (
+            int(length.split(':', 1)[1]) + len(insertion[1]))
+      if length:
+        headers.append(length)
+    elif (100 <= status < 200) or status in (204, 304):
+      pass
+    elif body_length is not None:
+      headers.append('Content-Length: %d' % body_length)
+    elif self.request.http_version == 'HTTP/1.1':
+      headers.append('Transfer-Encoding: chunked')
+      chunked = True
+    else:
+      # HTTP/1.0 client and no length: closing is the only delimiter
+      self.keep_alive = False
+    headers.append('Connection: %s' % (
+        'keep-alive' if self.keep_alive else 'close'))
 
-      f = open(filepath, 'w')
-      f.write(response)
-      f.close()
+    return '\r\n'.join(headers) + '\r\n\r\n', chunked
 
-      # count content_type
-      if type_on:
-        #type_lock.acquire()
-        if type_match:
-          t = type_match.group(2)
-          if t in type_map:
-            type_map[t] = type_map[t] + 1
-          else:
-            type_map[t] = 1
-
-        f = open(type_file,'w')
-        for key in type_map:
-          f.write(key + "," + str(type_map[key]) + "\n")
-        f.close()
-        #type_lock.release()
-      
-    #working_lock.acquire()
-    while filepath in working:
-      working.remove(filepath)
-    #working_lock.release()
-
-    self.connection.send(response)
+  def answer_conditional(self, meta):
+    """Answer a GET or HEAD whose validators match the stored response
+    with 304 Not Modified. Returns whether it did."""
+    request = self.request
+    if request.method not in ('GET', 'HEAD') or \
+        not meta.not_modified(request.if_none_match,
+                              request.get('If-Modified-Since')):
+      return False
+    lines = [meta.status_line.split(None, 1)[0] + ' 304 Not Modified']
+    for name, value in meta.headers():
+      if name.lower() in not_modified_headers:
+        lines.append('%s: %s' % (name, value))
+    reply = entrymeta.EntryMeta(304, '\r\n'.join(lines), flags=meta.flags)
+    head, chunked = self.frame_head(reply, None,
+                                    decoded=self.must_decompress(meta))
+    self.connection.sendall(head)
+    return True
+
+  def send_cached(self, entry):
+    """Send a stored :class:`cachestore.Entry`: only the head goes through
+    Python (to be re-framed), the body is sent straight from the file."""
+    size = entry.length
+    meta = entry.meta()
+    body_start = meta.size
+    ranges = self.requested_ranges(meta, size - body_start)
+    if ranges is not None:
+      self.send_ranges(meta, size - body_start, ranges,
+                       lambda first, count: zerocopy.sendfile(
+                           self.connection, entry.fd,
+                           entry.offset + body_start + first, count))
+      return
+    if self.must_decompress(meta):
+      self.send_decompressed(meta, self.entry_chunks(entry, body_start))
+      return
+    insertion = self.insertion(meta)
+    if insertion is None:
+      head, chunked = self.frame_head(meta, size - body_start)
+      self.connection.sendall(head)
+      if self.request.method != 'HEAD' and body_start < size:
+        zerocopy.sendfile(self.connection, entry.fd,
+                          entry.offset + body_start, size - body_start)
+      return
+    # the body around the snippet, both parts straight from the file
+    at, text = insertion
+    at = min(at, size - body_start)
+    head, chunked = self.frame_head(meta, size - body_start + len(text))
+    self.connection.sendall(head)
+    if self.request.method != 'HEAD':
+      zerocopy.sendfile(self.connection, entry.fd, entry.offset + body_start,
+                        at)
+      self.connection.sendall(text)
+      zerocopy.sendfile(self.connection, entry.fd,
+                        entry.offset + body_start + at,
+                        size - body_start - at)
+
+  def entry_chunks(self, entry, start):
+    while start < entry.length:
+      data = entry.read(min(65536, entry.length - start), start)
+      if not data:
+        break
+      start += len(data)
+      yield data
+
+  def send_response_text(self, response):
+    """Send a serialized response (as stored in the cache) to the
+    client."""
+    meta = entrymeta.parse(response)
+    self.send_entity(meta, buffer(response, meta.size))
+
+  def send_entity(self, meta, body):
+    """Send a response held in memory, with framing headers recomputed for
+    this connection: the stored Content-Length may predate the -i
+    insertion, and Connection reflects whether we keep the client
+    connection open."""
+    ranges = self.requested_ranges(meta, len(body))
+    if ranges is not None:
+      self.send_ranges(meta, len(body), ranges,
+                       lambda first, count: self.connection.sendall(
+                           buffer(body, first, count)))
+      return
+    if self.must_decompress(meta):
+      self.send_decompressed(meta, [body])
+      return
+    insertion = self.insertion(meta)
+    added = len(insertion[1]) if insertion is not None else 0
+    head, chunked = self.frame_head(meta, len(body) + added)
+    self.connection.sendall(head)
+    if self.request.method == 'HEAD':
+      return
+    parts = [body] if insertion is None else \
+        injection.splice([body], insertion[0], insertion[1])
+    for data in parts:
+      if len(data):
+        self.connection.sendall(data)
+
+  def requested_ranges(self, meta, length):
+    """The parts of a stored body of ``length`` bytes to send for this
+    request, as inclusive ``(first, last)`` positions. None means all of
+    it, and an empty list that none of the ranges asked for exists."""
+    request = self.request
+    if request.method != 'GET' or meta.status != 200 or meta.gzipped or \
+        self.insertion(meta) is not None:
+      # ranges of a compressed entry would be ranges of the gzip stream,
+      # and those of a stored page not those of the page with the snippet
+      return None
+    ranges = request.byte_ranges(length)
+    if ranges is None:
+      return None
+    if_range = request.if_range
+    if if_range is not None and not meta.if_range(if_range):
+      return None
+    if sum(last - first + 1 for first, last in ranges) > length:
+      # overlapping ranges; the whole body is less to send
+      return None
+    return ranges
+
+  def send_ranges(self, meta, length, ranges, send_part):
+    """Send ``ranges`` of a stored body of ``length`` bytes: one as 206
+    Partial Content, several as a multipart/byteranges 206, none as 416.
+    ``send_part(first, count)`` sends ``count`` bytes of the body from
+    ``first`` on."""
+    version = meta.status_line.split(None, 1)[0]
+    if not ranges:
+      reply = entrymeta.EntryMeta(416, '%s 416 Requested Range Not Satisfiable'
+                                  '\r\nContent-Range: bytes */%d' % (
+                                      version, length))
+      head, chunked = self.frame_head(reply, 0)
+      self.connection.sendall(head)
+      return
+
+    lines = ['%s 206 Partial Content' % version]
+    for line in meta.head.split('\r\n')[1:]:
+      name = line.split(':', 1)[0].strip().lower()
+      if name == 'content-range' or \
+          (name == 'content-type' and len(ranges) > 1):
+        continue
+      lines.append(line)
+    if len(ranges) == 1:
+      first, last = ranges[0]
+      lines.append('Content-Range: bytes %d-%d/%d' % (first, last, length))
+      reply = entrymeta.EntryMeta(206, '\r\n'.join(lines))
+      head, chunked = self.frame_head(reply, last - first + 1)
+      self.connection.sendall(head)
+      send_part(first, last - first + 1)
+      return
+
+    boundary = os.urandom(12).encode('hex')
+    lines.append('Content-Type: multipart/byteranges; boundary=' + boundary)
+    part_type = 'Content-Type: %s\r\n' % meta.content_type \
+        if meta.content_type else ''
+    parts = ['%s--%s\r\n%sContent-Range: bytes %d-%d/%d\r\n\r\n' % (
+        '\r\n' if i else '', boundary, part_type, first, last, length)
+             for i, (first, last) in enumerate(ranges)]
+    end = '\r\n--%s--\r\n' % boundary
+    reply = entrymeta.EntryMeta(206, '\r\n'.join(lines))
+    head, chunked = self.frame_head(reply, sum(len(p) for p in parts) + sum(
+        last - first + 1 for first, last in ranges) + len(end))
+    self.connection.sendall(head)
+    for part, (first, last) in zip(parts, ranges):
+      self.connection.sendall(part)
+      send_part(first, last - first + 1)
+    self.connection.sendall(end)
+
+  def insertion(self, meta):
+    """Where the -i snippet goes into the body of a stored response and
+    what goes in, as ``(offset, text)``; None if nothing does."""
+    if not determinize or meta.insert_at is None:
+      return None
+    return meta.insert_at, injection.snippet(determinize, meta.wrap_head)
+
+  def must_decompress(self, meta):
+    """Whether a stored response is compressed and this client must get it
+    decompressed: it does not accept gzip, or the -i snippet goes into it.
+    HEAD is always answered as for identity."""
+    return meta.gzipped and (
+        self.request.method == 'HEAD' or
+        not compression.accepts_gzip(self.request.accept_encoding) or
+        self.insertion(meta) is not None)
+
+  def send_decompressed(self, meta, chunks):
+    """Send a compressed entry, given its header block and the pieces of
+    its stored body, as the origin sent it."""
+    insertion = self.insertion(meta)
+    length = meta.identity_length
+    if insertion is not None and length is not None:
+      length += len(insertion[1])
+    head, chunked = self.frame_head(meta, length, decoded=True)
+    self.connection.sendall(head)
+    if self.request.method == 'HEAD':
+      return
+    decompressor = compression.decompressor()
+    def decoded():
+      for data in chunks:
+        yield decompressor.decompress(data)
+      yield decompressor.flush()
+    parts = decoded() if insertion is None else \
+        injection.splice(decoded(), insertion[0], insertion[1])
+    for data in parts:
+      self.send_chunk(data, chunked)
+    if chunked:
+      self.connection.sendall('0\r\n\r\n')
+
+  def send_chunk(self, data, chunked):
+    if data and chunked:
+      self.connection.sendall('%x\r\n%s\r\n' % (len(data), data))
+    elif data:
+      self.connection.sendall(data)
+
+  def send_error_status(self, status, reason):
+    self.keep_alive = False
+    self.connection.sendall('HTTP/1.1 %d %s\r\nContent-Length: 0\r\n'
+                            'Connection: close\r\n\r\n' % (status, reason))
+
+  def client_wants_keep_alive(self, request):
+    tokens = [t.lower() for t in (request.connection or ())]
+    proxy_connection = request.get('Proxy-Connection', '').lower()
+    if 'close' in tokens or proxy_connection == 'close':
+      return False
+    if request.http_version == 'HTTP/1.1':
+      return True
+    return 'keep-alive' in tokens or proxy_connection == 'keep-alive'
     
   def cache_or_request(self):
-    filepath = self.filepath
-    # print "LOCK"
-    #lock.acquire()
-    status, output = commands.getstatusoutput("ls " + filepath)
-    if read_from_cache and status == 0 and output.find("cannot access") == -1:
-      #lock.release()
-      # print "UNLOCK"
-      try:
-        f = open(filepath, 'r')
-        firstline = f.readline()
-        create_date = f.readline().split(" ")
-        f.close()
-      except IOError:
-        # print "CALL CACHE_OR_REQUEST", filepath
-        self.cache_or_request()
+    while True:
+      # the variant this request selects, if responses for it vary
+      key = self.store_key = vary_index.key_for(self.key, self.request)
+      version = cache_store.version(key) if read_from_cache else None
+      data = self.hot_lookup(key, version) if version is not None else None
+      if data is not None:
+        # print "HOT-HIT", key
+        meta = entrymeta.parse(data)
+        if not self.answer_conditional(meta):
+          self.send_entity(meta, buffer(data, meta.size))
+        self.note_hit(key, meta, len(data))
+        hot_hit_count.add(media_type(meta.content_type))
         return
-      # print "IN-CACHE", firstline
-      while firstline == "~empty~\n":
-        # print "loop on ~empty~"
-        # print filepath
-
-        # # print create_date
-        create_day = int(create_date[2])
-        create_time = [int(x) for x in create_date[3].split(":")]
-        
-        status, current_date = commands.getstatusoutput("date")
-        current_date = current_date.split(" ")
-        current_day = int(current_date[2])
-        current_time = [int(x) for x in current_date[3].split(":")]
-
-        if current_day != create_day or \
-              current_time[0]*60 + current_time[1] > create_time[0]*60 + create_time[1] + 1:
-          os.system("rm " + filepath)
-          # print "BREAKING THE LOOP!!!!!!!!!!!!!!!!!!!!!!!!!"
-        
+
+      entry = cache_store.open_entry(key) if version is not None else None
+      if entry is not None:
+        # print "CACHE-HIT", key
         try:
-          f = open(filepath, 'r')
-          firstline = f.readline()
-          create_date = f.readline().split(" ")
-          f.close()
-        except IOError:
-          # print "CALL CACHE_OR_REQUEST"
-          self.cache_or_request()
-          return
-
-      # print "CACHE-HIT", filepath
-      try:
-        f = open(filepath, 'r')
-        response = f.read()
-        f.close()
-      except IOError:
-        # print "CALL CACHE_OR_REQUEST"
-        self.cache_or_request()
+          meta = entry.meta()
+          if self.answer_conditional(meta):
+            pass
+          elif hot_cache is not None and hot_cache.fits(entry.length, key) and \
+              self.request.method != 'HEAD':
+            data = entry.prefix + entry.read(entry.length, len(entry.prefix))
+            hot_cache.put(key, version, data)
+            self.send_response_text(data)
+          else:
+            self.send_cached(entry)
+        finally:
+          entry.close()
+        self.note_hit(key, meta, entry.length)
         return
-      self.connection.send(response)
-    else:
+
       # print "CACHE-MISS"
-      # # print request.host, request.connection
-      # # print request.cache_control, request.accept
-      # # print request.user_agent, request.accept_encoding, request.accept_language
-      # # print request.cookie
-
-      try:
-        # Placeholder for locking.
-        #working_lock.acquire()
-        working.append(filepath)
-        #working_lock.release()
-
-        os.system("echo ~empty~ > " + filepath + " & date >> " + filepath)
-        #lock.release()
-        # print "UNLOCK"
-        p = Process(target=(lambda:self.request_to_server()))
-        p.start()
-        p.join(10)
-        if p.is_alive():
-          # print "waiting... let's kill it..."
-          p.terminate()
-          p.join()
-
-          os.system("rm " + filepath)
-          #working_lock.acquire()
-          working.remove(filepath)
-          #working_lock.release()
-      except Exception as e:
-        f = open('error.log', 'a')
-        f.write(str(type(e)) + ', ' + str(e) + '\n')
-        f.write(traceback.format_exc())
-        f.close()
-
-        os.system("rm " + filepath)
-        # print "CLEAN-UP: rm", filepath
-        # # print traceback.format_exc()
-        raise e
-
-  def key_to_filepath(self, key):
-
-    cleanedfilename = key.replace("/","#").replace("&","~").replace(";",":").replace("|","-").replace("<","[").replace(">","]").replace("?",",").replace("(","{").replace(")","}").replace("$","%")
-    direc = cleanedfilename[0:cleanedfilename.find("#")]
-
-    if len(cleanedfilename) > 255:
-      cleanedfilename = hashlib.sha512(cleanedfilename).hexdigest()
-
-    path = cache_dir + "/" + direc + "/" + cleanedfilename 
-    path = path.encode('ascii', 'ignore')
-
-    #make sure this path can be used
-    dirnm = os.path.dirname(path)
-    if not os.path.exists(dirnm):
-      print "trying to make", dirnm
-      os.makedirs(dirnm)
-
-    return path
+      # Only one handler across all workers fetches a given key; the others
+      # block here until it publishes (or gives up) and then look again.
+      if not self.may_wait():
+        raise MissDeferred()
+      token = in_flight.acquire(key)
+      if token:
+        break
 
-  def handle(self):
-    try:
-      request = HttpMessage(socket=self.connection)
-      self.request = request
-      # print "BEFORE", request.method, request.host, request.request_uri
-      
-      # Need to modify uri because some websites, such as thefreedictionry.com,
-      # handle uri that has host as substring incorrectly.
-      pos = request.request_uri.find(request.host)
-      if pos >= 0:
-        request.request_uri = request.request_uri[pos+len(request.host):]
-        
-      key = request.host + request.request_uri
-      self.key = key
-      filepath = self.key_to_filepath(key)
-      self.filepath = filepath
-      # print "AFTER", request.method, key #, filepath
-    
-      self.cache_or_request()
+    self.outcome = 'miss'
 
-    except exc.MalformedFirstline:
-      # self.connection.send("")
-      pass
+    try:
+      self.request_to_server()
+    except FetchTimeout:
+      # print "upstream timed out", key
+      self.send_error_status(504, 'Gateway Timeout')
     except Exception as e:
       f = open('error.log', 'a')
       f.write(str(type(e)) + ', ' + str(e) + '\n')
       f.write(traceback.format_exc())
       f.close()
 
+      self.remove_from_cache(key)
+      # print "CLEAN-UP: rm", key
+      # # print traceback.format_exc()
+      raise e
+    finally:
+      in_flight.release(key, token)
+
+  def note_hit(self, key, meta, length):
+    """Account for a hit on ``key``, ``length`` bytes stored with block
+    ``meta``."""
+    self.outcome = 'hit'
+    label = media_type(meta.content_type)
+    hit_count.add(label)
+    hit_bytes.add(label, length - meta.size)
+    if evictor is not None:
+      evictor.hit(key)
+    if not first_hit.value:
+      with first_hit_lock:
+        if not first_hit.value:
+          first_hit.value = 1
+          print "first cache hit served %.2fs after startup" % (
+              time.time() - started_at)
+          sys.stdout.flush()
+
+  def hot_lookup(self, key, version):
+    if hot_cache is None:
+      return None
+    return hot_cache.get(key, version)
+
+  def remove_from_cache(self, key):
+    cache_store.remove(key)
+    # other workers notice through the store version
+    if hot_cache is not None:
+      hot_cache.invalidate(key)
+    if evictor is not None:
+      evictor.removed(key)
+
+  def handle(self):
+    served = 0
+    self.keep_alive = True
+    try:
+      while self.keep_alive:
+        # wait for the (next) request, but not forever
+        readable, _, _ = select.select([self.connection], [], [],
+                                       keepalive_timeout)
+        if not readable:
+          break
+
+        request = HttpMessage(socket=self.connection)
+        self.request = request
+        # print "BEFORE", request.method, request.host, request.request_uri
+
+        # the next request starts where this one's entity ends
+        request.buffer_all()
+        served += 1
+        self.keep_alive = (self.client_wants_keep_alive(request) and
+                           served < max_keepalive_requests)
+        self.serve(request)
+
+    except exc.MalformedFirstline:
+      # client closed the connection (or sent garbage) between requests
+      pass
+    except Exception as e:
+      log_error(e)
       raise e
 
       # # print "---------------------------------------------------------------"
@@ -298,38 +713,203 @@ class ProxyHandler(StreamRequestHandler):
       # # print "---------------------------------------------------------------"
 
     #   self.connection.send("")
-    
+
+  def serve(self, request):
+    """Answer ``request``, read in full from the client."""
+    self.request = request
+
+    # Need to modify uri because some websites, such as thefreedictionry.com,
+    # handle uri that has host as substring incorrectly.
+    pos = request.request_uri.find(request.host)
+    if pos >= 0:
+      request.request_uri = request.request_uri[pos+len(request.host):]
+
+    key = request.host + request.request_uri
+    self.key = key
+    # print "AFTER", request.method, key
+
+    self.started = time.time()
+    resource = hosted.get(request.request_uri.split('?', 1)[0])
+    if resource is not None:
+      self.outcome = 'hosted'
+      if not self.answer_conditional(resource.meta):
+        self.send_entity(resource.meta, resource.data)
+    else:
+      self.cache_or_request()
+    service_ms.observe(self.outcome, (time.time() - self.started) * 1000)
+
+  def may_wait(self):
+    """Whether this thread may wait for a fetch, of its own or of another
+    handler (see :class:`EventProxyHandler`)."""
+    return True
+
+class MissDeferred(Exception):
+  pass
+
+class EventProxyHandler(ProxyHandler):
+
+  """:class:`ProxyHandler` for the event loop server (see eventserver.py):
+  the loop reads the requests, and each one is answered by
+  :meth:`handle_request` on an executor thread. A request that is not in
+  the cache is handed to the slow pool, where :meth:`resume` fetches it or
+  waits for the fetch in flight."""
+
+  def __init__(self, connection, client_address):
+    self.connection = connection
+    self.client_address = client_address
+    self.served = 0
+    self.slow = False
+
+  def may_wait(self):
+    return self.slow
+
+  def handle_request(self, request):
+    self.served += 1
+    self.keep_alive = (self.client_wants_keep_alive(request) and
+                       self.served < max_keepalive_requests)
+    self.slow = False
+    try:
+      self.serve(request)
+    except MissDeferred:
+      return DEFER
+    except Exception as e:
+      log_error(e)
+      self.keep_alive = False
+    return self.keep_alive
+
+  def resume(self):
+    self.slow = True
+    try:
+      self.cache_or_request()
+      service_ms.observe(self.outcome, (time.time() - self.started) * 1000)
+    except Exception as e:
+      log_error(e)
+      self.keep_alive = False
+    return self.keep_alive
+
+def log_error(e):
+  f = open('error.log', 'a')
+  f.write(str(type(e)) + ', ' + str(e) + '\n')
+  f.write(traceback.format_exc())
+  f.close()
+
 if __name__ == "__main__":
 
   parser = OptionParser()
   parser.add_option("-d", "--cache-dir", default=".cache")
   parser.add_option("-i", "--insert", default=False)
-  parser.add_option("-c", "--count", action="store_true", default=False)
+  parser.add_option("-c", "--count", action="store_true", default=False,
+                    help="write counts by content type to %s and all "
+                         "metrics to %s" % (type_file, metrics_file))
+  parser.add_option("--metrics-interval", type="float",
+                    default=metrics_interval,
+                    help="seconds between writes of the -c files")
+  parser.add_option("--server", choices=["pool", "event"], default="pool",
+                    help="threads per connection in a pool of processes, or "
+                         "an event loop per process")
+  parser.add_option("--event-threads", type="int", default=n_thread,
+                    help="threads per process that answer cache hits with "
+                         "--server event")
+  parser.add_option("--event-miss-threads", type="int", default=64,
+                    help="threads per process that fetch misses (or wait "
+                         "for them) with --server event")
+  parser.add_option("--max-connections", type="int", default=10000,
+                    help="open client connections per process with --server "
+                         "event")
+  parser.add_option("--reuse-port", action="store_true", default=False,
+                    help="with --server pool, every process listens and "
+                         "accepts on its own SO_REUSEPORT socket")
+  parser.add_option("--keep-alive-timeout", type="float",
+                    default=keepalive_timeout)
+  parser.add_option("--max-requests", type="int",
+                    default=max_keepalive_requests)
+  parser.add_option("--store", choices=["file", "pack"], default="file",
+                    help="one file per entry, or append to segment files")
+  parser.add_option("--hot-tier", choices=["shared", "process"],
+                    default="shared",
+                    help="one in-memory tier for all workers, or one each")
+  parser.add_option("--hot-bytes", type="int", default=64 << 20,
+                    help="in-memory tier budget, in all for the shared tier "
+                         "and per worker otherwise (0 disables)")
+  parser.add_option("--hot-max-object", type="int", default=256 << 10)
+  parser.add_option("--max-cache-bytes", type="int", default=0,
+                    help="evict entries beyond this many bytes (0: no limit)")
+  parser.add_option("--max-cache-entries", type="int", default=0,
+                    help="evict entries beyond this many (0: no limit)")
+  parser.add_option("--eviction", choices=sorted(POLICIES), default="lru")
+  parser.add_option("--compress", action="store_true", default=False,
+                    help="store text-like bodies gzip'd")
+  parser.add_option("--redirect-entries", type="int", default=8192,
+                    help="redirects remembered to detect redirect loops")
   (options, args) = parser.parse_args()
 
   determinize = options.insert
   if (determinize):
-    f = open('determinize.js')
-    determinize_file = f.read()
-    f.close()
-    determinize ="<script>"+determinize_file+"determinize("+determinize+");</script>"
-  type_on = options.count
-  cache_dir = options.cache_dir
+    # pages only link to the script, which browsers then cache
+    script = HostedFile('determinize.js', 'application/javascript')
+    hosted[script.url] = script
+    determinize = ('<script src="%s"></script>'
+                   '<script>determinize(%s);</script>' % (script.url,
+                                                          determinize))
+  compress = options.compress
+  keepalive_timeout = options.keep_alive_timeout
+  max_keepalive_requests = options.max_requests
+  cache_dir = os.path.normpath(options.cache_dir)
+  reuse_port = options.reuse_port
 
   server_address = ('127.0.0.1', 1234)
   #proxyserver = ThreadingProxyServer(server_address, ProxyHandler)
-  proxyserver = PooledProxyServer(server_address, ProxyHandler)
+  if options.server == "event":
+    proxyserver = EventLoopServer(server_address, EventProxyHandler,
+                                  n_process, options.event_threads,
+                                  options.event_miss_threads,
+                                  keepalive_timeout, options.max_connections)
+  else:
+    proxyserver = PooledProxyServer(server_address, ProxyHandler)
   print 'proxy serving on %r' % (server_address,)
 
-  os.system("mkdir " + cache_dir)
+  if not os.path.isdir(cache_dir):
+    os.makedirs(cache_dir)
   print "cache directory:", cache_dir
 
+  if options.store == "pack":
+    cache_store = PackStore(cache_dir)
+  else:
+    cache_store = FileStore(cache_dir)
+  if cache_store.init():
+    print "cache directory also holds entries in the old layout;",
+    print "they are not served (see migrate_cache.py)"
+  loaded_at = time.time()
+  n_entries = cache_store.load()
+  print "cache index: %d entries in %.2fs%s" % (
+      n_entries, time.time() - loaded_at,
+      " (from snapshot)" if cache_store.index.from_snapshot else "")
+  if options.store == "pack":
+    cache_store.start_compactor()
+  else:
+    cache_store.start_checkpointer()
+  if options.max_cache_bytes or options.max_cache_entries:
+    evictor = Evictor(cache_store, options.eviction, options.max_cache_bytes,
+                      options.max_cache_entries)
+    evictor.start()
+  if options.hot_bytes > 0 and options.hot_tier == "shared":
+    hot_cache = SharedHotCache(options.hot_bytes, options.hot_max_object)
+  elif options.hot_bytes > 0:
+    hot_cache = HotCache(options.hot_bytes, options.hot_max_object)
+  vary_index = VaryIndex(cache_dir)
+  vary_index.load()
+  redirect_graph = RedirectGraph(options.redirect_entries)
+  if options.count:
+    registry.create()
+    Flusher(registry, content_type_table, type_file, metrics_file,
+            options.metrics_interval).start()
+  in_flight = InFlightRegistry()
+  fetch_engine = FetchEngine(workers=n_thread)
+
   try:
     proxyserver.serve_forever()
   except KeyboardInterrupt:
-    for f in working:
-      # print "CLEAN-UP: rm", f
-      os.system("rm " + f)
+    pass
     # print '\nexiting...'
-    # print "Redirect!!!!!!!!!!!!!!!!!!", len(redirect_map)
+    # print "Redirect!!!!!!!!!!!!!!!!!!", len(redirect_graph)
 
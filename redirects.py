@@ -0,0 +1,144 @@
+"""
+Redirects seen from the origin, shared by all worker processes.
+
+A graph of ``source -> target`` edges between cache keys, at most one per
+source, held in an anonymous shared memory map created before the workers
+are forked. Edges live in sets of WAYS slots picked by the source. A full
+set forgets its least recently used edge, so the graph takes the same
+memory however long the proxy runs.
+
+:meth:`RedirectGraph.add` follows the chain from the new target and reports
+the cycle the new edge closes, of any length up to MAX_HOPS. A key longer
+than MAX_KEY is stored as a fingerprint, so its edges still count towards
+cycles, but it cannot be given back by name.
+
+All access takes one lock; the graph is only consulted when a response comes
+from the origin.
+"""
+
+import mmap, struct, hashlib
+from multiprocessing import Lock, RawValue
+
+WAYS = 8
+# longest chain followed
+MAX_HOPS = 32
+# keys are stored up to this length; a longer one is stored as a fingerprint
+MAX_KEY = 512
+# source fingerprint (0: free), last used, source length, target length;
+# then the source and the target
+SLOT = struct.Struct('<QQHH4x')
+
+def _fingerprint(key):
+  return struct.unpack('<Q', hashlib.md5(key).digest()[:8])[0] or 1
+
+def _stored(key):
+  # a NUL never occurs in a key, so this cannot collide with a short one
+  if len(key) <= MAX_KEY:
+    return key
+  return '\0' + hashlib.md5(key).digest()
+
+def _named(stored):
+  return None if stored.startswith('\0') else stored
+
+class RedirectGraph(object):
+
+  def __init__(self, max_entries=8192):
+    self._sets = max(1, max_entries // WAYS)
+    self._slot_size = SLOT.size + 2 * MAX_KEY
+    self.size = self._sets * WAYS * self._slot_size
+    # anonymous maps are shared with the processes forked later
+    self._arena = mmap.mmap(-1, self.size)
+    self._lock = Lock()
+    self._clock = RawValue('L', 0)
+
+  def __len__(self):
+    with self._lock:
+      return sum(1 for at in self._slots() if self._used(at))
+
+  #......................................................................
+  # lock held from here on
+
+  def _slots(self, fingerprint=None):
+    if fingerprint is None:
+      return xrange(0, self.size, self._slot_size)
+    first = (fingerprint % self._sets) * WAYS * self._slot_size
+    return xrange(first, first + WAYS * self._slot_size, self._slot_size)
+
+  def _used(self, at):
+    return SLOT.unpack_from(self._arena, at)[0] != 0
+
+  def _find(self, source):
+    fingerprint = _fingerprint(source)
+    for at in self._slots(fingerprint):
+      fp, used, source_len, target_len = SLOT.unpack_from(self._arena, at)
+      if fp == fingerprint and \
+          self._arena[at + SLOT.size:at + SLOT.size + source_len] == source:
+        return at
+    return None
+
+  def _target(self, at, touch=True):
+    fp, used, source_len, target_len = SLOT.unpack_from(self._arena, at)
+    if touch:
+      self._clock.value += 1
+      SLOT.pack_into(self._arena, at, fp, self._clock.value, source_len,
+                     target_len)
+    start = at + SLOT.size + MAX_KEY
+    return self._arena[start:start + target_len]
+
+  def _chain(self, source):
+    chain = [source]
+    seen = set(chain)
+    while len(chain) <= MAX_HOPS:
+      at = self._find(chain[-1])
+      if at is None:
+        break
+      target = self._target(at, touch=False)
+      chain.append(target)
+      if target in seen:
+        break
+      seen.add(target)
+    return chain
+
+  #......................................................................
+  def target(self, source):
+    """Where ``source`` redirects to, or None if not known or too long to
+    have been kept."""
+    with self._lock:
+      at = self._find(_stored(source))
+      return _named(self._target(at)) if at is not None else None
+
+  def add(self, source, target):
+    """Record that ``source`` redirects to ``target``. Returns the cycle this
+    closes, as the list of keys from ``target`` round to ``source``, or
+    None. Keys in the cycle longer than MAX_KEY, other than ``source`` and
+    ``target``, are given as None."""
+    names = {_stored(source): source, _stored(target): target}
+    source, target = _stored(source), _stored(target)
+    arena = self._arena
+    with self._lock:
+      at = self._find(source)
+      if at is None:
+        # a free slot in the set, or the least recently used one
+        fingerprint = _fingerprint(source)
+        at = min(self._slots(fingerprint),
+                 key=lambda at: SLOT.unpack_from(arena, at)[1]
+                 if self._used(at) else -1)
+      self._clock.value += 1
+      start = at + SLOT.size
+      arena[start:start + len(source)] = source
+      arena[start + MAX_KEY:start + MAX_KEY + len(target)] = target
+      SLOT.pack_into(arena, at, _fingerprint(source), self._clock.value,
+                     len(source), len(target))
+
+      chain = self._chain(target)
+      if source in chain:
+        return [names.get(key) or _named(key)
+                for key in chain[:chain.index(source) + 1]]
+      return None
+
+  def remove(self, source):
+    """Forget where ``source`` redirects to."""
+    with self._lock:
+      at = self._find(_stored(source))
+      if at is not None:
+        SLOT.pack_into(self._arena, at, 0, 0, 0, 0)
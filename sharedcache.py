@@ -0,0 +1,248 @@
+"""
+Hot tier shared by all worker processes.
+
+Same interface as :class:`hotcache.HotCache`, but the entries live in one
+anonymous shared memory map created before the workers are forked, so an
+entry cached by one worker is served by all of them and memory is not spent
+eight times over.
+
+Layout of the arena::
+
+    class table    per size class: next never-used slot, clock hand
+    hash table     buckets of WAYS (fingerprint, slot) pairs
+    slabs          per size class: fixed-size slots, each a seqlock'd
+                   header, the key, then the data
+
+Size classes double from 1 KB up to ``max_object`` and share the budget
+equally. A slot holds key and data of up to its class size. When a class is
+full, a clock sweep over its slots picks one that was not read since the last
+sweep; a full bucket gives up one of its ways the same way.
+
+Writers (:meth:`SharedHotCache.put`, :meth:`SharedHotCache.invalidate`)
+serialize on one lock. Readers take no lock: every slot header starts with a
+sequence number that a writer makes odd while it changes the slot and even
+again when done. A reader copies the slot out and keeps the copy only if the
+sequence number was even and unchanged across the copy, and if the key
+stored in the slot is the one it looked up, so it never returns a torn or
+foreign entry. As in :class:`hotcache.HotCache`, an entry is served only
+under the store version it was cached with.
+"""
+
+import mmap, struct, hashlib, bisect
+from multiprocessing import Lock
+
+WAYS = 8
+MIN_CLASS = 1024
+# next never-used slot, clock hand
+CLASS = struct.Struct('<II')
+# fingerprint, slot number + 1 (0: empty)
+BUCKET = struct.Struct('<QI4x')
+# seq, bucket way + 1 (0: free), version hash, fingerprint, data length,
+# key length, referenced since the last sweep
+SLOT = struct.Struct('<IIqQIHBx')
+SEQ = struct.Struct('<I')
+REFERENCED_AT = SLOT.size - 2
+# attempts at reading a slot that a writer is busy with
+READ_TRIES = 3
+
+def _fingerprint(key):
+  return struct.unpack('<Q', hashlib.md5(key).digest()[:8])[0] or 1
+
+class SharedHotCache(object):
+
+  def __init__(self, max_bytes=64 << 20, max_object=256 << 10):
+    self.max_object = max_object
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+    sizes = [MIN_CLASS]
+    while sizes[-1] < max_object:
+      sizes.append(sizes[-1] * 2)
+    self._sizes = sizes
+    self._counts = [max(1, max_bytes // len(sizes) // (SLOT.size + size))
+                    for size in sizes]
+    self._first = [sum(self._counts[:c]) for c in range(len(sizes))]
+    n_slots = sum(self._counts)
+    # at most half full on average
+    self._buckets = max(1, 2 * n_slots // WAYS)
+
+    self._table_at = CLASS.size * len(sizes)
+    self._slabs_at = [self._table_at + self._buckets * WAYS * BUCKET.size]
+    for c in range(len(sizes) - 1):
+      self._slabs_at.append(
+          self._slabs_at[c] + self._counts[c] * (SLOT.size + sizes[c]))
+    size = self._slabs_at[-1] + self._counts[-1] * (SLOT.size + sizes[-1])
+
+    # anonymous maps are shared with the processes forked later
+    self._arena = mmap.mmap(-1, size)
+    self.size = size
+    self._lock = Lock()
+
+  def __len__(self):
+    arena = self._arena
+    n = 0
+    for at in xrange(self._table_at, self._slabs_at[0], BUCKET.size):
+      if BUCKET.unpack_from(arena, at)[1]:
+        n += 1
+    return n
+
+  def fits(self, size, key=''):
+    """Whether ``size`` bytes of data stored under ``key`` would be kept;
+    the key shares the slot with the data."""
+    return size <= self.max_object and len(key) + size <= self._sizes[-1]
+
+  #......................................................................
+  def _slot_at(self, slot):
+    c = bisect.bisect_right(self._first, slot) - 1
+    return c, self._slabs_at[c] + \
+        (slot - self._first[c]) * (SLOT.size + self._sizes[c])
+
+  def _bucket_at(self, fingerprint):
+    return self._table_at + (fingerprint % self._buckets) * WAYS * BUCKET.size
+
+  def _read(self, slot, fingerprint):
+    """Copy out ``(key, version hash, data)`` of ``slot`` if it holds
+    ``fingerprint`` and no writer touched it meanwhile."""
+    arena = self._arena
+    c, at = self._slot_at(slot)
+    capacity = self._sizes[c]
+    for i in range(READ_TRIES):
+      seq, way, version, fp, data_len, key_len, ref = SLOT.unpack_from(arena, at)
+      if seq & 1:
+        continue
+      if fp != fingerprint or not way:
+        return None
+      start = at + SLOT.size
+      key_len = min(key_len, capacity)
+      data_len = min(data_len, capacity - key_len)
+      key = arena[start:start + key_len]
+      data = arena[start + key_len:start + key_len + data_len]
+      if SEQ.unpack_from(arena, at)[0] == seq:
+        return key, version, data
+    return None
+
+  def get(self, key, version):
+    """Return the data cached for ``key`` if it was stored under
+    ``version``, else None."""
+    arena = self._arena
+    fingerprint = _fingerprint(key)
+    bucket = self._bucket_at(fingerprint)
+    for way in range(WAYS):
+      fp, slot = BUCKET.unpack_from(arena, bucket + way * BUCKET.size)
+      if fp != fingerprint or not slot:
+        continue
+      found = self._read(slot - 1, fingerprint)
+      if found is None or found[0] != key:
+        continue
+      if found[1] != hash(version):
+        break
+      c, at = self._slot_at(slot - 1)
+      arena[at + REFERENCED_AT] = '\x01'
+      self.hits += 1
+      return found[2]
+    self.misses += 1
+    return None
+
+  #......................................................................
+  def _clear_slot(self, slot):
+    # writer lock held
+    arena = self._arena
+    c, at = self._slot_at(slot)
+    seq, way = SLOT.unpack_from(arena, at)[:2]
+    if way:
+      bucket_at = self._table_at + (way - 1) * BUCKET.size
+      if BUCKET.unpack_from(arena, bucket_at)[1] == slot + 1:
+        BUCKET.pack_into(arena, bucket_at, 0, 0)
+    SEQ.pack_into(arena, at, seq + 1)
+    SLOT.pack_into(arena, at, seq + 1, 0, 0, 0, 0, 0, 0)
+    SEQ.pack_into(arena, at, seq + 2)
+
+  def _allocate(self, c):
+    # writer lock held
+    arena = self._arena
+    unused, hand = CLASS.unpack_from(arena, c * CLASS.size)
+    count = self._counts[c]
+    if unused < count:
+      CLASS.pack_into(arena, c * CLASS.size, unused + 1, hand)
+      return self._first[c] + unused
+    for i in xrange(2 * count):
+      slot = self._first[c] + hand
+      hand = (hand + 1) % count
+      at = self._slot_at(slot)[1]
+      way = SLOT.unpack_from(arena, at)[1]
+      if not way:
+        break
+      if arena[at + REFERENCED_AT] == '\x01':
+        # read since the last sweep; give it another round
+        arena[at + REFERENCED_AT] = '\x00'
+        continue
+      self._clear_slot(slot)
+      self.evictions += 1
+      break
+    CLASS.pack_into(arena, c * CLASS.size, unused, hand)
+    return slot
+
+  def _unlink(self, key, fingerprint):
+    # writer lock held
+    arena = self._arena
+    bucket = self._bucket_at(fingerprint)
+    for way in range(WAYS):
+      fp, slot = BUCKET.unpack_from(arena, bucket + way * BUCKET.size)
+      if fp == fingerprint and slot:
+        found = self._read(slot - 1, fingerprint)
+        if found is not None and found[0] == key:
+          self._clear_slot(slot - 1)
+
+  def put(self, key, version, data):
+    if version is None or not self.fits(len(data), key):
+      return
+    size = len(key) + len(data)
+    c = bisect.bisect_left(self._sizes, size)
+    fingerprint = _fingerprint(key)
+    bucket = self._bucket_at(fingerprint)
+    arena = self._arena
+    with self._lock:
+      self._unlink(key, fingerprint)
+      slot = self._allocate(c)
+
+      # a free way in the bucket, or the first one not read lately
+      victim = None
+      for way in range(WAYS):
+        fp, used = BUCKET.unpack_from(arena, bucket + way * BUCKET.size)
+        if not used:
+          victim = way
+          break
+        at = self._slot_at(used - 1)[1]
+        if victim is None and arena[at + REFERENCED_AT] != '\x01':
+          victim = way
+      if victim is None:
+        victim = fingerprint % WAYS
+      bucket_at = bucket + victim * BUCKET.size
+      used = BUCKET.unpack_from(arena, bucket_at)[1]
+      if used:
+        self._clear_slot(used - 1)
+        self.evictions += 1
+
+      at = self._slot_at(slot)[1]
+      seq = SEQ.unpack_from(arena, at)[0] | 1
+      SEQ.pack_into(arena, at, seq)
+      start = at + SLOT.size
+      arena[start:start + size] = key + data
+      way = (bucket_at - self._table_at) // BUCKET.size + 1
+      SLOT.pack_into(arena, at, seq, way, hash(version), fingerprint,
+                     len(data), len(key), 0)
+      SEQ.pack_into(arena, at, seq + 1)
+      BUCKET.pack_into(arena, bucket_at, fingerprint, slot + 1)
+
+  def invalidate(self, key):
+    with self._lock:
+      self._unlink(key, _fingerprint(key))
+
+  def stats(self):
+    lookups = self.hits + self.misses
+    return ('%d hits, %d misses (%.1f%% hit rate) in this worker, '
+            '%d evicted by it, %d bytes shared' % (
+                self.hits, self.misses,
+                100.0 * self.hits / lookups if lookups else 0.0,
+                self.evictions, self.size))
@@ -0,0 +1,111 @@
+"""Pack-file store: appends, compaction and rebuilding the index."""
+
+import os, shutil, tempfile, unittest
+
+from packstore import PackStore
+
+def value(key, size=300):
+  return (key * size)[:size]
+
+class PackStoreTest(unittest.TestCase):
+
+  def setUp(self):
+    self.cache_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.cache_dir)
+
+  def store(self):
+    store = PackStore(self.cache_dir, segment_size=1024)
+    store.init()
+    store.load()
+    return store
+
+  def read(self, store, key):
+    entry = store.open_entry(key)
+    if entry is None:
+      return None
+    try:
+      return entry.read(entry.length, 0)
+    finally:
+      entry.close()
+
+  def put(self, store, key, data):
+    writer = store.writer(key)
+    writer.write(data)
+    return writer.commit()
+
+  def test_put_and_read(self):
+    store = self.store()
+    self.put(store, 'a', value('a'))
+    self.put(store, 'b', value('b'))
+    self.assertEqual(self.read(store, 'a'), value('a'))
+    self.assertEqual(self.read(store, 'b'), value('b'))
+    self.assertEqual(self.read(store, 'c'), None)
+
+  def test_reload(self):
+    store = self.store()
+    for key in 'abcdefgh':
+      self.put(store, key, value(key))
+    self.put(store, 'a', value('A'))
+    store.remove('b')
+    store = self.store()
+    self.assertEqual(len(store), 7)
+    self.assertEqual(self.read(store, 'a'), value('A'))
+    self.assertEqual(self.read(store, 'b'), None)
+    self.assertEqual(self.read(store, 'h'), value('h'))
+
+  def test_torn_record(self):
+    store = self.store()
+    self.put(store, 'a', value('a'))
+    segment = store.segment_path(store.version('a')[0])
+    f = open(segment, 'ab')
+    # the start of a record cut short by a crash
+    f.write('CPK1\0\0\0\0')
+    f.close()
+    store = self.store()
+    self.assertEqual(self.read(store, 'a'), value('a'))
+    self.put(store, 'b', value('b'))
+    self.assertEqual(self.read(store, 'b'), value('b'))
+
+  def test_compaction(self):
+    store = self.store()
+    for key in 'abcdefghij':
+      self.put(store, key, value(key))
+    # most of the sealed segments become garbage
+    for key in 'abcdefgh':
+      store.remove(key)
+    self.put(store, 'i', value('I'))
+    before = store.segments()
+    # segments written by this process are still being appended to
+    store = self.store()
+    self.assertTrue(store.compact(0.5) > 0)
+    after = store.segments()
+    self.assertTrue(set(before) - set(after))
+    self.assertEqual(self.read(store, 'i'), value('I'))
+    self.assertEqual(self.read(store, 'j'), value('j'))
+
+    # removed keys stay removed once the old records are gone
+    store = self.store()
+    self.assertEqual(sorted(key for key, size, seq in store.entries()),
+                     ['i', 'j'])
+    self.assertEqual(self.read(store, 'a'), None)
+    self.assertEqual(self.read(store, 'i'), value('I'))
+
+  def test_entry_open_across_compaction(self):
+    store = self.store()
+    for key in 'abcd':
+      self.put(store, key, value(key))
+    store.remove('a')
+    store.remove('b')
+    store = self.store()
+    entry = store.open_entry('c')
+    try:
+      store.compact(0.0)
+      self.assertEqual(entry.read(entry.length, 0), value('c'))
+    finally:
+      entry.close()
+    self.assertEqual(self.read(store, 'c'), value('c'))
+
+if __name__ == '__main__':
+  unittest.main()
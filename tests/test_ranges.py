@@ -0,0 +1,91 @@
+"""Range requests answered from a stored response (ProxyHandler.send_entity)."""
+
+import unittest
+from StringIO import StringIO
+
+import proxyserv, entrymeta
+
+BODY = '0123456789'
+HEAD = 'HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nETag: "v1"\r\n' \
+    'Last-Modified: Tue, 01 Jan 2013 00:00:00 GMT'
+
+class Connection(object):
+
+  def __init__(self):
+    self.sent = []
+
+  def sendall(self, data):
+    self.sent.append(str(data))
+
+class Handler(proxyserv.ProxyHandler):
+
+  def __init__(self, request):
+    self.request = request
+    self.connection = Connection()
+    self.keep_alive = True
+
+def answer(*fields):
+  raw = 'GET http://example.com/a HTTP/1.1\r\nHost: example.com\r\n%s\r\n' % \
+      ''.join(field + '\r\n' for field in fields)
+  request = proxyserv.HttpMessage(fileobj=StringIO(raw))
+  request.buffer_all()
+  handler = Handler(request)
+  handler.send_entity(entrymeta.EntryMeta.from_head(HEAD), BODY)
+  head, sep, body = ''.join(handler.connection.sent).partition('\r\n\r\n')
+  return head.split('\r\n'), body
+
+class RangeTest(unittest.TestCase):
+
+  def test_no_range(self):
+    head, body = answer()
+    self.assertEqual(head[0], 'HTTP/1.1 200 OK')
+    self.assertEqual(body, BODY)
+
+  def test_single_range(self):
+    head, body = answer('Range: bytes=2-4')
+    self.assertEqual(head[0], 'HTTP/1.1 206 Partial Content')
+    self.assertIn('Content-Range: bytes 2-4/10', head)
+    self.assertIn('Content-Length: 3', head)
+    self.assertEqual(body, '234')
+
+  def test_suffix_and_open_ranges(self):
+    self.assertEqual(answer('Range: bytes=-3')[1], '789')
+    self.assertEqual(answer('Range: bytes=8-')[1], '89')
+    # past the end is cut to the end
+    self.assertEqual(answer('Range: bytes=6-100')[1], '6789')
+
+  def test_multiple_ranges(self):
+    head, body = answer('Range: bytes=0-1,7-8')
+    self.assertEqual(head[0], 'HTTP/1.1 206 Partial Content')
+    content_type = [line for line in head if line.startswith('Content-Type')]
+    self.assertEqual(len(content_type), 1)
+    boundary = content_type[0].split('boundary=')[1]
+    self.assertIn('Content-Length: %d' % len(body), head)
+    parts = body.split('--' + boundary)
+    self.assertEqual(parts[-1], '--\r\n')
+    self.assertTrue(parts[1].endswith('Content-Range: bytes 0-1/10\r\n\r\n01\r\n'))
+    self.assertTrue(parts[2].endswith('Content-Range: bytes 7-8/10\r\n\r\n78\r\n'))
+
+  def test_unsatisfiable(self):
+    head, body = answer('Range: bytes=20-30')
+    self.assertEqual(head[0], 'HTTP/1.1 416 Requested Range Not Satisfiable')
+    self.assertIn('Content-Range: bytes */10', head)
+    self.assertEqual(body, '')
+
+  def test_overlapping_ranges_send_everything(self):
+    head, body = answer('Range: bytes=0-7,2-9')
+    self.assertEqual(head[0], 'HTTP/1.1 200 OK')
+    self.assertEqual(body, BODY)
+
+  def test_if_range(self):
+    self.assertEqual(answer('Range: bytes=2-4', 'If-Range: "v1"')[1], '234')
+    self.assertEqual(answer('Range: bytes=2-4',
+                            'If-Range: Tue, 01 Jan 2013 00:00:00 GMT')[1],
+                     '234')
+    # another tag, a weak one or another date: the whole entity
+    for value in ('"v2"', 'W/"v1"', 'Wed, 02 Jan 2013 00:00:00 GMT'):
+      self.assertEqual(answer('Range: bytes=2-4', 'If-Range: ' + value)[1],
+                       BODY)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,123 @@
+"""Snapshots of the cache index and the journal replayed on top of them."""
+
+import os, shutil, tempfile, unittest
+
+from cacheindex import CacheIndex, SNAPSHOT_NAME, JOURNAL_NAME
+
+class SnapshotTest(unittest.TestCase):
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    self.snapshot = os.path.join(self.root, SNAPSHOT_NAME)
+    self.journal = os.path.join(self.root, JOURNAL_NAME)
+
+  def tearDown(self):
+    shutil.rmtree(self.root)
+
+  def write(self, name, data):
+    path = os.path.join(self.root, name)
+    f = open(path, 'wb')
+    f.write(data)
+    f.close()
+    return path
+
+  def started(self):
+    index = CacheIndex(self.root)
+    index.scan()
+    return index
+
+  def test_round_trip(self):
+    index = self.started()
+    index.add('/a', 10, 1.5)
+    index.add('/b', 20, 2.25)
+    index.checkpoint(self.snapshot)
+    entries, complete = CacheIndex(self.root).load_snapshot(self.snapshot)
+    self.assertTrue(complete)
+    self.assertEqual(entries, {'/a': (10, 1.5), '/b': (20, 2.25)})
+
+  def test_journal_after_snapshot(self):
+    index = self.started()
+    index.add('/a', 10, 1.5)
+    index.add('/b', 20, 2.25)
+    index.checkpoint(self.snapshot)
+    index.remove('/a')
+    index.add('/c', 30, 3.0)
+    entries, complete = CacheIndex(self.root).load_snapshot(self.snapshot)
+    self.assertTrue(complete)
+    self.assertEqual(entries, {'/b': (20, 2.25), '/c': (30, 3.0)})
+
+  def test_checkpoint_starts_new_journal(self):
+    index = self.started()
+    for i in range(100):
+      index.add('/%d' % i, i, 0.0)
+    index.checkpoint(self.snapshot)
+    # only the header of the new journal
+    self.assertEqual(len(open(self.journal).read().splitlines()), 1)
+    index.add('/x', 1, 0.0)
+    self.assertEqual(len(index), 101)
+
+  def test_other_process_follows_new_journal(self):
+    index = self.started()
+    index.add('/a', 10, 1.5)
+    ready, go = os.pipe(), os.pipe()
+    pid = os.fork()
+    if pid == 0:
+      status = 1
+      try:
+        index.add('/b', 20, 2.25)
+        os.write(ready[1], 'x')
+        os.read(go[0], 1)
+        # behind by the records published around the checkpoint
+        if dict(index.items()) == {'/a': (10, 1.5), '/b': (20, 2.25),
+                                   '/c': (30, 3.0), '/d': (40, 4.0)}:
+          status = 0
+      finally:
+        os._exit(status)
+    os.read(ready[0], 1)
+    index.add('/c', 30, 3.0)
+    index.checkpoint(self.snapshot)
+    index.add('/d', 40, 4.0)
+    os.write(go[1], 'x')
+    self.assertEqual(os.waitpid(pid, 0)[1], 0)
+
+  def test_torn_journal_tail(self):
+    index = self.started()
+    index.add('/a', 10, 1.5)
+    index.checkpoint(self.snapshot)
+    index.add('/b', 20, 2.25)
+    # a crash in the middle of appending a record
+    f = open(self.journal, 'ab')
+    f.write('+/c\t30')
+    f.close()
+    entries, complete = CacheIndex(self.root).load_snapshot(self.snapshot)
+    self.assertTrue(complete)
+    self.assertEqual(entries, {'/a': (10, 1.5), '/b': (20, 2.25)})
+
+  def test_journal_of_another_run(self):
+    index = self.started()
+    index.add('/a', 10, 1.5)
+    index.checkpoint(self.snapshot)
+    # a later run that never checkpointed started the journal again
+    self.started()
+    entries, complete = CacheIndex(self.root).load_snapshot(self.snapshot)
+    self.assertFalse(complete)
+    self.assertEqual(entries, {'/a': (10, 1.5)})
+
+  def test_damaged_snapshot(self):
+    self.write(SNAPSHOT_NAME, 'CIX1 not a snapshot')
+    self.assertEqual(CacheIndex(self.root).load_snapshot(self.snapshot), None)
+
+  def test_load_rescans_when_incomplete(self):
+    path = self.write('entry', 'x' * 5)
+    index = self.started()
+    index.add('/gone', 1, 0.0)
+    index.checkpoint(self.snapshot)
+    self.started()
+    index = CacheIndex(self.root)
+    self.assertEqual(index.load(self.snapshot), 1)
+    self.assertFalse(index.from_snapshot)
+    self.assertEqual(index.lookup(path)[0], 5)
+    self.assertEqual(index.lookup('/gone'), None)
+
+if __name__ == '__main__':
+  unittest.main()
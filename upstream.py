@@ -0,0 +1,92 @@
+"""
+Pool of persistent HTTP/1.1 connections to the upstream (SSL Strip).
+
+Connections are checked out by a fetcher thread, used for exactly one
+request/response exchange, and checked back in only if the response was
+framed by length (so the stream is positioned at the next response) and the
+upstream did not ask to close. A connection that sat idle longer than
+``idle_timeout`` is closed instead of reused, and every checkout verifies
+that the peer has not closed or sent stray bytes in the meantime.
+
+Sockets are never shared between processes; a pool inherited through fork
+starts out empty in the child.
+"""
+
+import os, time, socket, select, threading
+from httpmessage import const
+
+class UpstreamPool(object):
+
+  def __init__(self, address, max_size=16, idle_timeout=15.0):
+    self.address = address
+    self.max_size = max_size
+    self.idle_timeout = idle_timeout
+    self._idle = []
+    self._lock = threading.Lock()
+    self._pid = os.getpid()
+
+  def _healthy(self, sock, last_used):
+    if time.time() - last_used > self.idle_timeout:
+      return False
+    try:
+      readable, _, _ = select.select([sock], [], [], 0)
+      # an idle HTTP connection has nothing to say; readable means EOF
+      # (upstream closed it) or garbage we must not parse as a response
+      return not readable
+    except (select.error, socket.error, ValueError):
+      return False
+
+  def checkout(self, timeout):
+    """Return ``(sock, reused)``: a healthy idle connection if there is one,
+    otherwise a freshly connected socket. ``timeout`` is applied to it."""
+    while True:
+      with self._lock:
+        if self._pid != os.getpid():
+          self._idle = []
+          self._pid = os.getpid()
+        if not self._idle:
+          break
+        sock, last_used = self._idle.pop()
+      if self._healthy(sock, last_used):
+        sock.settimeout(timeout)
+        return sock, True
+      sock.close()
+
+    sock = socket.socket()
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.settimeout(timeout)
+    sock.connect(self.address)
+    return sock, False
+
+  def checkin(self, sock):
+    """Return a connection whose last response was read to the end."""
+    with self._lock:
+      if self._pid == os.getpid() and len(self._idle) < self.max_size:
+        self._idle.append((sock, time.time()))
+        return
+    sock.close()
+
+  def discard(self, sock):
+    try:
+      sock.close()
+    except socket.error:
+      pass
+
+  def close_all(self):
+    with self._lock:
+      idle, self._idle = self._idle, []
+    for sock, last_used in idle:
+      sock.close()
+
+def reusable(response):
+  """True if the connection ``response`` arrived on may carry another
+  exchange. Must be called before the entity is read, while the framing
+  headers still describe the wire format."""
+  if response.entity_size() is const.CONNECTION_CLOSE:
+    return False
+  tokens = [t.lower() for t in (response.connection or ())]
+  if 'close' in tokens:
+    return False
+  if response.http_version == 'HTTP/1.0':
+    return 'keep-alive' in tokens
+  return True
@@ -0,0 +1,89 @@
+"""
+Variants of responses that vary with request headers.
+
+A response with ``Vary`` is stored under a key of its own for each variant:
+the request key, then the values the request had for the headers named in
+``Vary`` (:func:`variant_key`). :class:`VaryIndex`, shared by all workers,
+maps a request key to those header names. A lookup builds the key of the
+variant the request selects and probes the store once, without reading
+other variants or the stored heads.
+
+The index is journaled like the store index (see cacheindex.py) and
+snapshotted once at startup, so the snapshot plus the journal of the last
+run give it back at the next start. It is not pruned when variants are
+evicted; a name list without variants behind it only costs a miss.
+"""
+
+import os
+from cacheindex import SharedMap
+
+JOURNAL_NAME = '.vary.journal'
+SNAPSHOT_NAME = '.vary.snapshot'
+# between the request key and the header values in a variant key; it is
+# never in a request line or a header value
+SEPARATOR = '\0'
+
+def vary_names(vary):
+  """The header names of a ``Vary`` field (as read from the message: a
+  tuple, or None if there is none), lowercased and sorted. None for
+  ``Vary: *``, which no stored variant can satisfy."""
+  names = set()
+  for name in vary or ():
+    name = name.strip().lower()
+    if name == '*':
+      return None
+    if name:
+      names.add(name)
+  return tuple(sorted(names))
+
+def variant_key(key, names, request):
+  """The key of the variant of ``key`` that ``request`` selects, given the
+  header ``names`` its responses vary on."""
+  values = [key]
+  for name in names:
+    found = request.getall(name) if name in request else ()
+    # whitespace is not significant in field values
+    values.append(' '.join(','.join(found).split()))
+  return SEPARATOR.join(values)
+
+class VaryIndex(SharedMap):
+
+  """Map from request key to the names of the request headers that its
+  stored responses vary on."""
+
+  def __init__(self, cache_dir):
+    SharedMap.__init__(self, os.path.join(cache_dir, JOURNAL_NAME))
+    self.snapshot_path = os.path.join(cache_dir, SNAPSHOT_NAME)
+
+  def encode(self, value):
+    return ','.join(value)
+
+  def decode(self, text):
+    return tuple(text.split(','))
+
+  def load(self):
+    """Read back the index of the last run and start a new journal. Must
+    run before the worker processes are forked. Returns how many keys
+    vary."""
+    loaded = self.load_snapshot(self.snapshot_path)
+    entries = loaded[0] if loaded is not None else {}
+    self.reset(entries)
+    self.from_snapshot = loaded is not None
+    self.checkpoint(self.snapshot_path)
+    return len(entries)
+
+  def key_for(self, key, request):
+    """The key the response to ``request`` is stored under: a variant key
+    if responses for ``key`` vary, else ``key`` itself."""
+    names = self.get(key)
+    return variant_key(key, names, request) if names else key
+
+  def record(self, key, names):
+    """Note the header ``names`` (from :func:`vary_names`) that a response
+    for ``key`` varies on; no names if it does not vary."""
+    if (self.get(key) or ()) == names:
+      return
+    if names:
+      self.put(key, names)
+    else:
+      self.discard(key)
@@ -0,0 +1,158 @@
+"""
+Send a byte range of a file to a socket without copying it through Python.
+
+Uses :func:`os.sendfile` where the interpreter has it, the C library's
+``sendfile(2)`` through :mod:`ctypes` otherwise (Linux), and falls back to a
+plain read/``sendall`` loop where neither is available. Partial writes are
+always resumed until the whole range is out; sockets with a timeout (which
+Python puts in non-blocking mode) are waited on with :func:`select.select`.
+A connection of the event loop server queues the range instead (see
+eventserver.py), and its loop sends it with :func:`sendfile_some`.
+
+:func:`pread` reads at an offset without touching the file position, so
+threads can share one descriptor.
+"""
+
+import os, errno, select, socket, threading
+
+# upper bound per system call, so a stalled client is noticed between calls
+MAX_CHUNK = 1 << 20
+
+_sendfile = getattr(os, 'sendfile', None)
+_pread = getattr(os, 'pread', None)
+
+_libc = None
+if _sendfile is None or _pread is None:
+  try:
+    import ctypes, ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                        use_errno=True)
+  except (ImportError, OSError):
+    _libc = None
+
+if _sendfile is None and _libc is not None:
+  try:
+    _libc_sendfile = _libc.sendfile
+    _libc_sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+                               ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    _libc_sendfile.restype = ctypes.c_ssize_t
+
+    def _sendfile(out_fd, in_fd, offset, count):
+      off = ctypes.c_int64(offset)
+      sent = _libc_sendfile(out_fd, in_fd, ctypes.byref(off), count)
+      if sent < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+      return sent
+  except AttributeError:
+    _sendfile = None
+
+if _pread is None and _libc is not None:
+  try:
+    _libc_pread = _libc.pread64
+    _libc_pread.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t,
+                            ctypes.c_int64]
+    _libc_pread.restype = ctypes.c_ssize_t
+
+    def _pread(fd, count, offset):
+      buf = ctypes.create_string_buffer(count)
+      while True:
+        got = _libc_pread(fd, buf, count, offset)
+        if got >= 0:
+          return buf.raw[:got]
+        err = ctypes.get_errno()
+        if err != errno.EINTR:
+          raise OSError(err, os.strerror(err))
+  except AttributeError:
+    _pread = None
+
+_seek_lock = threading.Lock()
+
+def pread(fd, count, offset):
+  """Read up to ``count`` bytes of ``fd`` at ``offset``. Fewer bytes are
+  returned only at the end of the file."""
+  if _pread is None:
+    # no positional read: make seek+read atomic within this process
+    with _seek_lock:
+      os.lseek(fd, offset, os.SEEK_SET)
+      return os.read(fd, count)
+  data = _pread(fd, count, offset)
+  while len(data) < count:
+    more = _pread(fd, count - len(data), offset + len(data))
+    if not more:
+      break
+    data += more
+  return data
+
+def _wait_writable(sock):
+  timeout = sock.gettimeout()
+  _, writable, _ = select.select([], [sock], [], timeout)
+  if not writable:
+    raise socket.timeout('timed out')
+
+def _copy(sock, fd, offset, count):
+  os.lseek(fd, offset, os.SEEK_SET)
+  while count > 0:
+    data = os.read(fd, min(count, 65536))
+    if not data:
+      raise EOFError('file ended %d bytes early' % count)
+    sock.sendall(data)
+    count -= len(data)
+
+def sendfile(sock, fd, offset, count):
+  """Send ``count`` bytes of the open file descriptor ``fd``, starting at
+  ``offset``, to ``sock``. Does not move the file position (except in the
+  read/``sendall`` fallback). Raises :exc:`EOFError` if the file is
+  shorter than promised."""
+  queue_file = getattr(sock, 'queue_file', None)
+  if queue_file is not None:
+    return queue_file(fd, offset, count)
+  if _sendfile is None:
+    return _copy(sock, fd, offset, count)
+
+  out_fd = sock.fileno()
+  while count > 0:
+    try:
+      sent = _sendfile(out_fd, fd, offset, min(count, MAX_CHUNK))
+    except OSError as e:
+      if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+        _wait_writable(sock)
+        continue
+      if e.errno == errno.EINTR:
+        continue
+      if e.errno in (errno.EINVAL, errno.ENOSYS):
+        # this fd pair cannot do sendfile; copy the rest by hand
+        return _copy(sock, fd, offset, count)
+      raise socket.error(e.errno, e.strerror)
+    if sent == 0:
+      raise EOFError('file ended %d bytes early' % count)
+    offset += sent
+    count -= sent
+
+def sendfile_some(sock, fd, offset, count):
+  """Send what the non-blocking ``sock`` takes, up to ``count`` bytes of
+  ``fd`` from ``offset`` on. Returns how many bytes went out."""
+  total = 0
+  copy = _sendfile is None
+  while count > 0:
+    try:
+      if copy:
+        data = pread(fd, min(count, 65536), offset)
+        sent = sock.send(data) if data else 0
+      else:
+        sent = _sendfile(sock.fileno(), fd, offset, min(count, MAX_CHUNK))
+    except (OSError, socket.error) as e:
+      if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+        break
+      if e.args[0] == errno.EINTR:
+        continue
+      if not copy and e.args[0] in (errno.EINVAL, errno.ENOSYS):
+        copy = True
+        continue
+      raise socket.error(e.args[0], os.strerror(e.args[0]))
+    if sent == 0:
+      raise EOFError('file ended %d bytes early' % count)
+    offset += sent
+    count -= sent
+    total += sent
+  return total